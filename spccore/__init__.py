@@ -1,4 +1,6 @@
 from .baseclient import get_base_client
 from .exceptions import check_status_code_and_raise_error
+from .internal.scheduler import get_transfer_scheduler
+from .progress import TransferProgress
 
-__all__ = ['get_base_client']
+__all__ = ['get_base_client', 'get_transfer_scheduler', 'TransferProgress']
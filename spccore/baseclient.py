@@ -1,4 +1,5 @@
 import base64
+import functools
 import hashlib
 import hmac
 import json
@@ -7,7 +8,16 @@ import typing
 import urllib.parse as urllib_parse
 from .constants import *
 from .download import *
+from .download import _download_file_handles, _iter_download_file_handles, _get_file_handle_batch
 from .exceptions import *
+from .sync import *
+from .sync import _sync_from_synapse, _sync_to_synapse
+from .upload import UploadResult
+from .upload import _upload_file_handle, _upload_file_handles, _upload_stream
+from .internal.cache import Cache
+from .internal.scheduler import get_transfer_scheduler
+from .internal.urlcache import PresignedUrlCache
+from .progress import TransferProgress
 from .utils import *
 
 
@@ -34,12 +44,32 @@ class SynapseBaseClient:
     upload_file_handle("/path/to/analysis.txt", content_type="text/plain", generate_preview=False)
         Uploads a file to Synapse
 
+    upload_file_handles(["/path/to/run1.csv", "/path/to/run2.csv"], content_type="text/csv")
+        Uploads many files to Synapse, side by side
+
+    upload_file_handle_from_stream(process.stdout, "analysis.txt.gz", content_type="application/gzip")
+        Uploads the content of a file-like object or of an iterator of bytes to Synapse
+
     download_file_handles(download_requests={file_handle_id="456",
                                              object_id="syn123",
                                              object_type="FileEntity",
                                              path="~/Documents/analysis.txt"})
         Downloads a batch of files from Synapse
 
+    download_file_handles_as_completed(download_requests={file_handle_id="456",
+                                                          object_id="syn123",
+                                                          object_type="FileEntity",
+                                                          path="~/Documents/analysis.txt"})
+        Downloads a batch of files from Synapse, yielding each result as soon as its file lands
+
+    sync_from_synapse(remote_files=[RemoteFile(path="data/a.csv", file_handle_id=456, object_id="syn123",
+                                               object_type="FileEntity", content_size=10, content_md5="...")],
+                      local_dir="~/Documents/project")
+        Downloads the files of a Synapse container that are missing or changed locally
+
+    sync_to_synapse(local_dir="~/Documents/project", remote_files=[...])
+        Uploads the local files that are missing or changed in a Synapse container
+
     """
 
     def __init__(self, *,
@@ -47,7 +77,11 @@ class SynapseBaseClient:
                  auth_endpoint: str = SYNAPSE_DEFAULT_AUTH_ENDPOINT,
                  file_endpoint: str = SYNAPSE_DEFAULT_FILE_ENDPOINT,
                  username: str = None,
-                 api_key: str = None):
+                 api_key: str = None,
+                 cache_root_dir: str = SYNAPSE_DEFAULT_CACHE_ROOT_DIR,
+                 use_cache_index: bool = False,
+                 cache_max_bytes: int = None,
+                 cache_dedupe: bool = False):
         """
 
         :param repo_endpoint: the Synapse server repo endpoint
@@ -55,6 +89,12 @@ class SynapseBaseClient:
         :param file_endpoint: the Synapse server file endpoint
         :param username: the Synapse username
         :param api_key: the Synapse API key
+        :param cache_root_dir: the root directory of the Synapse cache used by downloads
+        :param use_cache_index: Set to True to look up and purge the cache through an SQLite index. Default False.
+        :param cache_max_bytes: the size the files downloaded into the cache are kept within by evicting the least
+            recently used ones. Default None, unbounded.
+        :param cache_dedupe: Set to True to hardlink each downloaded file to a cached file with the same content.
+            Default False.
         :raises TypeError: when one or more parameters are not in their expected type
         """
         validate_type(str, repo_endpoint, "repo_endpoint")
@@ -62,6 +102,7 @@ class SynapseBaseClient:
         validate_type(str, file_endpoint, "file_endpoint")
         validate_type(str, username, "username")
         validate_type(str, api_key, "api_key")
+        validate_type(str, cache_root_dir, "cache_root_dir")
 
         self._default_repo_endpoint = repo_endpoint
         self._default_auth_endpoint = auth_endpoint
@@ -69,6 +110,15 @@ class SynapseBaseClient:
         self._username = username
         self._api_key = base64.b64decode(api_key) if api_key is not None else None
         self._requests_session = requests.Session()
+        self._cache = Cache(cache_root_dir=cache_root_dir,
+                            use_index=use_cache_index,
+                            max_bytes=cache_max_bytes,
+                            dedupe=cache_dedupe)
+        self._upload_state_dir = os.path.join(cache_root_dir, UPLOAD_STATE_DIR_NAME)
+        # shared by every transfer of this client so URLs are reused across retries and duplicate requests
+        self._presigned_url_cache = PresignedUrlCache(functools.partial(_get_file_handle_batch, self))
+        # shared by every client of the process so concurrent transfers share the bandwidth cap and in flight limit
+        self._transfer_scheduler = get_transfer_scheduler()
 
     def get(self,
             request_path: str,
@@ -190,39 +240,338 @@ class SynapseBaseClient:
                            *,
                            generate_preview: bool = False,
                            storage_location_id: int = SYNAPSE_DEFAULT_STORAGE_LOCATION_ID,
-                           use_multiple_threads: bool = True) -> dict:
+                           use_multiple_threads: bool = True,
+                           priority: str = TRANSFER_PRIORITY_INTERACTIVE,
+                           progress: TransferProgress = None) -> dict:
         """
         Uploads a file to Synapse
 
+        The state of the upload is kept under the cache root until the upload completes. When the process dies
+        mid-upload, uploading the unchanged file again resumes the upload: the file is not hashed again and only the
+        parts Synapse does not have are sent.
+
         :param path: the absolute/relative path to the local file to be uploaded
         :param content_type: the content type of the file
         :param generate_preview: set to True to generate preview. Default False.
         :param storage_location_id: the ID of the Storage Location to upload to.
             Default SYNAPSE_DEFAULT_STORAGE_LOCATION_ID
-        :param use_multiple_threads: set to False to use single thread. Default True.
+        :param use_multiple_threads: set to False to use single thread. Default True, up to UPLOAD_MAX_THREADS
+            threads tuned to the measured throughput.
+        :param priority: the priority class of the transfer in the transfer scheduler shared by the process, one of
+            TRANSFER_PRIORITIES. Default TRANSFER_PRIORITY_INTERACTIVE.
+        :param progress: the TransferProgress to report to. Poll its snapshot() from another thread, or give it a
+            callback, to follow the transfer. Default None, not reported.
         :return: the File Handle created in Synapse
         :raises SynapseClientError: please see each error message
         """
         validate_type(str, path, "path")
         validate_type(str, content_type, "content_type")
+        if not os.path.isfile(path):
+            raise ValueError("Can't find file \"%s\"" % path)
+        channel = self._transfer_scheduler.channel(priority)
+
+        max_threads = UPLOAD_MAX_THREADS if use_multiple_threads else 1
+        return _upload_file_handle(self,
+                                   path,
+                                   content_type,
+                                   generate_preview=generate_preview,
+                                   storage_location_id=storage_location_id,
+                                   max_threads=max_threads,
+                                   channel=channel,
+                                   progress=progress,
+                                   state_dir=self._upload_state_dir,
+                                   hashing_service=self._cache.hashing_service)
+
+    def upload_file_handles(self,
+                            paths: typing.Sequence[str],
+                            content_type: str = None,
+                            *,
+                            generate_preview: bool = False,
+                            storage_location_id: int = SYNAPSE_DEFAULT_STORAGE_LOCATION_ID,
+                            use_multiple_threads: bool = True,
+                            priority: str = TRANSFER_PRIORITY_INTERACTIVE,
+                            progress: TransferProgress = None) -> typing.List[UploadResult]:
+        """
+        Uploads many files to Synapse
 
+        Up to UPLOAD_MAX_THREADS files are uploaded at the same time, so the round trips each file takes to Synapse
+        overlap. Files of up to UPLOAD_SINGLE_PART_MAX_SIZE_BYTES are uploaded as a single part read in one go; larger
+        files are uploaded like in upload_file_handle(), and resumed like there after the process died. A file that
+        fails to upload does not stop the others.
 
+        :param paths: the absolute/relative paths to the local files to be uploaded
+        :param content_type: the content type of all files. Default None, guessed for each file from its name.
+        :param generate_preview: set to True to generate previews. Default False.
+        :param storage_location_id: the ID of the Storage Location to upload to.
+            Default SYNAPSE_DEFAULT_STORAGE_LOCATION_ID
+        :param use_multiple_threads: set to False to use single thread. Default True.
+        :param priority: the priority class of the transfer in the transfer scheduler shared by the process, one of
+            TRANSFER_PRIORITIES. Default TRANSFER_PRIORITY_INTERACTIVE.
+        :param progress: the TransferProgress to report to. Poll its snapshot() from another thread, or give it a
+            callback, to follow the transfer. Default None, not reported.
+        :return: the UploadResults holding the File Handle created in Synapse or the error, in the order of paths
+        :raises SynapseClientError: please see each error message
+        """
+        if isinstance(paths, str):
+            raise TypeError("paths must be a sequence of paths.")
+        validate_type(str, content_type, "content_type")
+        channel = self._transfer_scheduler.channel(priority)
+
+        max_threads = UPLOAD_MAX_THREADS if use_multiple_threads else 1
+        return _upload_file_handles(self,
+                                    paths,
+                                    content_type,
+                                    generate_preview=generate_preview,
+                                    storage_location_id=storage_location_id,
+                                    max_threads=max_threads,
+                                    channel=channel,
+                                    progress=progress,
+                                    state_dir=self._upload_state_dir,
+                                    hashing_service=self._cache.hashing_service)
+
+    def upload_file_handle_from_stream(self,
+                                       stream: typing.Union[typing.BinaryIO, typing.Iterable[bytes]],
+                                       file_name: str,
+                                       content_type: str,
+                                       *,
+                                       size: int = None,
+                                       content_md5: str = None,
+                                       generate_preview: bool = False,
+                                       storage_location_id: int = SYNAPSE_DEFAULT_STORAGE_LOCATION_ID,
+                                       use_multiple_threads: bool = True,
+                                       max_buffered_parts: int = UPLOAD_DEFAULT_MAX_BUFFERED_PARTS,
+                                       priority: str = TRANSFER_PRIORITY_INTERACTIVE,
+                                       progress: TransferProgress = None) -> dict:
+        """
+        Uploads the content of a binary file-like object or of an iterator of bytes to Synapse
 
+        Synapse needs the size and the MD5 of the whole content before the first part is sent. When both are given,
+        each part is hashed and uploaded as soon as it fills, with at most max_buffered_parts parts in memory.
+        Otherwise the content is hashed while it is buffered, in memory up to max_buffered_parts parts and in a
+        temporary file beyond, and uploaded once the stream ends.
 
+        :param stream: a binary file-like object, or an iterable of bytes of unknown length
+        :param file_name: the name of the file in Synapse
+        :param content_type: the content type of the file
+        :param size: the size of the content in bytes. Default None, unknown.
+        :param content_md5: the MD5 hex digest of the content. Default None, unknown.
+        :param generate_preview: set to True to generate preview. Default False.
+        :param storage_location_id: the ID of the Storage Location to upload to.
+            Default SYNAPSE_DEFAULT_STORAGE_LOCATION_ID
+        :param use_multiple_threads: set to False to use single thread. Default True, up to UPLOAD_MAX_THREADS
+            threads tuned to the measured throughput.
+        :param max_buffered_parts: the max number of parts held in memory. Default UPLOAD_DEFAULT_MAX_BUFFERED_PARTS
+        :param priority: the priority class of the transfer in the transfer scheduler shared by the process, one of
+            TRANSFER_PRIORITIES. Default TRANSFER_PRIORITY_INTERACTIVE.
+        :param progress: the TransferProgress to report to. Poll its snapshot() from another thread, or give it a
+            callback, to follow the transfer. Default None, not reported.
+        :return: the File Handle created in Synapse
+        :raises SynapseClientError: please see each error message
+        """
+        validate_type(str, file_name, "file_name")
+        validate_type(str, content_type, "content_type")
+        validate_type(int, size, "size")
+        validate_type(str, content_md5, "content_md5")
+        if max_buffered_parts < 1:
+            raise ValueError("max_buffered_parts must be at least 1.")
+        channel = self._transfer_scheduler.channel(priority)
+
+        max_threads = UPLOAD_MAX_THREADS if use_multiple_threads else 1
+        return _upload_stream(self,
+                              stream,
+                              file_name,
+                              content_type,
+                              size=size,
+                              content_md5=content_md5,
+                              generate_preview=generate_preview,
+                              storage_location_id=storage_location_id,
+                              max_threads=min(max_threads, max_buffered_parts),
+                              max_buffered_parts=max_buffered_parts,
+                              channel=channel,
+                              progress=progress)
 
     def download_file_handles(self,
                               download_requests: typing.Sequence[DownloadRequest],
                               *,
-                              use_multiple_threads: bool = True
+                              use_multiple_threads: bool = True,
+                              priority: str = TRANSFER_PRIORITY_INTERACTIVE,
+                              progress: TransferProgress = None,
+                              disk_space_check: typing.Optional[str] = None,
+                              zip_small_files: bool = False,
+                              hardlink_files: bool = False
                               ) -> typing.Mapping[DownloadRequest, DownloadResult]:
         """
         Downloads a batch of files from Synapse
 
+        Files that have an unmodified copy in the cache are reflinked or copied from the cache instead of being
+        transferred again, and so are the extra copies of a file handle requested at several paths. Requests whose path
+        already is an unmodified cached copy are skipped.
+        Every file that is written is registered in the cache.
+
+        Each file is preallocated before it is written. With a disk_space_check, the sizes of the files to transfer are
+        also summed per destination file system and compared with the space left before any transfer starts. The check
+        retrieves the file handles of those files in an extra round of requests, so it is off by default.
+
+        With zip_small_files, each window of up to SYNAPSE_FILE_HANDLE_BATCH_MAX_SIZE requests that holds at least
+        DOWNLOAD_ZIP_PACKAGE_MIN_FILES files of at most DOWNLOAD_ZIP_PACKAGE_MAX_FILE_SIZE_BYTES has them packaged in a
+        zip by Synapse. The zip is streamed and its members are extracted straight to their paths, so many small files
+        cost one transfer instead of one each. Files Synapse could not package are downloaded one by one.
+
+        For very large batches, pass a DownloadRequestBatch to get the results back as a compact DownloadResultBatch.
+
         :param download_requests: the list of download requests
         :param use_multiple_threads: set to False to use single thread. Default True.
+        :param priority: the priority class of the transfer in the transfer scheduler shared by the process, one of
+            TRANSFER_PRIORITIES. Default TRANSFER_PRIORITY_INTERACTIVE.
+        :param progress: the TransferProgress to report to. Poll its snapshot() from another thread, or give it a
+            callback, to follow the transfer. Default None, not reported.
+        :param disk_space_check: what to do when the files do not fit: DOWNLOAD_DISK_SPACE_CHECK_FAIL raises
+            SynapseInsufficientDiskSpaceError before any transfer, DOWNLOAD_DISK_SPACE_CHECK_TRIM fails the requests
+            that do not fit and downloads the others, None skips the check. Default None.
+        :param zip_small_files: set to True to transfer batches of small files as server-side zip packages.
+            Default False.
+        :param hardlink_files: set to True to hardlink those files to their cached copy before trying a reflink or a
+            copy. A hardlinked file shares its content with the cached copy and the other paths of the file handle, so
+            writing to one of them changes all of them. Default False.
         :return: a map between the DownloadRequest and the result
         :raises SynapseClientError: please see each error message
         """
+        if disk_space_check not in (DOWNLOAD_DISK_SPACE_CHECK_FAIL, DOWNLOAD_DISK_SPACE_CHECK_TRIM, None):
+            raise ValueError("disk_space_check must be DOWNLOAD_DISK_SPACE_CHECK_FAIL, DOWNLOAD_DISK_SPACE_CHECK_TRIM "
+                             "or None.")
+        channel = self._transfer_scheduler.channel(priority)
+        max_threads = DEFAULT_TRANSFER_MAX_THREADS if use_multiple_threads else 1
+        results = _download_file_handles(self,
+                                         download_requests,
+                                         cache=self._cache,
+                                         max_threads=max_threads,
+                                         channel=channel,
+                                         progress=progress,
+                                         disk_space_check=disk_space_check,
+                                         zip_small_files=zip_small_files,
+                                         hardlink_files=hardlink_files)
+        if isinstance(download_requests, DownloadRequestBatch):
+            return results
+        return dict(zip(download_requests, results))
+
+    def download_file_handles_as_completed(self,
+                                           download_requests: typing.Sequence[DownloadRequest],
+                                           *,
+                                           use_multiple_threads: bool = True,
+                                           priority: str = TRANSFER_PRIORITY_INTERACTIVE,
+                                           progress: TransferProgress = None,
+                                           zip_small_files: bool = False,
+                                           hardlink_files: bool = False
+                                           ) -> typing.Iterator[typing.Tuple[DownloadRequest, DownloadResult]]:
+        """
+        Downloads a batch of files from Synapse and yields each result as soon as its file lands
+
+        The requests are handled like in download_file_handles(), but the results are not collected, so processing
+        can start on the first file and memory stays bounded however large the batch is. There is no disk space check:
+        files start landing before the whole batch is sized, so a file that does not fit fails on its own.
+
+        :param download_requests: the list of download requests
+        :param use_multiple_threads: set to False to use single thread. Default True.
+        :param priority: the priority class of the transfer in the transfer scheduler shared by the process, one of
+            TRANSFER_PRIORITIES. Default TRANSFER_PRIORITY_INTERACTIVE.
+        :param progress: the TransferProgress to report to. Poll its snapshot() from another thread, or give it a
+            callback, to follow the transfer. Default None, not reported.
+        :param zip_small_files: set to True to transfer batches of small files as server-side zip packages.
+            Default False.
+        :param hardlink_files: set to True to hardlink files materialized from another copy before trying a reflink or
+            a copy. Please see download_file_handles(). Default False.
+        :return: an iterator over (DownloadRequest, DownloadResult) pairs, in the order the files land
+        :raises SynapseClientError: please see each error message
+        """
+        channel = self._transfer_scheduler.channel(priority)
+        max_threads = DEFAULT_TRANSFER_MAX_THREADS if use_multiple_threads else 1
+        for index, result in _iter_download_file_handles(self,
+                                                         download_requests,
+                                                         cache=self._cache,
+                                                         max_threads=max_threads,
+                                                         channel=channel,
+                                                         progress=progress,
+                                                         zip_small_files=zip_small_files,
+                                                         hardlink_files=hardlink_files):
+            yield download_requests[index], result
+
+    def sync_from_synapse(self,
+                          remote_files: typing.Iterable[RemoteFile],
+                          local_dir: str,
+                          *,
+                          use_multiple_threads: bool = True,
+                          priority: str = TRANSFER_PRIORITY_BULK,
+                          progress: TransferProgress = None
+                          ) -> SyncResult:
+        """
+        Mirrors a Synapse container to a local directory
+
+        The local tree is scanned in parallel and each remote file is compared with the local file at the same
+        relative path: by size first, then by the cache, then by MD5. Only the files that are missing or differ are
+        downloaded. Local files that are not in the manifest are reported as extraneous and left untouched.
+
+        :param remote_files: the manifest of the container, one RemoteFile per file
+        :param local_dir: the local directory to mirror the container to
+        :param use_multiple_threads: set to False to use single thread. Default True.
+        :param priority: the priority class of the transfers in the transfer scheduler shared by the process, one of
+            TRANSFER_PRIORITIES. Default TRANSFER_PRIORITY_BULK.
+        :param progress: the TransferProgress to report the downloads to. Default None, not reported.
+        :return: the SyncResult
+        :raises SynapseClientError: please see each error message
+        """
+        validate_type(str, local_dir, "local_dir")
+
+        max_threads = DEFAULT_TRANSFER_MAX_THREADS if use_multiple_threads else 1
+        return _sync_from_synapse(self,
+                                  remote_files,
+                                  local_dir,
+                                  max_threads=max_threads,
+                                  priority=priority,
+                                  progress=progress)
+
+    def sync_to_synapse(self,
+                        local_dir: str,
+                        remote_files: typing.Iterable[RemoteFile] = (),
+                        *,
+                        storage_location_id: int = SYNAPSE_DEFAULT_STORAGE_LOCATION_ID,
+                        use_multiple_threads: bool = True,
+                        priority: str = TRANSFER_PRIORITY_BULK,
+                        progress: TransferProgress = None
+                        ) -> SyncResult:
+        """
+        Mirrors a local directory to a Synapse container
+
+        The local tree is scanned in parallel and each local file is compared with the remote file at the same
+        relative path: by size first, then by the cache, then by MD5. Only the files that are missing or differ are
+        uploaded, and each uploaded file is registered in the cache under its new file handle. Remote files that do
+        not exist locally are reported as extraneous.
+
+        This creates the File Handles only; attaching them to entities of the container is up to the caller.
+
+        :param local_dir: the local directory to mirror to the container
+        :param remote_files: the manifest of the container, one RemoteFile per file. Default empty, upload all.
+        :param storage_location_id: the ID of the Storage Location to upload to.
+            Default SYNAPSE_DEFAULT_STORAGE_LOCATION_ID
+        :param use_multiple_threads: set to False to use single thread. Default True.
+        :param priority: the priority class of the transfers in the transfer scheduler shared by the process, one of
+            TRANSFER_PRIORITIES. Default TRANSFER_PRIORITY_BULK.
+        :param progress: the TransferProgress to report the uploads to. Default None, not reported.
+        :return: the SyncResult, with the File Handle created for each transferred path
+        :raises SynapseClientError: please see each error message
+        """
+        validate_type(str, local_dir, "local_dir")
+        if not os.path.isdir(local_dir):
+            raise ValueError("Can't find directory \"%s\"" % local_dir)
+
+        max_threads = DEFAULT_TRANSFER_MAX_THREADS if use_multiple_threads else 1
+        return _sync_to_synapse(self,
+                                local_dir,
+                                remote_files,
+                                max_threads=max_threads,
+                                storage_location_id=storage_location_id,
+                                use_multiple_threads=use_multiple_threads,
+                                priority=priority,
+                                progress=progress)
 
 
 def get_base_client(*,
@@ -230,7 +579,11 @@ def get_base_client(*,
                     auth_endpoint: str = SYNAPSE_DEFAULT_AUTH_ENDPOINT,
                     file_endpoint: str = SYNAPSE_DEFAULT_FILE_ENDPOINT,
                     username: str = None,
-                    api_key: str = None
+                    api_key: str = None,
+                    cache_root_dir: str = SYNAPSE_DEFAULT_CACHE_ROOT_DIR,
+                    use_cache_index: bool = False,
+                    cache_max_bytes: int = None,
+                    cache_dedupe: bool = False
                     ) -> SynapseBaseClient:
     """
     Get the base Synapse client.
@@ -242,6 +595,12 @@ def get_base_client(*,
     :param file_endpoint: the Synapse server file endpoint
     :param username: the Synapse username
     :param api_key: the Synapse API key
+    :param cache_root_dir: the root directory of the Synapse cache used by downloads
+    :param use_cache_index: Set to True to look up and purge the cache through an SQLite index. Default False.
+    :param cache_max_bytes: the size the files downloaded into the cache are kept within by evicting the least
+        recently used ones. Default None, unbounded.
+    :param cache_dedupe: Set to True to hardlink each downloaded file to a cached file with the same content.
+        Default False.
     :return: a Synapse connection
     :raises TypeError: when one or more parameters are not in their expected type
     """
@@ -249,7 +608,11 @@ def get_base_client(*,
                              auth_endpoint=auth_endpoint,
                              file_endpoint=file_endpoint,
                              username=username,
-                             api_key=api_key)
+                             api_key=api_key,
+                             cache_root_dir=cache_root_dir,
+                             use_cache_index=use_cache_index,
+                             cache_max_bytes=cache_max_bytes,
+                             cache_dedupe=cache_dedupe)
 
 
 # Helper functions
@@ -30,3 +30,62 @@ SYNAPSE_DEFAULT_STORAGE_LOCATION_ID = 1
 SYNAPSE_DEFAULT_CACHE_ROOT_DIR = os.path.expanduser(os.path.join('~', '.synapseCache'))
 SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME = ".cacheMap"
 SYNAPSE_DEFAULT_CACHE_BUCKET_SIZE = 1000
+# the nanosecond modified times and sizes of the entries of the cache map, which R clients do not read
+CACHE_MAP_V2_FILE_NAME = '.cacheMap.v2'
+# the optional SQLite index of the cache maps, which clients that do not use it ignore
+CACHE_INDEX_FILE_NAME = '.cacheIndex.sqlite'
+CACHE_MAX_PARSED_CACHE_MAPS = 1024
+CACHE_PURGE_MAX_THREADS = 8
+CACHE_BATCH_MAX_THREADS = 8
+CACHE_MAP_TEMP_FILE_SUFFIX = '.tmp'
+# the number of least recently used entries read from the index at a time when evicting
+CACHE_EVICTION_BATCH_SIZE = 100
+# records where a purge stopped by its budget resumes
+CACHE_PURGE_CHECKPOINT_FILE_NAME = '.purgeCheckpoint'
+
+SYNAPSE_FILE_HANDLE_BATCH_MAX_SIZE = 100
+SYNAPSE_MULTIPART_MIN_PART_SIZE_BYTES = 5 * 1024 * 1024
+SYNAPSE_MULTIPART_MAX_NUMBER_OF_PARTS = 10000
+SYNAPSE_BULK_DOWNLOAD_REQUEST_TYPE = 'org.sagebionetworks.repo.model.file.BulkFileDownloadRequest'
+# zip entries named {file handle ID % 1000}/{file handle ID}/{file name}, unique per file handle
+SYNAPSE_BULK_DOWNLOAD_ZIP_FILE_FORMAT = 'CommandLineCache'
+SYNAPSE_BULK_DOWNLOAD_MAX_PACKAGE_SIZE_BYTES = 1024 * 1024 * 1024
+SYNAPSE_ASYNC_JOB_POLL_INTERVAL_SEC = 1
+SYNAPSE_ASYNC_JOB_MAX_POLL_INTERVAL_SEC = 10
+SYNAPSE_ASYNC_JOB_TIMEOUT_SEC = 600
+
+
+# Transfer constants
+
+DEFAULT_TRANSFER_MAX_THREADS = 8
+DEFAULT_TRANSFER_MAX_IN_FLIGHT_PARTS = 32
+TRANSFER_PRIORITY_INTERACTIVE = 'interactive'
+TRANSFER_PRIORITY_BULK = 'bulk'
+# from the highest to the lowest priority
+TRANSFER_PRIORITIES = (TRANSFER_PRIORITY_INTERACTIVE, TRANSFER_PRIORITY_BULK)
+PROGRESS_DEFAULT_INTERVAL_SEC = 1
+DOWNLOAD_CHUNK_SIZE_BYTES = 1024 * 1024
+DOWNLOAD_TEMP_FILE_SUFFIX = '.synapse_download'
+DOWNLOAD_MAX_ATTEMPTS = 3
+DOWNLOAD_RETRY_BACKOFF_SEC = 1
+# the space downloads leave free on each destination file system
+DOWNLOAD_MIN_FREE_DISK_SPACE_BYTES = 100 * 1024 * 1024
+# files up to this size are packaged in a server-side zip when a window holds enough of them
+DOWNLOAD_ZIP_PACKAGE_MAX_FILE_SIZE_BYTES = 1024 * 1024
+DOWNLOAD_ZIP_PACKAGE_MIN_FILES = 10
+UPLOAD_DEFAULT_PART_SIZE_BYTES = 8 * 1024 * 1024
+UPLOAD_DEFAULT_MAX_BUFFERED_PARTS = 2 * DEFAULT_TRANSFER_MAX_THREADS
+UPLOAD_MAX_ATTEMPTS = 3
+UPLOAD_RETRY_BACKOFF_SEC = 1
+UPLOAD_MAX_THREADS = 16
+UPLOAD_TARGET_NUMBER_OF_PARTS = 1000
+UPLOAD_MAX_AUTOTUNED_PART_SIZE_BYTES = 64 * 1024 * 1024
+UPLOAD_MAX_BUFFERED_BYTES = 1024 * 1024 * 1024
+# files up to this size are uploaded as a single part read in one go
+UPLOAD_SINGLE_PART_MAX_SIZE_BYTES = UPLOAD_DEFAULT_PART_SIZE_BYTES
+UPLOAD_DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+# the directory under the cache root that holds the state of unfinished multipart uploads
+UPLOAD_STATE_DIR_NAME = '.uploads'
+HASHING_MAX_THREADS = os.cpu_count() or 1
+HASHING_MAX_REMEMBERED_FILES = 10000
+HASHING_CHUNK_SIZE_BYTES = 1024 * 1024
@@ -1,6 +1,49 @@
+import array
+import collections
+import collections.abc
+import concurrent.futures
+import csv
+import hashlib
+import os
+import time
+import typing
+import zipfile
+
+import requests
+
+from .constants import *
+from .exceptions import *
+from .internal.cache import Cache
+from .internal.contextutils import _null_context
+from .internal.dozer import doze
+from .internal.lock import LockException
+from .internal.pathutils import get_free_disk_space, materialize_file, normalize_path, preallocate_file, \
+    remove_if_exists
+from .internal.scheduler import TransferChannel
+from .internal.urlcache import PresignedUrlCache, PresignedUrlKey
+from .internal.zipstream import iter_zip_members
+from .progress import TransferProgress
+
+DOWNLOAD_STATUS_DOWNLOADED = "DOWNLOADED"
+DOWNLOAD_STATUS_FROM_CACHE = "FROM_CACHE"
+DOWNLOAD_STATUS_UP_TO_DATE = "UP_TO_DATE"
+DOWNLOAD_STATUS_FAILED = "FAILED"
+
+DOWNLOAD_DISK_SPACE_CHECK_FAIL = "FAIL"
+DOWNLOAD_DISK_SPACE_CHECK_TRIM = "TRIM"
+
+DOWNLOAD_REQUEST_MANIFEST_COLUMNS = ('file_handle_id', 'object_id', 'object_type', 'path')
+DOWNLOAD_RESULT_MANIFEST_COLUMNS = DOWNLOAD_REQUEST_MANIFEST_COLUMNS + ('status', 'error')
+
+FAILURE_CODE_ERRORS = {
+    'NOT_FOUND': SynapseNotFoundError,
+    'UNAUTHORIZED': SynapseUnauthorizedError,
+}
+
+
 class DownloadRequest:
     """
-    A request to download a file from Synapse
+    A request to download a file from Synapse. Requests are immutable and compare equal when all attributes are equal.
 
     ...
 
@@ -17,6 +60,8 @@ class DownloadRequest:
         This path can be either absolute path or relative path from where the code is executed to the download location.
     """
 
+    __slots__ = ('file_handle_id', 'object_id', 'object_type', 'path')
+
     def __init__(self, file_handle_id: int, object_id: str, object_type: str, path: str):
         """
 
@@ -26,19 +71,1137 @@ class DownloadRequest:
         :param path:
         """
 
-        self.file_handle_id = file_handle_id
-        self.object_id = object_id
-        self.object_type = object_type
-        self.path = path
+        object.__setattr__(self, 'file_handle_id', file_handle_id)
+        object.__setattr__(self, 'object_id', object_id)
+        object.__setattr__(self, 'object_type', object_type)
+        object.__setattr__(self, 'path', path)
+
+    def _key(self) -> tuple:
+        return self.file_handle_id, self.object_id, self.object_type, self.path
+
+    def __setattr__(self, name, value):
+        raise AttributeError("DownloadRequest is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("DownloadRequest is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, DownloadRequest):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return "DownloadRequest(file_handle_id={!r}, object_id={!r}, object_type={!r}, path={!r})".format(*self._key())
 
 
 class DownloadResult:
     """
-    A download result
+    A download result. Results are immutable and compare equal when all attributes are equal.
 
     ...
 
     Attributes
     ----------
+    path : str
+        The local path of the file.
+    status : str
+        DOWNLOAD_STATUS_DOWNLOADED when the file was transferred from Synapse,
+        DOWNLOAD_STATUS_FROM_CACHE when the file was materialized from a copy in the cache,
+        DOWNLOAD_STATUS_UP_TO_DATE when the path already was an unmodified cached copy,
+        DOWNLOAD_STATUS_FAILED otherwise.
+    error : Exception
+        The reason the download failed. None when the download succeeded.
+    """
+
+    __slots__ = ('path', 'status', 'error')
+
+    def __init__(self, path: str, status: str, *, error: Exception = None):
+        """
+
+        :param path:
+        :param status:
+        :param error:
+        """
+
+        object.__setattr__(self, 'path', path)
+        object.__setattr__(self, 'status', status)
+        object.__setattr__(self, 'error', error)
+
+    def _key(self) -> tuple:
+        return self.path, self.status, self.error
+
+    def __setattr__(self, name, value):
+        raise AttributeError("DownloadResult is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("DownloadResult is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, DownloadResult):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return "DownloadResult(path={!r}, status={!r}, error={!r})".format(*self._key())
+
+
+class DownloadRequestBatch(collections.abc.Sequence):
+    """
+    A compact, columnar sequence of DownloadRequests for very large batches.
+
+    Instead of keeping one object per request, each attribute is stored in its own column: file handle IDs in an
+    array of 64-bit integers, object types as codes into a small table of distinct values, and object IDs and paths
+    back to back in UTF-8 buffers. DownloadRequest objects are created on access.
+
+    A batch can be passed to SynapseBaseClient.download_file_handles in place of a list of DownloadRequests.
+    """
+
+    def __init__(self, download_requests: typing.Iterable[DownloadRequest] = ()):
+        """
+
+        :param download_requests: the requests to add to the batch
+        """
+        self._file_handle_ids = array.array('q')
+        self._object_ids = _StringColumn()
+        self._object_types = _CategoricalColumn()
+        self._paths = _StringColumn()
+        self.extend(download_requests)
+
+    def append(self, download_request: DownloadRequest) -> None:
+        """
+        Add a request at the end of the batch
+
+        :param download_request: the request to add
+        :raises TypeError: when download_request is not a DownloadRequest
+        """
+        if not isinstance(download_request, DownloadRequest):
+            raise TypeError('download_request must be of type {}.'.format(DownloadRequest))
+        self._file_handle_ids.append(download_request.file_handle_id)
+        self._object_ids.append(download_request.object_id)
+        self._object_types.append(download_request.object_type)
+        self._paths.append(download_request.path)
+
+    def extend(self, download_requests: typing.Iterable[DownloadRequest]) -> None:
+        """
+        Add requests at the end of the batch
+
+        :param download_requests: the requests to add
+        """
+        for download_request in download_requests:
+            self.append(download_request)
+
+    def __len__(self):
+        return len(self._file_handle_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return DownloadRequestBatch(self[i] for i in range(*index.indices(len(self))))
+        return DownloadRequest(self._file_handle_ids[index],
+                               self._object_ids[index],
+                               self._object_types[index],
+                               self._paths[index])
+
+    @classmethod
+    def from_csv(cls, manifest_path: str, *, delimiter: str = ',') -> 'DownloadRequestBatch':
+        """
+        Build a batch from a CSV manifest with the columns file_handle_id, object_id, object_type and path.
+        Use delimiter='\\t' to read a TSV manifest.
+
+        :param manifest_path: the path to the manifest
+        :param delimiter: the column delimiter. Default ','
+        :return: the batch
+        :raises ValueError: when the manifest misses a required column
+        """
+        batch = cls()
+        for row in _read_manifest(manifest_path, delimiter, DOWNLOAD_REQUEST_MANIFEST_COLUMNS):
+            batch.append(_request_from_row(row))
+        return batch
+
+    def to_csv(self, manifest_path: str, *, delimiter: str = ',') -> None:
+        """
+        Write the batch to a CSV manifest. Use delimiter='\\t' to write a TSV manifest.
+
+        :param manifest_path: the path to the manifest
+        :param delimiter: the column delimiter. Default ','
+        """
+        _write_manifest(manifest_path, delimiter, DOWNLOAD_REQUEST_MANIFEST_COLUMNS,
+                        (_request_to_row(request) for request in self))
+
+
+class DownloadResultBatch(collections.abc.Mapping):
+    """
+    A compact, columnar mapping between the DownloadRequests of a DownloadRequestBatch and their DownloadResults.
+
+    Statuses are stored as one byte per request and errors only for the requests that failed.
+    Iterating the batch yields the requests in the order of the request batch. Looking up a result by request builds
+    an index of the requests on first use; use results() to walk the batch without paying for the index.
+    """
+
+    def __init__(self, download_requests: DownloadRequestBatch):
+        """
+
+        :param download_requests: the requests these results belong to
+        """
+        self._requests = download_requests
+        self._statuses = _CategoricalColumn(len(download_requests))
+        self._errors = {}
+        self._count = 0
+        self._index = None
+
+    def set_result(self, index: int, download_result: DownloadResult) -> None:
+        """
+        Record the result of the request at the given position of the request batch
+
+        :param index: the position of the request
+        :param download_result: the result
+        """
+        if self._statuses[index] is None:
+            self._count += 1
+        self._statuses[index] = download_result.status
+        if download_result.error is not None:
+            self._errors[index] = download_result.error
+        else:
+            self._errors.pop(index, None)
+
+    def result(self, index: int) -> DownloadResult:
+        """
+        :param index: the position of the request in the request batch
+        :return: the result of the request at the given position
+        """
+        return DownloadResult(self._requests._paths[index], self._statuses[index], error=self._errors.get(index))
+
+    def results(self) -> typing.Iterator[typing.Tuple[DownloadRequest, DownloadResult]]:
+        """
+        :return: an iterator over the recorded (request, result) pairs in the order of the request batch
+        """
+        for index in self._recorded_indices():
+            yield self._requests[index], self.result(index)
+
+    def _recorded_indices(self) -> typing.Iterator[int]:
+        return (index for index in range(len(self._statuses)) if self._statuses[index] is not None)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for index in self._recorded_indices():
+            yield self._requests[index]
+
+    def __getitem__(self, download_request):
+        if self._index is None:
+            self._index = {self._requests[index]: index for index in range(len(self._requests))}
+        index = self._index[download_request]
+        if self._statuses[index] is None:
+            raise KeyError(download_request)
+        return self.result(index)
+
+    @classmethod
+    def from_csv(cls, manifest_path: str, *, delimiter: str = ',') -> 'DownloadResultBatch':
+        """
+        Build a batch from a CSV manifest written by to_csv(). Use delimiter='\\t' to read a TSV manifest.
+        Errors are restored as SynapseClientErrors holding the recorded message.
+
+        :param manifest_path: the path to the manifest
+        :param delimiter: the column delimiter. Default ','
+        :return: the batch
+        :raises ValueError: when the manifest misses a required column
+        """
+        download_requests = DownloadRequestBatch()
+        statuses = _CategoricalColumn()
+        errors = {}
+        for index, row in enumerate(_read_manifest(manifest_path, delimiter, DOWNLOAD_RESULT_MANIFEST_COLUMNS)):
+            download_requests.append(_request_from_row(row))
+            statuses.append(row['status'] or None)
+            if row['error']:
+                errors[index] = SynapseClientError(message=row['error'])
+        batch = cls(download_requests)
+        for index in range(len(statuses)):
+            if statuses[index] is not None:
+                batch.set_result(index, DownloadResult(download_requests._paths[index],
+                                                       statuses[index],
+                                                       error=errors.get(index)))
+        return batch
+
+    def to_csv(self, manifest_path: str, *, delimiter: str = ',') -> None:
+        """
+        Write the requests and their results to a CSV manifest. Use delimiter='\\t' to write a TSV manifest.
+
+        :param manifest_path: the path to the manifest
+        :param delimiter: the column delimiter. Default ','
+        """
+        _write_manifest(manifest_path, delimiter, DOWNLOAD_RESULT_MANIFEST_COLUMNS,
+                        (_result_to_row(request, result) for request, result in self.results()))
+
+
+class _CategoricalColumn:
+    """A column of a few distinct values, stored as one byte per row. Rows hold None until they are set."""
+
+    def __init__(self, length: int = 0):
+        self._codes = array.array('B', bytes(length))
+        self._values = [None]
+        self._code_by_value = {None: 0}
+
+    def _code(self, value) -> int:
+        code = self._code_by_value.get(value)
+        if code is None:
+            code = len(self._values)
+            if code > 255:
+                raise ValueError("too many distinct values in a categorical column")
+            self._values.append(value)
+            self._code_by_value[value] = code
+        return code
+
+    def append(self, value) -> None:
+        self._codes.append(self._code(value))
+
+    def __setitem__(self, index: int, value) -> None:
+        self._codes[index] = self._code(value)
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __getitem__(self, index: int):
+        return self._values[self._codes[index]]
+
+
+class _StringColumn:
+    """A column of strings, stored back to back as UTF-8 in a single buffer with the end offset of each row"""
+
+    def __init__(self):
+        self._data = bytearray()
+        self._ends = array.array('q')
+
+    def append(self, value: str) -> None:
+        self._data += value.encode('utf-8', 'surrogateescape')
+        self._ends.append(len(self._data))
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, index: int) -> str:
+        index = range(len(self._ends))[index]
+        start = self._ends[index - 1] if index else 0
+        return self._data[start:self._ends[index]].decode('utf-8', 'surrogateescape')
+
+
+# Helper functions
+# These methods are not designed to be used outside of this package.
+
 
+def _download_file_handles(client,
+                           download_requests: typing.Sequence[DownloadRequest],
+                           *,
+                           cache: Cache,
+                           max_threads: int,
+                           channel: TransferChannel = None,
+                           progress: TransferProgress = None,
+                           disk_space_check: str = None,
+                           zip_small_files: bool = False,
+                           hardlink_files: bool = False
+                           ) -> typing.Union[typing.List[DownloadResult], DownloadResultBatch]:
     """
+    Download a batch of files and collect the results. The results of a DownloadRequestBatch are written into a
+    DownloadResultBatch as they arrive, so no DownloadResult is kept per request.
+
+    With a disk space check, the sizes of the files to transfer are summed per destination file system before any
+    transfer starts. When they do not fit, DOWNLOAD_DISK_SPACE_CHECK_FAIL fails the whole batch, and
+    DOWNLOAD_DISK_SPACE_CHECK_TRIM fails the requests that do not fit and downloads the others.
+
+    :param client: the SynapseBaseClient used to talk to Synapse
+    :param download_requests: the list of download requests
+    :param cache: the cache to consult and to register downloaded files in
+    :param max_threads: the max number of files processed at the same time
+    :param channel: the channel of the transfer scheduler to submit the transfers to. Default None, unscheduled.
+    :param progress: the progress to report the transfers to. Default None, not reported.
+    :param disk_space_check: DOWNLOAD_DISK_SPACE_CHECK_FAIL, DOWNLOAD_DISK_SPACE_CHECK_TRIM, or None to skip the
+        check. Default None.
+    :param zip_small_files: set to True to transfer batches of small files as server-side zip packages. Default False.
+    :param hardlink_files: set to True to hardlink files materialized from another copy instead of reflinking or
+        copying them. Default False.
+    :return: the results, in the order of download_requests, as a DownloadResultBatch when download_requests is a
+        DownloadRequestBatch
+    :raises SynapseInsufficientDiskSpaceError: when the files do not fit and disk_space_check is
+        DOWNLOAD_DISK_SPACE_CHECK_FAIL
+    """
+    is_batch = isinstance(download_requests, DownloadRequestBatch)
+    if is_batch:
+        results = DownloadResultBatch(download_requests)
+        set_result = results.set_result
+    else:
+        results = [None] * len(download_requests)
+        set_result = results.__setitem__
+    positions = range(len(download_requests))
+    if disk_space_check is not None:
+        trimmed = _check_disk_space(client,
+                                    download_requests,
+                                    cache=cache,
+                                    max_threads=max_threads,
+                                    trim=disk_space_check == DOWNLOAD_DISK_SPACE_CHECK_TRIM)
+        if trimmed:
+            for index, error in trimmed.items():
+                set_result(index, DownloadResult(download_requests[index].path, DOWNLOAD_STATUS_FAILED, error=error))
+            positions = array.array('q', (index for index in positions if index not in trimmed))
+            remaining = (download_requests[index] for index in positions)
+            download_requests = DownloadRequestBatch(remaining) if is_batch else list(remaining)
+    for index, result in _iter_download_file_handles(client, download_requests, cache=cache, max_threads=max_threads,
+                                                     channel=channel, progress=progress,
+                                                     zip_small_files=zip_small_files, hardlink_files=hardlink_files):
+        set_result(positions[index], result)
+    return results
+
+
+def _check_disk_space(client,
+                      download_requests: typing.Sequence[DownloadRequest],
+                      *,
+                      cache: Cache,
+                      max_threads: int,
+                      trim: bool
+                      ) -> typing.Dict[int, SynapseInsufficientDiskSpaceError]:
+    """
+    Sum the sizes of the files to transfer per destination file system and compare them with the space left, keeping
+    DOWNLOAD_MIN_FREE_DISK_SPACE_BYTES free. Files with an unmodified copy in the cache are not counted, and a file
+    handle is only counted once per file system. The sizes come from the file handles alone: presigned URLs expire,
+    so they are only requested for the files about to be transferred.
+
+    :param client: the SynapseBaseClient used to talk to Synapse
+    :param download_requests: the download requests
+    :param cache: the cache to consult
+    :param max_threads: the max number of cache lookups at the same time
+    :param trim: set to True to fail the requests that do not fit, in order, instead of the whole batch
+    :return: a map between the position of each trimmed request and its error
+    :raises SynapseInsufficientDiskSpaceError: when the files do not fit and trim is False
+    """
+    cached = [bool(paths) for paths in cache.lookup_many((download_request.file_handle_id
+                                                          for download_request in download_requests),
+                                                         max_threads=max_threads)]
+    # file handle ID -> the key its size is requested with
+    keys = collections.OrderedDict()
+    for download_request, is_cached in zip(download_requests, cached):
+        if not is_cached:
+            keys.setdefault(download_request.file_handle_id, _url_key(download_request))
+    keys = list(keys.values())
+    sizes = {}
+    for start in range(0, len(keys), SYNAPSE_FILE_HANDLE_BATCH_MAX_SIZE):
+        file_results = _get_file_handle_batch(client, keys[start:start + SYNAPSE_FILE_HANDLE_BATCH_MAX_SIZE],
+                                              include_presigned_urls=False)
+        sizes.update((key[0], file_result.get('fileHandle', {}).get('contentSize') or 0)
+                     for key, file_result in file_results.items())
+
+    # the file system of each destination directory, and the space left on and a directory of each file system
+    devices = {}
+    free_space = {}
+    directories = {}
+    required = collections.defaultdict(int)
+    counted = set()
+    trimmed = {}
+    for index, (download_request, is_cached) in enumerate(zip(download_requests, cached)):
+        if is_cached:
+            continue
+        directory = os.path.dirname(os.path.abspath(download_request.path))
+        if directory not in devices:
+            device, free = get_free_disk_space(directory)
+            devices[directory] = device
+            free_space.setdefault(device, free - DOWNLOAD_MIN_FREE_DISK_SPACE_BYTES)
+            directories.setdefault(device, directory)
+        device = devices[directory]
+        if (device, download_request.file_handle_id) in counted:
+            continue
+        size = sizes.get(download_request.file_handle_id, 0)
+        if trim and required[device] + size > free_space[device]:
+            trimmed[index] = SynapseInsufficientDiskSpaceError(
+                message="Not enough space left for {} ({} bytes)".format(download_request.path, size))
+            continue
+        required[device] += size
+        counted.add((device, download_request.file_handle_id))
+
+    short = ["{} more bytes on the file system of {}".format(required[device] - free_space[device], directory)
+             for device, directory in directories.items() if required[device] > free_space[device]]
+    if short:
+        raise SynapseInsufficientDiskSpaceError(message="Not enough disk space for the downloads: need " +
+                                                ", ".join(short))
+    return trimmed
+
+
+def _iter_download_file_handles(client,
+                                download_requests: typing.Sequence[DownloadRequest],
+                                *,
+                                cache: Cache,
+                                max_threads: int,
+                                channel: TransferChannel = None,
+                                progress: TransferProgress = None,
+                                zip_small_files: bool = False,
+                                hardlink_files: bool = False
+                                ) -> typing.Iterator[typing.Tuple[int, DownloadResult]]:
+    """
+    Download a batch of files, materializing them from the cache whenever an unmodified copy is available.
+
+    The requests are processed in windows of SYNAPSE_FILE_HANDLE_BATCH_MAX_SIZE, so the work in flight stays bounded
+    however large the batch is. Identical file handles within a window are transferred once; identical file handles
+    in later windows are materialized from the cache the earlier transfer registered them in.
+
+    With zip_small_files, a window holding at least DOWNLOAD_ZIP_PACKAGE_MIN_FILES files of at most
+    DOWNLOAD_ZIP_PACKAGE_MAX_FILE_SIZE_BYTES has them packaged in a zip by Synapse, which is streamed and extracted
+    in a single transfer. Files Synapse could not package are transferred one by one.
+
+    :param client: the SynapseBaseClient used to talk to Synapse
+    :param download_requests: the list of download requests
+    :param cache: the cache to consult and to register downloaded files in
+    :param max_threads: the max number of files processed at the same time
+    :param channel: the channel of the transfer scheduler to submit the transfers to. Default None, unscheduled.
+    :param progress: the progress to report the transfers to. Default None, not reported.
+    :param zip_small_files: set to True to transfer batches of small files as server-side zip packages. Default False.
+    :param hardlink_files: set to True to hardlink files materialized from another copy instead of reflinking or
+        copying them. Default False.
+    :return: an iterator over (position of the request, result) pairs, in the order the files land
+    """
+    def submit_group(group):
+        return executor.submit(_download_group,
+                               client._requests_session,
+                               cache,
+                               client._presigned_url_cache,
+                               [download_requests[index] for index in group],
+                               channel=channel,
+                               progress=progress,
+                               hardlink=hardlink_files)
+
+    if progress is not None:
+        progress.expect_files(len(download_requests))
+    with progress if progress is not None else _null_context(), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+        for start in range(0, len(download_requests), SYNAPSE_FILE_HANDLE_BATCH_MAX_SIZE):
+            window = range(start, min(start + SYNAPSE_FILE_HANDLE_BATCH_MAX_SIZE, len(download_requests)))
+
+            cache_futures = {executor.submit(_download_from_cache, cache, download_requests[index],
+                                             hardlink=hardlink_files): index
+                             for index in window}
+            to_transfer = []
+            for future in concurrent.futures.as_completed(cache_futures):
+                result = future.result()
+                if result is None:
+                    to_transfer.append(cache_futures[future])
+                else:
+                    if progress is not None:
+                        progress.add_files()
+                    yield cache_futures[future], result
+            if not to_transfer:
+                continue
+
+            # identical file handles are transferred once and fanned out to every requested path locally
+            groups = _group_by_file_handle_id(download_requests, sorted(to_transfer))
+            # presigned URLs expire, so only request them for the files we are about to download
+            client._presigned_url_cache.prefetch(_url_key(download_requests[group[0]]) for group in groups)
+            # a future maps to the groups it transfers and whether it is a zip package, which returns a list of
+            # results, or None when the group was not delivered, per group
+            transfer_futures = {}
+            if zip_small_files:
+                packaged = _select_zip_package(client._presigned_url_cache, download_requests, groups)
+                if packaged:
+                    transfer_futures[executor.submit(_download_zip_package,
+                                                     client,
+                                                     cache,
+                                                     download_requests,
+                                                     packaged,
+                                                     channel=channel,
+                                                     progress=progress,
+                                                     hardlink=hardlink_files)] = (packaged, True)
+                    packaged_ids = {download_requests[group[0]].file_handle_id for group in packaged}
+                    groups = [group for group in groups
+                              if download_requests[group[0]].file_handle_id not in packaged_ids]
+            for group in groups:
+                transfer_futures[submit_group(group)] = ([group], False)
+            while transfer_futures:
+                # the groups a zip package did not deliver are transferred one by one
+                unpackaged = []
+                for future in concurrent.futures.as_completed(transfer_futures):
+                    future_groups, is_package = transfer_futures[future]
+                    future_results = future.result() if is_package else [future.result()]
+                    for group, results in zip(future_groups, future_results):
+                        if results is None:
+                            unpackaged.append(group)
+                            continue
+                        # the URL of a completed download is neither held nor refreshed any more
+                        client._presigned_url_cache.release([_url_key(download_requests[group[0]])])
+                        for index, result in zip(group, results):
+                            if progress is not None:
+                                progress.add_files()
+                            yield index, result
+                transfer_futures = {submit_group(group): ([group], False) for group in unpackaged}
+
+
+def _group_by_file_handle_id(download_requests: typing.Sequence[DownloadRequest],
+                             indices: typing.Iterable[int]
+                             ) -> typing.List[typing.List[int]]:
+    """
+    Group the positions of download requests that ask for the same file handle, preserving the order of first
+    appearance
+
+    :param download_requests: the download requests
+    :param indices: the positions of the requests to group
+    :return: a list of groups, each group holds the positions of the requests for one file handle ID
+    """
+    groups = collections.OrderedDict()
+    for index in indices:
+        groups.setdefault(download_requests[index].file_handle_id, []).append(index)
+    return list(groups.values())
+
+
+def _download_group(session: requests.Session,
+                    cache: Cache,
+                    url_cache: PresignedUrlCache,
+                    download_requests: typing.Sequence[DownloadRequest],
+                    *,
+                    channel: TransferChannel = None,
+                    progress: TransferProgress = None,
+                    hardlink: bool = False
+                    ) -> typing.List[DownloadResult]:
+    """
+    Transfer a file handle once for the first request of the group and materialize it for the other requests
+
+    :param session: the session used to perform the HTTP requests
+    :param cache: the cache to register the files in
+    :param url_cache: the cache of presigned URLs
+    :param download_requests: the requests for the same file handle
+    :param channel: the channel of the transfer scheduler to submit the transfer to. Default None, unscheduled.
+    :param progress: the progress to report the transfer to. Default None, not reported.
+    :param hardlink: set to True to hardlink the materialized copies. Default False.
+    :return: the results, in the order of download_requests
+    """
+    primary_result = _download_from_synapse(session, cache, url_cache, download_requests[0], channel=channel,
+                                            progress=progress, hardlink=hardlink)
+    return _fan_out(cache, download_requests, primary_result, hardlink=hardlink)
+
+
+def _fan_out(cache: Cache,
+             download_requests: typing.Sequence[DownloadRequest],
+             primary_result: DownloadResult,
+             *,
+             hardlink: bool = False
+             ) -> typing.List[DownloadResult]:
+    """
+    Materialize the file transferred for the first request of a group for the other requests of the group
+
+    :param cache: the cache to register the files in
+    :param download_requests: the requests for the same file handle
+    :param primary_result: the result of the first request
+    :param hardlink: set to True to hardlink the materialized copies. Default False.
+    :return: the results, in the order of download_requests
+    """
+    primary = download_requests[0]
+    results = [primary_result]
+    # position in results -> request, for the copies to register together
+    materialized = {}
+    for request in download_requests[1:]:
+        if primary_result.status == DOWNLOAD_STATUS_FAILED or \
+                normalize_path(request.path) == normalize_path(primary.path):
+            results.append(DownloadResult(request.path, primary_result.status, error=primary_result.error))
+            continue
+        try:
+            materialize_file(primary.path, request.path, hardlink=hardlink)
+            materialized[len(results)] = request
+            results.append(DownloadResult(request.path, DOWNLOAD_STATUS_DOWNLOADED))
+        except OSError as error:
+            results.append(DownloadResult(request.path, DOWNLOAD_STATUS_FAILED, error=error))
+    if materialized:
+        errors = cache.register_many((request.file_handle_id, request.path) for request in materialized.values())
+        for (position, request), error in zip(materialized.items(), errors):
+            if error is not None:
+                results[position] = DownloadResult(request.path, DOWNLOAD_STATUS_FAILED, error=error)
+    return results
+
+
+def _select_zip_package(url_cache: PresignedUrlCache,
+                        download_requests: typing.Sequence[DownloadRequest],
+                        groups: typing.Sequence[typing.List[int]]
+                        ) -> typing.List[typing.List[int]]:
+    """
+    Pick the groups worth packaging in a zip: files of at most DOWNLOAD_ZIP_PACKAGE_MAX_FILE_SIZE_BYTES, up to
+    SYNAPSE_BULK_DOWNLOAD_MAX_PACKAGE_SIZE_BYTES in total, when there are at least DOWNLOAD_ZIP_PACKAGE_MIN_FILES
+
+    :param url_cache: the cache of presigned URLs, holding the file handles of the groups
+    :param download_requests: the download requests
+    :param groups: the positions of the requests for each file handle
+    :return: the groups to package, empty when there are too few
+    """
+    packaged = []
+    package_size = 0
+    for group in groups:
+        file_result = url_cache.get(_url_key(download_requests[group[0]]))
+        if file_result.get('failureCode') is not None:
+            # reported by the regular transfer
+            continue
+        size = file_result.get('fileHandle', {}).get('contentSize')
+        if size is None or size > DOWNLOAD_ZIP_PACKAGE_MAX_FILE_SIZE_BYTES or \
+                package_size + size > SYNAPSE_BULK_DOWNLOAD_MAX_PACKAGE_SIZE_BYTES:
+            continue
+        packaged.append(group)
+        package_size += size
+    return packaged if len(packaged) >= DOWNLOAD_ZIP_PACKAGE_MIN_FILES else []
+
+
+def _download_zip_package(client,
+                          cache: Cache,
+                          download_requests: typing.Sequence[DownloadRequest],
+                          groups: typing.Sequence[typing.List[int]],
+                          *,
+                          channel: TransferChannel = None,
+                          progress: TransferProgress = None,
+                          hardlink: bool = False
+                          ) -> typing.List[typing.Optional[typing.List[DownloadResult]]]:
+    """
+    Have Synapse package the file handles of the groups in a zip, then stream the zip and extract each member straight
+    to the path of the first request of its group. The zip itself is never written to disk.
+
+    A group is not delivered when Synapse could not package its file handle, when its member fails to extract or does
+    not match the MD5 of the file handle, or when the package fails as a whole. The caller transfers those groups on
+    their own.
+
+    :param client: the SynapseBaseClient used to talk to Synapse
+    :param cache: the cache to register the files in
+    :param download_requests: the download requests
+    :param groups: the positions of the requests for each file handle to package
+    :param channel: the channel of the transfer scheduler to submit the transfer to. Default None, unscheduled.
+    :param progress: the progress to report the transfer to. Default None, not reported.
+    :param hardlink: set to True to hardlink the materialized copies. Default False.
+    :return: the results of each group, in the order of groups, or None for the groups that were not delivered
+    """
+    results = [None] * len(groups)
+    primaries = [download_requests[group[0]] for group in groups]
+    positions = {str(primary.file_handle_id): position for position, primary in enumerate(primaries)}
+    request_body = {
+        'concreteType': SYNAPSE_BULK_DOWNLOAD_REQUEST_TYPE,
+        'requestedFiles': [{'fileHandleId': str(primary.file_handle_id),
+                            'associateObjectId': primary.object_id,
+                            'associateObjectType': primary.object_type}
+                           for primary in primaries],
+        'zipFileFormat': SYNAPSE_BULK_DOWNLOAD_ZIP_FILE_FORMAT,
+    }
+    try:
+        response = _get_async_job_response(client, '/file/bulk/async', request_body,
+                                           endpoint=client._default_file_endpoint)
+        positions_by_entry = {summary['zipEntryName']: positions[summary['fileHandleId']]
+                              for summary in response.get('fileSummary', [])
+                              if summary.get('status') == 'SUCCESS' and summary.get('fileHandleId') in positions}
+        if not positions_by_entry:
+            return results
+        url = client.get('/fileHandle/{}/url'.format(response['resultZipFileHandleId']),
+                         request_parameters={'redirect': False},
+                         endpoint=client._default_file_endpoint)
+        with channel.slot() if channel is not None else _null_context(), \
+                client._requests_session.get(url, stream=True) as zip_response:
+            check_storage_status_code_and_raise_error(zip_response)
+            chunks = zip_response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE_BYTES)
+            for name, content in iter_zip_members(_throttle_chunks(chunks, channel)):
+                position = positions_by_entry.get(name)
+                if position is None:
+                    continue
+                file_handle = client._presigned_url_cache.get(_url_key(primaries[position])).get('fileHandle', {})
+                results[position] = _extract_zip_member(cache,
+                                                        [download_requests[index] for index in groups[position]],
+                                                        file_handle,
+                                                        content,
+                                                        progress=progress,
+                                                        hardlink=hardlink)
+    except (SynapseClientError, OSError, LockException, requests.RequestException, zipfile.BadZipFile):
+        # the groups that were not delivered yet are transferred on their own
+        pass
+    return results
+
+
+def _extract_zip_member(cache: Cache,
+                        download_requests: typing.Sequence[DownloadRequest],
+                        file_handle: dict,
+                        content: typing.Iterable[bytes],
+                        *,
+                        progress: TransferProgress = None,
+                        hardlink: bool = False
+                        ) -> typing.Optional[typing.List[DownloadResult]]:
+    """
+    Write the content of a zip member to the path of the first request of a group, verify its CRC-32 and MD5 before
+    moving it into place, register it in the cache and materialize it for the other requests of the group
+
+    :param cache: the cache to register the files in
+    :param download_requests: the requests for the file handle of the member
+    :param file_handle: the file handle of the member
+    :param content: the uncompressed content of the member
+    :param progress: the progress to report the transfer to. Default None, not reported.
+    :param hardlink: set to True to hardlink the materialized copies. Default False.
+    :return: the results, in the order of download_requests, or None when the member could not be extracted or
+        verified
+    """
+    primary = download_requests[0]
+    temp_path = primary.path + DOWNLOAD_TEMP_FILE_SUFFIX
+    expected_size = file_handle.get('contentSize') or 0
+    if progress is not None:
+        progress.expect_bytes(expected_size)
+    written = 0
+    extracted = False
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(primary.path)), exist_ok=True)
+        md5 = hashlib.md5()
+        with open(temp_path, 'wb') as f:
+            # the CRC-32 of the member is checked before its content ends
+            for chunk in content:
+                md5.update(chunk)
+                f.write(chunk)
+                written += len(chunk)
+                if progress is not None:
+                    progress.add_bytes(len(chunk))
+        expected_md5 = file_handle.get('contentMd5')
+        if expected_md5 is not None and md5.hexdigest() != expected_md5:
+            return None
+        os.replace(temp_path, primary.path)
+        extracted = True
+    except (OSError, zipfile.BadZipFile):
+        return None
+    finally:
+        if not extracted:
+            remove_if_exists(temp_path)
+            if progress is not None:
+                # the file is transferred again on its own
+                progress.add_bytes(-written)
+                progress.expect_bytes(-expected_size)
+    try:
+        cache.register(primary.file_handle_id, primary.path, content_md5=expected_md5)
+    except (OSError, LockException) as error:
+        return _fan_out(cache, download_requests, DownloadResult(primary.path, DOWNLOAD_STATUS_FAILED, error=error),
+                        hardlink=hardlink)
+    return _fan_out(cache, download_requests, DownloadResult(primary.path, DOWNLOAD_STATUS_DOWNLOADED),
+                    hardlink=hardlink)
+
+
+def _throttle_chunks(chunks: typing.Iterable[bytes], channel: typing.Optional[TransferChannel]
+                     ) -> typing.Iterator[bytes]:
+    for chunk in chunks:
+        if channel is not None:
+            channel.throttle(len(chunk))
+        yield chunk
+
+
+def _get_async_job_response(client, uri: str, request_body: dict, *, endpoint: str) -> dict:
+    """
+    Start an asynchronous job and wait for its response, polling with an exponential backoff
+
+    :param client: the SynapseBaseClient used to talk to Synapse
+    :param uri: the URI of the job type, without the /start and /get/{token} suffixes
+    :param request_body: the job request
+    :param endpoint: the Synapse server endpoint that serves the job type
+    :return: the job response
+    :raises SynapseClientError: when the job failed or did not complete within SYNAPSE_ASYNC_JOB_TIMEOUT_SEC
+    """
+    token = client.post(uri + '/start', request_body=request_body, endpoint=endpoint)['token']
+    deadline = time.monotonic() + SYNAPSE_ASYNC_JOB_TIMEOUT_SEC
+    interval = SYNAPSE_ASYNC_JOB_POLL_INTERVAL_SEC
+    while True:
+        response = client.get('{}/get/{}'.format(uri, token), endpoint=endpoint)
+        # Synapse answers with the AsynchronousJobStatus while the job runs and with the job response once it is done
+        if 'jobState' not in response:
+            return response
+        if response['jobState'] == 'FAILED':
+            raise SynapseClientError(message="Asynchronous job {} failed: {}".format(token,
+                                                                                     response.get('errorMessage')))
+        if time.monotonic() + interval > deadline:
+            raise SynapseClientError(message="Asynchronous job {} did not complete in {} seconds".format(
+                token, SYNAPSE_ASYNC_JOB_TIMEOUT_SEC))
+        doze(interval)
+        interval = min(2 * interval, SYNAPSE_ASYNC_JOB_MAX_POLL_INTERVAL_SEC)
+
+
+def _url_key(download_request: DownloadRequest) -> PresignedUrlKey:
+    return download_request.file_handle_id, download_request.object_id, download_request.object_type
+
+
+def _get_file_handle_batch(client,
+                           keys: typing.Sequence[PresignedUrlKey],
+                           *,
+                           include_presigned_urls: bool = True
+                           ) -> typing.Dict[PresignedUrlKey, dict]:
+    """
+    Retrieve the file handles and presigned URLs for a batch of (file handle ID, object ID, object type) keys
+
+    :param client: the SynapseBaseClient used to talk to Synapse
+    :param keys: at most SYNAPSE_FILE_HANDLE_BATCH_MAX_SIZE keys
+    :param include_presigned_urls: set to False to only retrieve the file handles. Default True.
+    :return: a map between each key and its FileResult
+    """
+    request_body = {
+        'requestedFiles': [{'fileHandleId': str(file_handle_id),
+                            'associateObjectId': object_id,
+                            'associateObjectType': object_type}
+                           for file_handle_id, object_id, object_type in keys],
+        'includePreSignedURLs': include_presigned_urls,
+        'includeFileHandles': True,
+        'includePreviewPreSignedURLs': False,
+    }
+    response = client.post('/fileHandle/batch', request_body=request_body, endpoint=client._default_file_endpoint)
+    file_results = response.get('requestedFiles', [])
+    if [file_result['fileHandleId'] for file_result in file_results] == [str(key[0]) for key in keys]:
+        return dict(zip(keys, file_results))
+    # fall back to matching on the file handle ID when Synapse did not answer in the order of the request
+    by_file_handle_id = {file_result['fileHandleId']: file_result for file_result in file_results}
+    return {key: by_file_handle_id[str(key[0])] for key in keys if str(key[0]) in by_file_handle_id}
+
+
+def _download_from_cache(cache: Cache,
+                         download_request: DownloadRequest,
+                         *,
+                         hardlink: bool = False
+                         ) -> typing.Optional[DownloadResult]:
+    """
+    Try to satisfy a download request with an unmodified copy from the cache
+
+    :param cache: the cache to consult
+    :param download_request: the download request
+    :param hardlink: set to True to hardlink the cached copy. Default False.
+    :return: the result, or None when the file has to be transferred from Synapse. The result is failed when the
+        lock of the cache could not be obtained.
+    """
+    try:
+        cached_paths = cache.get_all_unmodified_cached_file_paths(download_request.file_handle_id)
+        if normalize_path(download_request.path) in cached_paths:
+            return DownloadResult(download_request.path, DOWNLOAD_STATUS_UP_TO_DATE)
+        for cached_path in cached_paths:
+            try:
+                materialize_file(cached_path, download_request.path, hardlink=hardlink)
+            except OSError:
+                # the cached copy may have been removed since the lookup; try the next one
+                continue
+            cache.register(download_request.file_handle_id, download_request.path)
+            return DownloadResult(download_request.path, DOWNLOAD_STATUS_FROM_CACHE)
+    except LockException as error:
+        return DownloadResult(download_request.path, DOWNLOAD_STATUS_FAILED, error=error)
+    return None
+
+
+def _download_from_content_cache(cache: Cache,
+                                 download_request: DownloadRequest,
+                                 content_md5: str,
+                                 *,
+                                 hardlink: bool = False
+                                 ) -> bool:
+    """
+    Try to satisfy a download request with an unmodified cached file of another file handle with the same content
+
+    :param cache: the cache to consult
+    :param download_request: the download request
+    :param content_md5: the MD5 hex digest of the content of the file handle
+    :param hardlink: set to True to hardlink the cached file. Default False.
+    :return: True when the file was materialized from the cache
+    """
+    for cached_path in cache.get_all_unmodified_cached_file_paths_with_content(content_md5):
+        try:
+            materialize_file(cached_path, download_request.path, hardlink=hardlink)
+        except OSError:
+            # the cached copy may have been removed since the lookup; try the next one
+            continue
+        cache.register(download_request.file_handle_id, download_request.path, content_md5=content_md5)
+        return True
+    return False
+
+
+def _download_from_synapse(session: requests.Session,
+                           cache: Cache,
+                           url_cache: PresignedUrlCache,
+                           download_request: DownloadRequest,
+                           *,
+                           channel: TransferChannel = None,
+                           progress: TransferProgress = None,
+                           hardlink: bool = False
+                           ) -> DownloadResult:
+    """
+    Transfer a file from its presigned URL and register it in the cache. A file whose content is already cached under
+    another file handle is materialized from the cache instead.
+
+    Failed attempts are retried up to DOWNLOAD_MAX_ATTEMPTS times with the presigned URL from the URL cache, resuming
+    from the bytes already written. A URL rejected by the storage provider is dropped from the URL cache first.
+
+    :param session: the session used to perform the HTTP requests
+    :param cache: the cache to register the file in
+    :param url_cache: the cache of presigned URLs
+    :param download_request: the download request
+    :param channel: the channel of the transfer scheduler to submit the transfer to. Default None, unscheduled.
+    :param progress: the progress to report the transfer to. Default None, not reported.
+    :param hardlink: set to True to hardlink a file materialized from the cache. Default False.
+    :return: the download result
+    """
+    key = _url_key(download_request)
+    temp_path = download_request.path + DOWNLOAD_TEMP_FILE_SUFFIX
+    try:
+        # only resume from bytes written by this call
+        remove_if_exists(temp_path)
+        for attempt in range(1, DOWNLOAD_MAX_ATTEMPTS + 1):
+            file_result = url_cache.get(key)
+            if file_result.get('failureCode') is not None:
+                error = FAILURE_CODE_ERRORS.get(file_result['failureCode'], SynapseClientError)
+                raise error(message="Cannot download file handle {}: {}".format(download_request.file_handle_id,
+                                                                                file_result['failureCode']))
+            file_handle = file_result.get('fileHandle', {})
+            if attempt == 1 and file_handle.get('contentMd5') is not None and \
+                    _download_from_content_cache(cache, download_request, file_handle['contentMd5'],
+                                                 hardlink=hardlink):
+                return DownloadResult(download_request.path, DOWNLOAD_STATUS_FROM_CACHE)
+            if progress is not None and attempt == 1:
+                progress.expect_bytes(file_handle.get('contentSize') or 0)
+            try:
+                _download_from_url(session,
+                                   file_result['preSignedURL'],
+                                   download_request.path,
+                                   expected_md5=file_handle.get('contentMd5'),
+                                   expected_size=file_handle.get('contentSize'),
+                                   channel=channel,
+                                   progress=progress)
+                break
+            except SynapseMd5MismatchError:
+                if progress is not None:
+                    # the content is transferred again
+                    progress.add_bytes(-os.path.getsize(temp_path))
+                remove_if_exists(temp_path)
+                if attempt == DOWNLOAD_MAX_ATTEMPTS:
+                    raise
+            except SynapseUnauthorizedError:
+                # the URL expired or was revoked
+                url_cache.invalidate(key)
+                if attempt == DOWNLOAD_MAX_ATTEMPTS:
+                    raise
+            except (SynapseServerError, SynapseTemporarilyUnavailableError, SynapseTooManyRequestError,
+                    requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                if attempt == DOWNLOAD_MAX_ATTEMPTS:
+                    raise
+                doze(DOWNLOAD_RETRY_BACKOFF_SEC * 2 ** (attempt - 1))
+        cache.register(download_request.file_handle_id, download_request.path,
+                       content_md5=file_handle.get('contentMd5'))
+        return DownloadResult(download_request.path, DOWNLOAD_STATUS_DOWNLOADED)
+    except (SynapseClientError, OSError, LockException, requests.RequestException) as error:
+        remove_if_exists(temp_path)
+        return DownloadResult(download_request.path, DOWNLOAD_STATUS_FAILED, error=error)
+
+
+def _download_from_url(session: requests.Session,
+                       url: str,
+                       path: str,
+                       *,
+                       expected_md5: str = None,
+                       expected_size: int = None,
+                       channel: TransferChannel = None,
+                       progress: TransferProgress = None
+                       ) -> None:
+    """
+    Stream the content of url into path. The file is written to a temporary file first and moved into place once
+    its content has been verified. When a temporary file from a failed attempt exists, only the remaining bytes are
+    requested.
+
+    :param session: the session used to perform the HTTP request
+    :param url: the presigned URL to download from
+    :param path: the local path to download to
+    :param expected_md5: the MD5 hex digest of the content. Set to None to skip the verification.
+    :param expected_size: the size of the content in bytes, if known
+    :param channel: the channel of the transfer scheduler that paces the transfer. Default None, unscheduled.
+    :param progress: the progress to report the transfer to. Default None, not reported.
+    :raises SynapseMd5MismatchError: when the downloaded content does not match expected_md5
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = path + DOWNLOAD_TEMP_FILE_SUFFIX
+    offset = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+    md5 = _md5_of_file(temp_path) if offset else hashlib.md5()
+    if expected_size is None or offset < expected_size:
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else None
+        with channel.slot() if channel is not None else _null_context(), \
+                session.get(url, stream=True, headers=headers) as response:
+            check_storage_status_code_and_raise_error(response)
+            if offset and response.status_code != 206:
+                # the storage provider ignored the range and sends the whole file
+                if progress is not None:
+                    progress.add_bytes(-offset)
+                offset = 0
+                md5 = hashlib.md5()
+            with open(temp_path, 'ab' if offset else 'wb') as f:
+                if not offset and expected_size is not None:
+                    preallocate_file(f, expected_size)
+                try:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE_BYTES):
+                        if channel is not None:
+                            channel.throttle(len(chunk))
+                        md5.update(chunk)
+                        f.write(chunk)
+                        if progress is not None:
+                            progress.add_bytes(len(chunk))
+                finally:
+                    # drop the preallocated bytes that were not written, so a retry resumes from the right offset
+                    f.truncate()
+    if expected_md5 is not None and md5.hexdigest() != expected_md5:
+        raise SynapseMd5MismatchError(message="Downloaded content for {} has MD5 {}, expected {}".format(
+            path, md5.hexdigest(), expected_md5))
+    os.replace(temp_path, path)
+
+
+def _md5_of_file(path: str):
+    """
+    :return: the MD5 hash object fed with the content of path, ready to be updated with the bytes that follow
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE_BYTES), b''):
+            md5.update(chunk)
+    return md5
+
+
+def _read_manifest(manifest_path: str,
+                   delimiter: str,
+                   required_columns: typing.Sequence[str]
+                   ) -> typing.Iterator[typing.Dict[str, str]]:
+    """
+    Read the rows of a delimited manifest
+
+    :param manifest_path: the path to the manifest
+    :param delimiter: the column delimiter
+    :param required_columns: the columns the manifest must have
+    :return: an iterator over the rows
+    :raises ValueError: when the manifest misses a required column
+    """
+    with open(manifest_path, 'r', newline='') as f:
+        reader = csv.DictReader(f, delimiter=delimiter)
+        missing = [column for column in required_columns if column not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError("Manifest {} is missing columns: {}".format(manifest_path, ", ".join(missing)))
+        for row in reader:
+            yield row
+
+
+def _write_manifest(manifest_path: str,
+                    delimiter: str,
+                    columns: typing.Sequence[str],
+                    rows: typing.Iterable[typing.Sequence]
+                    ) -> None:
+    """
+    Write rows to a delimited manifest
+
+    :param manifest_path: the path to the manifest
+    :param delimiter: the column delimiter
+    :param columns: the header
+    :param rows: the rows, each row holds one value per column
+    """
+    with open(manifest_path, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter=delimiter)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+def _request_from_row(row: typing.Dict[str, str]) -> DownloadRequest:
+    return DownloadRequest(int(row['file_handle_id']), row['object_id'], row['object_type'], row['path'])
+
+
+def _request_to_row(download_request: DownloadRequest) -> tuple:
+    return (download_request.file_handle_id, download_request.object_id, download_request.object_type,
+            download_request.path)
+
+
+def _result_to_row(download_request: DownloadRequest, download_result: DownloadResult) -> tuple:
+    error = download_result.error
+    if isinstance(error, SynapseClientError):
+        error = error.message or type(error).__name__
+    return _request_to_row(download_request) + (download_result.status, '' if error is None else str(error))
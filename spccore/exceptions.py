@@ -52,6 +52,14 @@ class SynapseTemporarilyUnavailableError(SynapseClientError):
     """Synapse Temporarily Unavailable Error"""
 
 
+class SynapseMd5MismatchError(SynapseClientError):
+    """The MD5 of the transferred content does not match the MD5 recorded in Synapse"""
+
+
+class SynapseInsufficientDiskSpaceError(SynapseClientError):
+    """The destination file system does not have enough space left for the files to download"""
+
+
 ERRORS = {
     400: SynapseBadRequestError,
     401: SynapseUnauthorizedError,
@@ -81,3 +89,15 @@ def check_status_code_and_raise_error(response: requests.Response) -> None:
         if 'errorCode' in response.json():
             error_code = response.json()['errorCode']
         raise error(message=reason, error_code=error_code)
+
+
+def check_storage_status_code_and_raise_error(response: requests.Response) -> None:
+    """
+    Raise the SynapseClientError matching the status code of a response from a storage provider, such as the response
+    to a presigned URL. Unlike Synapse responses, these responses do not carry a JSON body.
+
+    :param response: the response returned by the storage provider
+    """
+    if response.status_code >= 400:
+        default = SynapseServerError if response.status_code >= 500 else SynapseClientError
+        raise ERRORS.get(response.status_code, default)(message=response.reason)
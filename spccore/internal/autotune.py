@@ -0,0 +1,104 @@
+import threading
+import time
+
+"""
+Tunes the number of parts transferred at the same time while a transfer runs.
+
+The tuner hill-climbs on aggregate throughput: after each window of completed parts, it keeps moving the concurrency
+in the same direction while the bytes per second of the whole transfer improve, and turns around when they do not.
+When the server throttles a request, the concurrency is halved and the level that tripped the throttling becomes
+the new ceiling.
+
+Example::
+
+    tuner = ConcurrencyTuner(maximum=16)
+    # before starting a part
+    if in_flight < tuner.limit: ...
+    # after a part completes
+    tuner.record(part_size)
+    # after a 429 response
+    tuner.throttled()
+"""
+
+AUTOTUNE_INITIAL_CONCURRENCY = 2
+AUTOTUNE_MIN_IMPROVEMENT = 0.05
+
+
+class ConcurrencyTuner:
+    """
+    Implements a thread safe, throughput-driven concurrency limit
+    """
+
+    def __init__(self,
+                 *,
+                 maximum: int,
+                 minimum: int = 1,
+                 initial: int = AUTOTUNE_INITIAL_CONCURRENCY,
+                 min_improvement: float = AUTOTUNE_MIN_IMPROVEMENT
+                 ) -> None:
+        """
+        :param maximum: the max concurrency
+        :param minimum: the min concurrency
+        :param initial: the concurrency to start with
+        :param min_improvement: the relative throughput gain a step must bring to keep going in the same direction
+        """
+        if minimum < 1 or maximum < minimum:
+            raise ValueError("Expect 1 <= minimum <= maximum.")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_improvement = min_improvement
+        self._limit = max(minimum, min(initial, maximum))
+        self._ceiling = maximum
+        self._direction = 1
+        self._last_throughput = None
+        self._lock = threading.Lock()
+        self._reset_window()
+
+    @property
+    def limit(self) -> int:
+        """The number of parts that may be in flight right now"""
+        return self._limit
+
+    def record(self, number_of_bytes: int) -> None:
+        """
+        Record a completed part. Once as many parts as the current limit completed, the throughput of the window is
+        compared with the previous one and the limit is moved by one.
+
+        :param number_of_bytes: the size of the completed part
+        """
+        with self._lock:
+            self._window_bytes += number_of_bytes
+            self._window_parts += 1
+            if self._window_parts < max(self._limit, 2):
+                return
+            elapsed = time.monotonic() - self._window_start
+            throughput = self._window_bytes / elapsed if elapsed > 0 else float('inf')
+            if self._last_throughput is not None \
+                    and throughput < self._last_throughput * (1 + self.min_improvement):
+                self._direction = -self._direction
+            self._last_throughput = throughput
+            self._step()
+            self._reset_window()
+
+    def throttled(self) -> None:
+        """
+        Record that the server throttled a request: halve the limit and never grow back to the level that tripped it
+        """
+        with self._lock:
+            self._ceiling = max(self.minimum, self._limit - 1)
+            self._limit = max(self.minimum, self._limit // 2)
+            self._direction = 1
+            self._last_throughput = None
+            self._reset_window()
+
+    def _step(self) -> None:
+        limit = self._limit + self._direction
+        if limit < self.minimum or limit > self._ceiling:
+            self._direction = -self._direction
+            limit = self._limit + self._direction
+        self._limit = max(self.minimum, min(limit, self._ceiling))
+
+    def _reset_window(self) -> None:
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_parts = 0
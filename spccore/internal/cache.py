@@ -1,7 +1,15 @@
+import collections
+import concurrent.futures
+import functools
 import json
+import math
+import threading
+import time
 
 from spccore.constants import *
 from spccore.utils import *
+from .cacheindex import CacheIndex
+from .hashing import HashingService, get_hashing_service
 from .lock import *
 from .pathutils import *
 
@@ -13,15 +21,61 @@ class Cache:
     https://sagebionetworks.jira.com/wiki/spaces/SYNR/pages/34373660/Common+Client+Command+set+and+Cache+C4
     """
 
-    def __init__(self, *, cache_root_dir: str = SYNAPSE_DEFAULT_CACHE_ROOT_DIR) -> None:
+    def __init__(self,
+                 *,
+                 cache_root_dir: str = SYNAPSE_DEFAULT_CACHE_ROOT_DIR,
+                 hashing_service: HashingService = None,
+                 use_index: bool = False,
+                 max_parsed_cache_maps: int = CACHE_MAX_PARSED_CACHE_MAPS,
+                 max_bytes: int = None,
+                 max_entries: int = None,
+                 lock_free_reads: bool = False,
+                 dedupe: bool = False
+                 ) -> None:
         """
         Create an instance of the Cache
 
         :param cache_root_dir: the root directory of the Synapse cache
+        :param hashing_service: the service that hashes local files.
+            Default None, the service shared with the uploads of this process.
+        :param use_index: Set to True to look up and purge through an SQLite index of the cache maps, built from the
+            cache maps when it does not exist yet. Default False.
+        :param max_parsed_cache_maps: the max number of parsed cache maps kept in memory for lookups
+        :param max_bytes: the max total size of the registered files that live under the cache root.
+            Default None, unbounded.
+        :param max_entries: the max number of entries of the cache maps. Default None, unbounded.
+            With max_bytes or max_entries, the cache uses the index, records when each entry is looked up, and
+            evicts the least recently used entries once register() goes over a limit.
+        :param lock_free_reads: Set to True to read cache maps without taking their lock. Cache maps are published
+            atomically, so a reader sees either the old or the new map; a map that cannot be parsed, as written in
+            place by an older client, is read again under the lock. Default False.
+        :param dedupe: Set to True to replace a file registered with the MD5 of its content by a hardlink to an
+            unmodified file of the cache with the same content, on the same file system. Both paths then share one
+            file, so a program that modifies one of them in place modifies the other. The cache uses the index, which
+            records the content MD5s of the entries. Default False.
         :raises TypeError: when one or more parameters have invalid type
         """
         validate_type(str, cache_root_dir, "cache_root_dir")
+        validate_type(bool, use_index, "use_index")
+        validate_type(int, max_parsed_cache_maps, "max_parsed_cache_maps")
+        validate_type(int, max_bytes, "max_bytes")
+        validate_type(int, max_entries, "max_entries")
+        validate_type(bool, lock_free_reads, "lock_free_reads")
+        validate_type(bool, dedupe, "dedupe")
         self.cache_root_dir = cache_root_dir
+        self.hashing_service = hashing_service if hashing_service is not None else get_hashing_service()
+        self._parsed_cache_maps = _ParsedCacheMaps(max_parsed_cache_maps)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.lock_free_reads = lock_free_reads
+        self.dedupe = dedupe
+        # evictions triggered by concurrent registrations would evict the same entries
+        self._eviction_lock = threading.Lock()
+        self._index = None
+        if use_index or self._is_bounded() or dedupe:
+            self._index = CacheIndex(os.path.join(cache_root_dir, CACHE_INDEX_FILE_NAME))
+            if self._index.created:
+                self.rebuild_index()
 
     def get_cache_dir(self, file_handle_id: int) -> str:
         """
@@ -39,47 +93,287 @@ class Cache:
 
     def get_all_unmodified_cached_file_paths(self, file_handle_id: int) -> typing.List[str]:
         """
-        Performs a cache Read and retrieve all file paths for the given file handle id from the cache
+        Performs a cache Read and retrieve all file paths for the given file handle id from the cache.
+        A cache map parsed by an earlier lookup is reused without locking while its file is unchanged.
 
         :param file_handle_id: the file handle id to look up
         :returns: The paths to the file in the cache if the file exists and has not been modified
         :raises TypeError: when one or more parameters have invalid type
         """
         validate_type(int, file_handle_id, "file_handle_id")
+        return self._get_all_unmodified_cached_file_paths(file_handle_id)
 
+    def lookup_many(self,
+                    file_handle_ids: typing.Iterable[int],
+                    *,
+                    max_threads: int = CACHE_BATCH_MAX_THREADS
+                    ) -> typing.List[typing.List[str]]:
+        """
+        Performs the cache Reads of many file handle ids on a pool of threads, each cache map read once
+
+        :param file_handle_ids: the file handle ids to look up
+        :param max_threads: the max number of cache maps read at the same time
+        :return: for each file handle id, in order, the paths to its unmodified files in the cache
+        :raises TypeError: when one or more parameters have invalid type
+        """
+        file_handle_ids = list(file_handle_ids)
+        for file_handle_id in file_handle_ids:
+            validate_type(int, file_handle_id, "file_handle_id")
+
+        unique_ids = list(collections.OrderedDict.fromkeys(file_handle_ids))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+            paths = dict(zip(unique_ids, executor.map(self._get_all_unmodified_cached_file_paths, unique_ids)))
+        return [list(paths[file_handle_id]) for file_handle_id in file_handle_ids]
+
+    def _get_all_unmodified_cached_file_paths(self, file_handle_id: int) -> typing.List[str]:
+        if self._index is not None:
+            paths = _get_non_modified_paths(*self._index.get_cache_map_with_stats(file_handle_id))
+            if self._is_bounded() and paths:
+                self._index.touch(file_handle_id, paths)
+            return paths
+        return self._get_unmodified_paths_from_cache_map(file_handle_id)
+
+    def _get_unmodified_paths_from_cache_map(self, file_handle_id: int) -> typing.List[str]:
         cache_dir = self.get_cache_dir(file_handle_id)
         if not os.path.exists(cache_dir):
             return []
-        with Lock(SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME, current_working_directory=cache_dir):
-            return _get_all_non_modified_paths(cache_dir)
+        cache_maps = self._parsed_cache_maps.get(cache_dir, _get_cache_map_stat(cache_dir))
+        if cache_maps is None:
+            # the stat is taken before the read, so a write in between invalidates what is read
+            stat = _get_cache_map_stat(cache_dir)
+            if self.lock_free_reads:
+                cache_map = _get_cache_map_without_lock(cache_dir)
+            else:
+                cache_map = _get_cache_map_with_shared_lock(cache_dir)
+            cache_maps = cache_map, _get_cache_map_v2(cache_dir, cache_map)
+            self._parsed_cache_maps.put(cache_dir, stat, cache_maps)
+        return _get_non_modified_paths(*cache_maps)
 
-    def register(self, file_handle_id: int, file_path: str) -> dict:
+    def register(self, file_handle_id: int, file_path: str, *, content_md5: str = None) -> dict:
         """
         Performs a cache Write to register file_path with file_handle_id in the cache
 
         :param file_handle_id: the file handle id of the file
         :param file_path: the actual file path
+        :param content_md5: the MD5 hex digest of the content of the file, recorded so that the content is found in
+            the cache by its MD5. With dedupe, the file is replaced by a hardlink to a cached file with this content.
+            Default None, unknown.
         :return: the cache map
         :raises TypeError: when one or more parameters have invalid type
         """
         validate_type(int, file_handle_id, "file_handle_id")
         validate_type(str, file_path, "file_path")
+        validate_type(str, content_md5, "content_md5")
 
         if not file_path or not os.path.exists(file_path):
             raise ValueError("Can't find file \"%s\"" % file_path)
 
-        cache_dir = self.get_cache_dir(file_handle_id)
         file_path = normalize_path(file_path)
-        modified_time = get_modified_time_in_iso(file_path)
+        content_md5s = None
+        if content_md5 is not None:
+            content_md5s = {file_path: content_md5}
+            if self.dedupe:
+                self._link_to_copy(file_path, content_md5)
+        cache_map = self._register_group(file_handle_id, [file_path], content_md5s)
+        if self._is_bounded():
+            self._evict(protected={(file_handle_id, file_path)})
+        return cache_map
+
+    def register_many(self,
+                      entries: typing.Iterable[typing.Tuple[int, str]],
+                      *,
+                      max_threads: int = CACHE_BATCH_MAX_THREADS
+                      ) -> typing.List[typing.Optional[Exception]]:
+        """
+        Performs the cache Writes of many registrations: the entries of each file handle are written to its cache map
+        under a single lock, and the file handles are processed on a pool of threads.
+
+        :param entries: the (file handle id, file path) pairs to register
+        :param max_threads: the max number of cache maps written at the same time
+        :return: for each entry, in order, None when it was registered, or the error that prevented it
+        :raises TypeError: when one or more parameters have invalid type
+        """
+        entries = list(entries)
+        for file_handle_id, file_path in entries:
+            validate_type(int, file_handle_id, "file_handle_id")
+            validate_type(str, file_path, "file_path")
+
+        results = [None] * len(entries)
+        # file handle id -> [(position, normalized file path)]
+        groups = collections.OrderedDict()
+        for position, (file_handle_id, file_path) in enumerate(entries):
+            if not file_path or not os.path.exists(file_path):
+                results[position] = ValueError("Can't find file \"%s\"" % file_path)
+                continue
+            groups.setdefault(file_handle_id, []).append((position, normalize_path(file_path)))
+
+        def register_group(group: typing.Tuple[int, typing.List[typing.Tuple[int, str]]]) -> None:
+            file_handle_id, members = group
+            try:
+                self._register_group(file_handle_id, [file_path for _, file_path in members])
+            except (OSError, LockException) as error:
+                for position, _ in members:
+                    results[position] = error
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+            list(executor.map(register_group, groups.items()))
+        if self._is_bounded():
+            self._evict(protected={(file_handle_id, file_path)
+                                   for file_handle_id, members in groups.items() for _, file_path in members})
+        return results
+
+    def _register_group(self,
+                        file_handle_id: int,
+                        file_paths: typing.List[str],
+                        content_md5s: typing.Dict[str, str] = None
+                        ) -> dict:
+        """
+        Register normalized file paths of existing files with a file handle under a single lock
+
+        :param content_md5s: the MD5 hex digests of the content of the files, by path. Default None, unknown.
+        :return: the cache map
+        """
+        content_md5s = content_md5s or {}
+        cache_dir = self.get_cache_dir(file_handle_id)
+        entries_v2 = [_get_cache_map_v2_entry(file_path, content_md5s.get(file_path)) for file_path in file_paths]
 
         with Lock(SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME, current_working_directory=cache_dir) as lock:
             cache_map = _get_cache_map(cache_dir)
             _renew_lock(lock)
-            cache_map[file_path] = modified_time
+            cache_map.update((file_path, entry['modifiedTime']) for file_path, entry in zip(file_paths, entries_v2))
+            cache_map_v2 = _read_cache_map_v2_file(cache_dir)
+            for file_path, entry in zip(file_paths, entries_v2):
+                _keep_content_md5(entry, cache_map_v2.get(file_path))
+                cache_map_v2[file_path] = entry
+            # written first, so a reader of the new cache map finds its entries
+            _write_cache_map_v2({path: cache_map_v2[path] for path in cache_map if path in cache_map_v2}, cache_dir)
             _write_cache_map(cache_map, cache_dir)
-
+            self._parsed_cache_maps.discard(cache_dir)
+            if self._index is not None:
+                registered = list(zip(file_paths, entries_v2))
+                self._index.set_cache_map(file_handle_id, cache_map,
+                                          {file_path: entry['contentMd5'] for file_path, entry in registered
+                                           if 'contentMd5' in entry},
+                                          {file_path: (entry['modifiedTimeNs'], entry['size'])
+                                           for file_path, entry in registered})
         return cache_map
 
+    def register_if_content_matches(self, file_handle_id: int, file_path: str, content_md5: str) -> bool:
+        """
+        Register file_path with file_handle_id when the MD5 of its content is content_md5.
+        The file is hashed by the hashing service, which remembers the digest for a later upload of the same file.
+
+        :param file_handle_id: the file handle id of the file
+        :param file_path: the actual file path
+        :param content_md5: the MD5 hex digest of the content of the file handle
+        :return: True when the file was registered
+        :raises TypeError: when one or more parameters have invalid type
+        """
+        validate_type(int, file_handle_id, "file_handle_id")
+        validate_type(str, file_path, "file_path")
+        validate_type(str, content_md5, "content_md5")
+
+        if self.hashing_service.md5_of_file(file_path) != content_md5:
+            return False
+        self.register(file_handle_id, file_path, content_md5=content_md5)
+        return True
+
+    def get_all_unmodified_cached_file_paths_with_content(self, content_md5: str) -> typing.List[str]:
+        """
+        Look up the cache by content: the unmodified files registered with the MD5 of their content, under any file
+        handle. Only the cache of a client that uses the index records the content of its entries.
+
+        :param content_md5: the MD5 hex digest of the content to look up
+        :return: the paths to the unmodified files with this content, the files under the cache root first
+        :raises TypeError: when one or more parameters have invalid type
+        """
+        validate_type(str, content_md5, "content_md5")
+        if self._index is None:
+            return []
+        entries = self._index.get_entries_with_content(content_md5)
+        unmodified = {}
+        for file_handle_id in collections.OrderedDict.fromkeys(file_handle_id for file_handle_id, _ in entries):
+            # checked against the cache map v2, so a rewrite within a second does not pass for the recorded content
+            unmodified[file_handle_id] = set(self._get_unmodified_paths_from_cache_map(file_handle_id))
+        return list(collections.OrderedDict.fromkeys(path for file_handle_id, path in entries
+                                                     if path in unmodified[file_handle_id]))
+
+    def dedupe_files(self, *, dry_run: bool = False) -> typing.List[str]:
+        """
+        Deduplicate the files of the cache in place: each unmodified file with the content of another unmodified file
+        on the same file system is replaced by a hardlink to it. Files registered without their content MD5 are
+        hashed when their size is the size of another file, and their MD5 recorded.
+
+        :param dry_run: Set to True to list the files that would be replaced without replacing or hashing them.
+            Files registered without their content MD5 are then left out. Default False.
+        :return: the paths to the files replaced by hardlinks
+        :raises ValueError: when the cache has no index
+        """
+        if self._index is None:
+            raise ValueError("The cache at \"%s\" has no index" % self.cache_root_dir)
+        entries = self._index.get_entries_with_shared_size()
+        unmodified = {}
+        for file_handle_id in collections.OrderedDict.fromkeys(file_handle_id for file_handle_id, _, _ in entries):
+            unmodified[file_handle_id] = set(self._get_unmodified_paths_from_cache_map(file_handle_id))
+        entries = [entry for entry in entries if entry[1] in unmodified[entry[0]]]
+
+        if not dry_run:
+            to_hash = [(file_handle_id, path) for file_handle_id, path, content_md5 in entries if content_md5 is None]
+            md5s = dict(zip(to_hash, self.hashing_service.md5_of_files([path for _, path in to_hash])))
+            for file_handle_id, paths in _group_by_file_handle_id(to_hash).items():
+                self._register_group(file_handle_id, paths, {path: md5s[file_handle_id, path] for path in paths})
+            entries = [(file_handle_id, path, md5s.get((file_handle_id, path), content_md5))
+                       for file_handle_id, path, content_md5 in entries]
+
+        # content MD5 -> (file handle id, path) of its files, the file kept first
+        copies = collections.OrderedDict()
+        for file_handle_id, path, content_md5 in entries:
+            if content_md5 is not None:
+                copies.setdefault(content_md5, []).append((file_handle_id, path))
+        linked = []
+        for content_md5, files in copies.items():
+            # (device, inode) -> the file kept for each file system
+            kept = {}
+            for file_handle_id, path in files:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                source = kept.setdefault(stat.st_dev, (path, stat.st_ino))
+                if source[1] == stat.st_ino:
+                    continue
+                if not dry_run:
+                    try:
+                        link_file(source[0], path)
+                    except OSError:
+                        continue
+                    self._register_group(file_handle_id, [path], {path: content_md5})
+                linked.append(path)
+        return linked
+
+    def _link_to_copy(self, file_path: str, content_md5: str) -> bool:
+        """
+        Replace a file by a hardlink to an unmodified cached file with the same content on the same file system
+
+        :return: True when the file shares its storage with a cached copy
+        """
+        stat = os.stat(file_path)
+        for copy_path in self.get_all_unmodified_cached_file_paths_with_content(content_md5):
+            if copy_path == file_path:
+                continue
+            try:
+                copy_stat = os.stat(copy_path)
+                if (copy_stat.st_dev, copy_stat.st_ino) == (stat.st_dev, stat.st_ino):
+                    return True
+                if (copy_stat.st_dev, copy_stat.st_size) != (stat.st_dev, stat.st_size):
+                    continue
+                link_file(copy_path, file_path)
+                return True
+            except OSError:
+                # the copy was removed since the lookup, or the file system does not support hardlinks
+                continue
+        return False
+
     def remove(self, file_handle_id: int, *, file_path: str = None, delete_file: bool = False) -> typing.List[str]:
         """
         Performs a cache Write to remove a file(s) from the cache.
@@ -118,6 +412,9 @@ class Cache:
                 del cache_map[file_path]
 
             _write_cache_map(cache_map, cache_dir)
+            self._parsed_cache_maps.discard(cache_dir)
+            if self._index is not None:
+                self._index.set_cache_map(file_handle_id, cache_map)
 
         return removed
 
@@ -135,23 +432,283 @@ class Cache:
         :raises TypeError: when one or more parameters have invalid type
         """
         validate_type(datetime.datetime, before_date, "before_date")
+        self._parsed_cache_maps.clear()
         removed = []
-        for cache_dir in _cache_dirs(self.cache_root_dir):
-            removed.extend(_purge_cache_dir(before_date, cache_dir, dry_run))
+        if self._index is None:
+            for cache_dir in _cache_dirs(self.cache_root_dir):
+                removed.extend(_purge_cache_dir(before_date, cache_dir, dry_run))
+            return removed
+        for file_handle_id in self._get_file_handle_ids_to_purge(before_date):
+            removed.extend(self._purge_indexed_cache_dir(before_date, file_handle_id, dry_run))
         return removed
 
+    def iter_purge(self,
+                   before_date: datetime.datetime,
+                   *,
+                   dry_run: bool = False,
+                   max_threads: int = CACHE_PURGE_MAX_THREADS,
+                   time_budget_sec: float = None,
+                   max_files: int = None
+                   ) -> typing.Iterator[str]:
+        """
+        Purge the cache like purge(), one bucket directory per task on a pool of threads, and yield each removed file
+        path as its bucket is done.
+
+        With a time budget or a max number of files, the purge stops early: no cache directory is started once the
+        budget is spent or max_files paths were removed, and the directories in progress are finished, so a few more
+        paths than max_files may be removed. The next purge resumes at the first bucket that was not finished, and
+        wraps around to the buckets before it, so a purge run regularly with a budget eventually covers the whole
+        cache. The position is recorded in a checkpoint file under the cache root, except for dry runs.
+
+        :param before_date: the cutoff time to look up
+        :param dry_run: Set to True to list the file paths that would be removed without deleting the files.
+            Default False.
+        :param max_threads: the max number of bucket directories purged at the same time
+        :param time_budget_sec: the wall clock time after which no cache directory is started. Default None, no limit.
+        :param max_files: the number of removed file paths after which no cache directory is started.
+            Default None, no limit.
+        :return: an iterator over the removed file paths
+        :raises TypeError: when one or more parameters have invalid type
+        """
+        validate_type(datetime.datetime, before_date, "before_date")
+        # validated before the first item is requested
+        return self._iter_purge(before_date, dry_run=dry_run, max_threads=max_threads,
+                                time_budget_sec=time_budget_sec, max_files=max_files)
+
+    def _iter_purge(self,
+                    before_date: datetime.datetime,
+                    *,
+                    dry_run: bool,
+                    max_threads: int,
+                    time_budget_sec: typing.Optional[float],
+                    max_files: typing.Optional[int]
+                    ) -> typing.Iterator[str]:
+        self._parsed_cache_maps.clear()
+        deadline = time.monotonic() + time_budget_sec if time_budget_sec is not None else None
+        checkpoint_path = os.path.join(self.cache_root_dir, CACHE_PURGE_CHECKPOINT_FILE_NAME)
+        if self._index is None:
+            buckets = _get_buckets(self.cache_root_dir)
+        else:
+            # only the buckets of file handles with old entries need a visit
+            file_handle_ids = collections.defaultdict(list)
+            for file_handle_id in self._get_file_handle_ids_to_purge(before_date):
+                file_handle_ids[file_handle_id % SYNAPSE_DEFAULT_CACHE_BUCKET_SIZE].append(file_handle_id)
+            buckets = sorted(file_handle_ids)
+        # resume at the checkpoint, then wrap around
+        next_bucket = _read_purge_checkpoint(checkpoint_path)
+        buckets = [bucket for bucket in buckets if bucket >= next_bucket] + \
+                  [bucket for bucket in buckets if bucket < next_bucket]
+
+        stop = threading.Event()
+        removed_count = [0]
+        removed_count_lock = threading.Lock()
+
+        def should_stop() -> bool:
+            if deadline is not None and time.monotonic() >= deadline:
+                stop.set()
+            return stop.is_set()
+
+        def purge_bucket(bucket: int) -> typing.Tuple[typing.List[str], bool]:
+            """:return: the removed paths, and whether every cache directory of the bucket was purged"""
+            removed = []
+            if self._index is None:
+                purges = (functools.partial(_purge_cache_dir, before_date, cache_dir, dry_run)
+                          for cache_dir in _get_bucket_cache_dirs(os.path.join(self.cache_root_dir, str(bucket))))
+            else:
+                purges = (functools.partial(self._purge_indexed_cache_dir, before_date, file_handle_id, dry_run)
+                          for file_handle_id in file_handle_ids[bucket])
+            for purge in purges:
+                if should_stop():
+                    return removed, False
+                removed_from_cache_dir = purge()
+                removed.extend(removed_from_cache_dir)
+                with removed_count_lock:
+                    removed_count[0] += len(removed_from_cache_dir)
+                    if max_files is not None and removed_count[0] >= max_files:
+                        stop.set()
+            return removed, True
+
+        bucket_iterator = iter(buckets)
+        in_flight = {}
+        finished = set()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+                try:
+                    while True:
+                        while len(in_flight) < max_threads and not should_stop():
+                            bucket = next(bucket_iterator, None)
+                            if bucket is None:
+                                break
+                            in_flight[executor.submit(purge_bucket, bucket)] = bucket
+                        if not in_flight:
+                            break
+                        done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            bucket = in_flight.pop(future)
+                            removed, bucket_finished = future.result()
+                            if bucket_finished:
+                                finished.add(bucket)
+                            yield from removed
+                finally:
+                    # when the caller stops early, let the buckets in progress stop at their next cache directory
+                    stop.set()
+        finally:
+            if not dry_run:
+                for future, bucket in in_flight.items():
+                    if not future.cancelled() and future.exception() is None and future.result()[1]:
+                        finished.add(bucket)
+                _write_purge_checkpoint(checkpoint_path,
+                                        next((bucket for bucket in buckets if bucket not in finished), None))
+
+    def evict(self) -> typing.List[str]:
+        """
+        Evict the least recently used entries until the cache is within max_bytes and max_entries.
+        Evicted entries are removed from their cache maps, and their files are deleted when they live under the cache
+        root. register() evicts on its own; this is for a cache whose limits were lowered.
+
+        :return: the paths of the evicted entries
+        """
+        return self._evict(protected=set())
+
+    def _is_bounded(self) -> bool:
+        return self.max_bytes is not None or self.max_entries is not None
+
+    def _evict(self, *, protected: typing.AbstractSet[typing.Tuple[int, str]]) -> typing.List[str]:
+        """
+        :param protected: the (file handle ID, path) of the entries that were just registered, which are never evicted
+        """
+        evicted = []
+        if not self._is_bounded() or not self._eviction_lock.acquire(blocking=False):
+            # another thread is already evicting
+            return evicted
+        try:
+            while True:
+                entries, size = self._index.get_usage()
+                bytes_over = self.max_bytes is not None and size > self.max_bytes
+                entries_over = self.max_entries is not None and entries > self.max_entries
+                if not bytes_over and not entries_over:
+                    return evicted
+                # only the files under the cache root count towards max_bytes, so only they free bytes
+                candidates = [candidate for candidate in
+                              self._index.get_least_recently_used(CACHE_EVICTION_BATCH_SIZE, in_cache_root=bytes_over)
+                              if candidate[:2] not in protected]
+                if not candidates:
+                    return evicted
+                for file_handle_id, path, file_size, in_cache_root in candidates:
+                    self.remove(file_handle_id, file_path=path, delete_file=in_cache_root)
+                    evicted.append(path)
+                    entries -= 1
+                    size -= file_size if in_cache_root else 0
+                    if (self.max_bytes is None or size <= self.max_bytes) and \
+                            (self.max_entries is None or entries <= self.max_entries):
+                        break
+        finally:
+            self._eviction_lock.release()
+
+    def _get_file_handle_ids_to_purge(self, before_date: datetime.datetime) -> typing.List[int]:
+        # the cutoff is rounded to the millisecond precision of the cache maps; _purge_cache_dir compares exactly
+        return self._index.get_file_handle_ids_modified_before(from_datetime_to_iso(before_date))
+
+    def _purge_indexed_cache_dir(self,
+                                 before_date: datetime.datetime,
+                                 file_handle_id: int,
+                                 dry_run: bool
+                                 ) -> typing.List[str]:
+        cache_dir = self.get_cache_dir(file_handle_id)
+        if not os.path.isdir(cache_dir):
+            # removed by a client that does not update the index
+            if not dry_run:
+                self._index.set_cache_map(file_handle_id, {})
+            return []
+        return _purge_cache_dir(before_date, cache_dir, dry_run, index=self._index)
+
+    def rebuild_index(self) -> None:
+        """
+        Rebuild the index from the cache maps, to pick up the changes of clients that do not update the index
+
+        :raises ValueError: when the cache has no index
+        """
+        if self._index is None:
+            raise ValueError("The cache at \"%s\" has no index" % self.cache_root_dir)
+        cache_map_paths = ((_get_file_handle_id(cache_dir),
+                            os.path.join(cache_dir, SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME))
+                           for cache_dir in _cache_dirs(self.cache_root_dir))
+        self._index.rebuild(cache_map_paths)
+
 
 # Helper methods
 # These methods are not designed to be used outside of this module.
 
 
-def _purge_cache_dir(before_date: datetime.datetime, cache_dir: str, dry_run: bool) -> typing.List[str]:
+class _ParsedCacheMaps:
+    """
+    A thread safe LRU of parsed cache maps keyed by cache directory. A cache map is only returned while the stat of
+    its file, (modification time in nanoseconds, size, inode), is the one it was read with, so a write by another
+    client or process makes it stale. The stat of a rewrite within the time resolution of the file system that keeps
+    the size cannot be told apart, so the writes of this cache discard the maps they change.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        # cache directory -> (stat, (cache map, cache map v2))
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cache_dir: str, stat: typing.Optional[tuple]) -> typing.Optional[tuple]:
+        """
+        :return: the cache map and cache map v2 parsed with the given stat of its file, or None
+        """
+        if stat is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(cache_dir)
+            if entry is None or entry[0] != stat:
+                return None
+            self._entries.move_to_end(cache_dir)
+            return entry[1]
+
+    def put(self, cache_dir: str, stat: typing.Optional[tuple], cache_maps: tuple) -> None:
+        if stat is None or self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[cache_dir] = (stat, cache_maps)
+            self._entries.move_to_end(cache_dir)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, cache_dir: str) -> None:
+        with self._lock:
+            self._entries.pop(cache_dir, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def _get_cache_map_stat(cache_dir: str) -> typing.Optional[tuple]:
+    """
+    :return: the (modification time in nanoseconds, size, inode) of the cache map file, or None when it does not exist
+    """
+    try:
+        stat = os.stat(os.path.join(cache_dir, SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME))
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def _purge_cache_dir(before_date: datetime.datetime,
+                     cache_dir: str,
+                     dry_run: bool,
+                     *,
+                     index: CacheIndex = None
+                     ) -> typing.List[str]:
     """
     Purge a single cache directory and remove all files that are recorded before a set date.
 
     :param before_date: the cutoff date
     :param cache_dir: the target directory
     :param dry_run: Set to True to return the list of file paths that would be removed without deleting the files.
+    :param index: the index to update with the remaining entries. Default None, no index.
     :return: a list of file paths that were removed
     """
     removed = []
@@ -174,6 +731,8 @@ def _purge_cache_dir(before_date: datetime.datetime, cache_dir: str, dry_run: bo
                 shutil.rmtree(cache_dir)
             else:
                 _write_cache_map(remain_map, cache_dir)
+            if index is not None:
+                index.set_cache_map(_get_file_handle_id(cache_dir), remain_map)
     return removed
 
 
@@ -182,19 +741,34 @@ def _renew_lock(lock: Lock):
         raise LockException("Failed to renew lock")
 
 
-def _get_all_non_modified_paths(cache_dir: str) -> typing.List[str]:
+def _get_non_modified_paths(cache_map: dict, cache_map_v2: dict = None) -> typing.List[str]:
+    """
+    :param cache_map: a cache map, path -> modified time
+    :param cache_map_v2: the (modified time in nanoseconds, size) of the entries registered with them, by path.
+        Default None, every entry is checked by its modified time in seconds.
+    :return: the paths of the cache map whose files were not modified since they were registered
     """
-    Perform a cache map read and return all non-modified paths in the given cache directory
+    cache_map_v2 = cache_map_v2 or {}
+    return [path for path, modified_time in cache_map.items()
+            if _is_unmodified(path, modified_time, cache_map_v2.get(path))]
 
-    :param cache_dir: the cache directory to look for
-    :return: all non-modified paths
+
+def _is_unmodified(path: str, modified_time: str, stat_v2: typing.Optional[typing.Tuple[int, int]]) -> bool:
     """
-    cache_map = _get_cache_map(cache_dir)
-    non_modified_paths = []
-    for path in cache_map:
-        if get_modified_time_in_iso(path) == cache_map.get(path):
-            non_modified_paths.append(path)
-    return non_modified_paths
+    Check a cache map entry against a single stat of its file
+
+    :param path: the path of the entry
+    :param modified_time: the modified time of the entry, in the ISO format of the cache map
+    :param stat_v2: the (modified time in nanoseconds, size) of the entry, or None for an entry registered without
+    :return: True when the file exists and was not modified since it was registered
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat_v2 is not None:
+        return (stat.st_mtime_ns, stat.st_size) == stat_v2
+    return from_epoch_time_to_iso(math.floor(stat.st_mtime)) == modified_time
 
 
 def _get_cache_map(cache_dir: str) -> dict:
@@ -213,34 +787,163 @@ def _get_cache_map(cache_dir: str) -> dict:
     return cache_map
 
 
+def _get_cache_map_v2_entry(path: str, content_md5: str = None) -> dict:
+    """
+    :return: the cache map v2 entry of an existing file, with the modified time recorded in the cache map
+    """
+    stat = os.stat(path)
+    entry = {'modifiedTime': from_epoch_time_to_iso(math.floor(stat.st_mtime)),
+             'modifiedTimeNs': stat.st_mtime_ns,
+             'size': stat.st_size}
+    if content_md5 is not None:
+        entry['contentMd5'] = content_md5
+    return entry
+
+
+def _keep_content_md5(entry: dict, previous_entry: typing.Optional[dict]) -> None:
+    """
+    Keep the content MD5 of the previous entry of a path registered again without it, while the file is unchanged
+    """
+    if 'contentMd5' in entry or not isinstance(previous_entry, dict) or 'contentMd5' not in previous_entry:
+        return
+    if all(previous_entry.get(key) == entry[key] for key in ('modifiedTime', 'modifiedTimeNs', 'size')):
+        entry['contentMd5'] = previous_entry['contentMd5']
+
+
+def _group_by_file_handle_id(entries: typing.Iterable[typing.Tuple[int, str]]) -> typing.Dict[int, typing.List[str]]:
+    groups = collections.OrderedDict()
+    for file_handle_id, path in entries:
+        groups.setdefault(file_handle_id, []).append(path)
+    return groups
+
+
+def _read_cache_map_v2_file(cache_dir: str) -> dict:
+    """
+    :return: the cache map v2 of a cache directory, path -> entry, or an empty map when it cannot be read
+    """
+    try:
+        with open(os.path.join(cache_dir, CACHE_MAP_V2_FILE_NAME), 'r') as f:
+            cache_map_v2 = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache_map_v2 if isinstance(cache_map_v2, dict) else {}
+
+
+def _get_cache_map_v2(cache_dir: str, cache_map: dict) -> typing.Dict[str, typing.Tuple[int, int]]:
+    """
+    Read the cache map v2 of the entries of a cache map. An entry whose modified time is not the one of the cache map
+    was registered again by a client that does not write the cache map v2, such as an R client, and is left out.
+
+    :param cache_dir: the path to the cache directory
+    :param cache_map: the cache map read from the cache directory
+    :return: path -> (modified time in nanoseconds, size)
+    """
+    cache_map_v2 = {}
+    for path, entry in _read_cache_map_v2_file(cache_dir).items():
+        try:
+            if cache_map.get(path) == entry['modifiedTime']:
+                cache_map_v2[path] = (int(entry['modifiedTimeNs']), int(entry['size']))
+        except (TypeError, KeyError, ValueError):
+            continue
+    return cache_map_v2
+
+
+def _get_cache_map_without_lock(cache_dir: str) -> dict:
+    """
+    Perform a cache map read without the lock, and again with the lock if the map was caught being written in place
+
+    :param cache_dir: the path to the cache directory
+    :return: a dictionary with the cache map of all files in the cache folder
+    """
+    try:
+        return _get_cache_map(cache_dir)
+    except ValueError:
+        with Lock(SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME, current_working_directory=cache_dir):
+            return _get_cache_map(cache_dir)
+
+
+def _get_cache_map_with_shared_lock(cache_dir: str) -> dict:
+    """
+    Perform a cache map read under the shared lock, and again under the exclusive lock if the map was caught being
+    written in place. Older clients, such as R clients, do not wait for the holders of the shared lock.
+
+    :param cache_dir: the path to the cache directory
+    :return: a dictionary with the cache map of all files in the cache folder
+    """
+    try:
+        with SharedLock(SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME, current_working_directory=cache_dir):
+            return _get_cache_map(cache_dir)
+    except ValueError:
+        with Lock(SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME, current_working_directory=cache_dir):
+            return _get_cache_map(cache_dir)
+
+
 def _write_cache_map(cache_map: dict, cache_dir: str) -> None:
     """
-    Perform a cache map write
+    Perform a cache map write. The map is written to a temporary file, flushed to disk, then renamed over the cache
+    map, so readers see either the old or the new map in full.
 
     :param cache_map: the map to write
     :param cache_dir: the location to write to
     """
+    _write_json_atomically(cache_map, cache_dir, SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME)
+
+
+def _write_cache_map_v2(cache_map_v2: dict, cache_dir: str) -> None:
+    """
+    Perform a cache map v2 write, atomically like the cache map
+
+    :param cache_map_v2: the map to write, path -> entry
+    :param cache_dir: the location to write to
+    """
+    _write_json_atomically(cache_map_v2, cache_dir, CACHE_MAP_V2_FILE_NAME)
+
+
+def _write_json_atomically(content: dict, cache_dir: str, file_name: str) -> None:
     if not os.path.exists(cache_dir):
         os.makedirs(cache_dir)
 
-    cache_map_file = os.path.join(cache_dir, SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME)
-
-    with open(cache_map_file, 'w') as f:
-        json.dump(cache_map, f)
-        f.write('\n')  # For compatibility with R's JSON parser
+    file_path = os.path.join(cache_dir, file_name)
+    # unique per writer, in case a lock considered stale was broken while its owner was still writing
+    temp_file = '{}.{}.{}{}'.format(file_path, os.getpid(), threading.get_ident(), CACHE_MAP_TEMP_FILE_SUFFIX)
+
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(content, f)
+            f.write('\n')  # For compatibility with R's JSON parser
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, file_path)
+    except BaseException:
+        remove_if_exists(temp_file)
+        raise
+    _fsync_directory(cache_dir)
+
+
+def _fsync_directory(directory: str) -> None:
+    """Make a rename within a directory durable. Directories cannot be opened on Windows, which needs no flush."""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def _is_modified(cache_dir: str, file_path: str) -> bool:
     """
-    Perform a cache map read and check if a file in the cache has been modified
+    Perform a cache map read without the lock and check if a file in the cache has been modified
 
     :param cache_dir: the cache directory
     :param file_path: the file to check
     :return: true if the file's modified time is later than the cache time; false otherwise
     """
-    cache_map = _get_cache_map(cache_dir)
-    cache_time = cache_map.get(normalize_path(file_path))
-    return cache_time is None or cache_time == get_modified_time_in_iso(file_path)
+    cache_map = _get_cache_map_without_lock(cache_dir)
+    file_path = normalize_path(file_path)
+    cache_time = cache_map.get(file_path)
+    return cache_time is None or \
+        _is_unmodified(file_path, cache_time, _get_cache_map_v2(cache_dir, cache_map).get(file_path))
 
 
 def _cache_dirs(cache_root_dir: str) -> typing.List[str]:
@@ -259,6 +962,51 @@ def _cache_dirs(cache_root_dir: str) -> typing.List[str]:
                     yield path_to_file_handle_id_dir
 
 
+def _get_buckets(cache_root_dir: str) -> typing.List[int]:
+    """
+    :return: the bucket numbers of the bucket directories, such as 949 for [cache_root_dir]/949, in ascending order
+    """
+    if not os.path.isdir(cache_root_dir):
+        return []
+    return sorted(int(name) for name in os.listdir(cache_root_dir)
+                  if name.isdigit() and os.path.isdir(os.path.join(cache_root_dir, name)))
+
+
+def _get_bucket_cache_dirs(bucket_dir: str) -> typing.List[str]:
+    """
+    :return: the cache dirs of a bucket directory, such as [cache_root_dir]/949/59949 for [cache_root_dir]/949
+    """
+    if not os.path.isdir(bucket_dir):
+        return []
+    return [os.path.join(bucket_dir, name) for name in sorted(os.listdir(bucket_dir))
+            if name.isdigit() and os.path.isdir(os.path.join(bucket_dir, name))]
+
+
+def _read_purge_checkpoint(checkpoint_path: str) -> int:
+    """
+    :return: the bucket number an interrupted purge stopped at, 0 without a readable checkpoint
+    """
+    try:
+        with open(checkpoint_path, 'r') as f:
+            return int(json.load(f)['nextBucket'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+
+
+def _write_purge_checkpoint(checkpoint_path: str, next_bucket: typing.Optional[int]) -> None:
+    """
+    Record the bucket number the next purge starts at, or remove the checkpoint when the purge covered every bucket
+    """
+    if next_bucket is None:
+        remove_if_exists(checkpoint_path)
+        return
+    os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+    temp_path = checkpoint_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'nextBucket': next_bucket}, f)
+    os.replace(temp_path, checkpoint_path)
+
+
 def _get_file_handle_id(cache_dir: str) -> int:
     """
     Extract the file handle id from the given cache directory.
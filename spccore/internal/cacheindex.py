@@ -0,0 +1,319 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+from spccore.constants import CACHE_MAP_V2_FILE_NAME
+from .pathutils import normalize_path
+
+"""
+An SQLite index of the entries of the cache maps, kept next to the cache directories.
+
+The .cacheMap files stay the source of truth that R clients read and write; the index mirrors them so that a lookup
+is an indexed query instead of a locked read of a JSON file, and a purge visits only the cache directories that
+hold entries older than its cutoff instead of every directory of the cache.
+
+Each entry records the file handle ID, the normalized path, the modified time as stored in the cache map, the size
+of the file, whether it lives under the cache root, the time it was registered, the time it was last looked up and,
+when it was registered with it, the MD5 of its content, so files with the same content are found by their MD5.
+Entries registered with a cache map v2 entry also record the modified time in nanoseconds and the size of the file
+when it was registered, so a lookup served by the index validates them as precisely as one served by the cache maps.
+Modified times are stored in the ISO format of the cache maps, which sorts in time order, so a range query on them is
+a range scan of their index. Triggers keep the number of entries and the bytes of the files under the cache root in a
+single row, so the usage of the cache is read without a scan.
+
+Entries written by clients that do not update the index, such as R clients, are only seen once the index is
+rebuilt from the cache maps.
+
+Example::
+
+    index = CacheIndex(os.path.join(cache_root_dir, CACHE_INDEX_FILE_NAME))
+    index.set_cache_map(123, {"/path/to/file.txt": "2019-07-01T00:03:01.000Z"})
+    index.get_cache_map(123)                             # {"/path/to/file.txt": "2019-07-01T00:03:01.000Z"}
+    index.get_cache_map_with_stats(123)                  # ({"/path/to/file.txt": "2019-07-01T00:03:01.000Z"}, {})
+    index.get_file_handle_ids_modified_before("2020-01-01T00:00:00.000Z")  # [123]
+"""
+
+# an index with another schema version is dropped and rebuilt from the cache maps
+CACHE_INDEX_SCHEMA_VERSION = 4
+CACHE_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entries (
+    file_handle_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    modified_time TEXT NOT NULL,
+    modified_time_ns INTEGER,
+    size INTEGER,
+    in_cache_root INTEGER NOT NULL,
+    registered_time REAL NOT NULL,
+    accessed_time REAL NOT NULL,
+    content_md5 TEXT,
+    PRIMARY KEY (file_handle_id, path)
+);
+CREATE INDEX IF NOT EXISTS cache_entries_modified_time ON cache_entries (modified_time);
+CREATE INDEX IF NOT EXISTS cache_entries_accessed_time ON cache_entries (accessed_time);
+CREATE INDEX IF NOT EXISTS cache_entries_content_md5 ON cache_entries (content_md5);
+CREATE INDEX IF NOT EXISTS cache_entries_size ON cache_entries (size);
+CREATE TABLE IF NOT EXISTS cache_usage (entries INTEGER NOT NULL, bytes INTEGER NOT NULL);
+INSERT INTO cache_usage SELECT 0, 0 WHERE NOT EXISTS (SELECT * FROM cache_usage);
+CREATE TRIGGER IF NOT EXISTS cache_entries_insert AFTER INSERT ON cache_entries BEGIN
+    UPDATE cache_usage SET entries = entries + 1, bytes = bytes + NEW.in_cache_root * COALESCE(NEW.size, 0);
+END;
+CREATE TRIGGER IF NOT EXISTS cache_entries_delete AFTER DELETE ON cache_entries BEGIN
+    UPDATE cache_usage SET entries = entries - 1, bytes = bytes - OLD.in_cache_root * COALESCE(OLD.size, 0);
+END;
+"""
+CACHE_INDEX_DROP_SCHEMA = """
+DROP TABLE IF EXISTS cache_entries;
+DROP TABLE IF EXISTS cache_usage;
+"""
+# how long to wait for another process to release the database
+CACHE_INDEX_TIMEOUT_SEC = 30
+
+
+class CacheIndex:
+    """
+    Implements a thread safe index of the cache maps, shared with other processes through SQLite locking
+    """
+
+    def __init__(self, index_path: str) -> None:
+        """
+        Open the index, creating it when it does not exist
+
+        :param index_path: the path to the SQLite database
+        """
+        self.index_path = index_path
+        root_dir = os.path.dirname(os.path.abspath(index_path))
+        os.makedirs(root_dir, exist_ok=True)
+        self._root_prefix = normalize_path(root_dir).rstrip('/') + '/'
+        # one connection shared by the threads of the client, serialized by the lock
+        self._connection = sqlite3.connect(index_path, timeout=CACHE_INDEX_TIMEOUT_SEC, check_same_thread=False)
+        # makes the rows replaced by INSERT OR REPLACE fire the delete trigger
+        self._connection.execute("PRAGMA recursive_triggers = ON")
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+            # True when the index has to be built from the cache maps
+            self.created = version != CACHE_INDEX_SCHEMA_VERSION
+            if self.created:
+                self._connection.executescript(CACHE_INDEX_DROP_SCHEMA)
+            self._connection.executescript(CACHE_INDEX_SCHEMA)
+            self._connection.execute("PRAGMA user_version = {}".format(CACHE_INDEX_SCHEMA_VERSION))
+
+    def get_cache_map(self, file_handle_id: int) -> typing.Dict[str, str]:
+        """
+        :param file_handle_id: the file handle ID to look up
+        :return: the indexed cache map of the file handle, path -> modified time
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT path, modified_time FROM cache_entries WHERE file_handle_id = ?",
+                                            (file_handle_id,)).fetchall()
+        return dict(rows)
+
+    def get_cache_map_with_stats(self,
+                                 file_handle_id: int
+                                 ) -> typing.Tuple[typing.Dict[str, str], typing.Dict[str, typing.Tuple[int, int]]]:
+        """
+        :param file_handle_id: the file handle ID to look up
+        :return: the indexed cache map of the file handle, path -> modified time, and the (modified time in
+            nanoseconds, size) of the entries registered with them, by path
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT path, modified_time, modified_time_ns, size FROM cache_entries "
+                                            "WHERE file_handle_id = ?", (file_handle_id,)).fetchall()
+        return ({path: modified_time for path, modified_time, _, _ in rows},
+                {path: (modified_time_ns, size) for path, _, modified_time_ns, size in rows
+                 if modified_time_ns is not None and size is not None})
+
+    def set_cache_map(self,
+                      file_handle_id: int,
+                      cache_map: typing.Dict[str, str],
+                      content_md5s: typing.Dict[str, str] = None,
+                      stats: typing.Dict[str, typing.Tuple[int, int]] = None
+                      ) -> None:
+        """
+        Replace the entries of a file handle with the entries of its cache map.
+        Entries whose path, modified time and stat are unchanged keep their size, registration time and content MD5,
+        unless a content MD5 is given for them.
+
+        :param file_handle_id: the file handle ID of the cache map
+        :param cache_map: the cache map, path -> modified time
+        :param content_md5s: the MD5 hex digests of the content of the entries registered with them, by path.
+            Default None.
+        :param stats: the (modified time in nanoseconds, size) of the entries registered with them, by path.
+            Default None.
+        """
+        with self._lock, self._connection:
+            self._set_cache_map(file_handle_id, cache_map, time.time(), content_md5s or {}, stats or {})
+
+    def get_file_handle_ids_modified_before(self, modified_time: str) -> typing.List[int]:
+        """
+        :param modified_time: the cutoff, in the ISO format of the cache maps
+        :return: the file handle IDs with at least one entry modified at or before the cutoff, in ascending order
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT DISTINCT file_handle_id FROM cache_entries "
+                                            "WHERE modified_time <= ? ORDER BY file_handle_id",
+                                            (modified_time,)).fetchall()
+        return [row[0] for row in rows]
+
+    def touch(self, file_handle_id: int, paths: typing.Iterable[str]) -> None:
+        """
+        Record that entries were looked up
+
+        :param file_handle_id: the file handle ID of the entries
+        :param paths: the paths of the entries
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany("UPDATE cache_entries SET accessed_time = ? "
+                                         "WHERE file_handle_id = ? AND path = ?",
+                                         [(now, file_handle_id, path) for path in paths])
+
+    def get_usage(self) -> typing.Tuple[int, int]:
+        """
+        :return: the number of entries, and the total size of the files of the entries under the cache root
+        """
+        with self._lock:
+            return self._connection.execute("SELECT entries, bytes FROM cache_usage").fetchone()
+
+    def get_least_recently_used(self,
+                                limit: int,
+                                *,
+                                in_cache_root: bool = False
+                                ) -> typing.List[typing.Tuple[int, str, int, bool]]:
+        """
+        :param limit: the max number of entries to return
+        :param in_cache_root: Set to True to only return the entries whose files live under the cache root.
+            Default False.
+        :return: the (file handle ID, path, size, whether the file lives under the cache root) of the entries looked
+            up or registered the longest time ago, the least recently used first
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT file_handle_id, path, COALESCE(size, 0), in_cache_root "
+                                            "FROM cache_entries {}ORDER BY accessed_time LIMIT ?"
+                                            .format("WHERE in_cache_root = 1 " if in_cache_root else ""),
+                                            (limit,)).fetchall()
+        return [(file_handle_id, path, size, bool(in_root)) for file_handle_id, path, size, in_root in rows]
+
+    def get_entries_with_content(self, content_md5: str) -> typing.List[typing.Tuple[int, str]]:
+        """
+        :param content_md5: the MD5 hex digest of the content to look up
+        :return: the (file handle ID, path) of the entries registered with this content, the entries whose files live
+            under the cache root first
+        """
+        with self._lock:
+            return self._connection.execute("SELECT file_handle_id, path FROM cache_entries WHERE content_md5 = ? "
+                                            "ORDER BY in_cache_root DESC, accessed_time DESC",
+                                            (content_md5,)).fetchall()
+
+    def get_entries_with_shared_size(self) -> typing.List[typing.Tuple[int, str, typing.Optional[str]]]:
+        """
+        :return: the (file handle ID, path, content MD5 or None) of the non empty entries whose size is the size of
+            another entry, the only entries that may hold the content of another entry, ordered by size
+        """
+        with self._lock:
+            return self._connection.execute("SELECT file_handle_id, path, content_md5 FROM cache_entries "
+                                            "WHERE size IN (SELECT size FROM cache_entries WHERE size > 0 "
+                                            "GROUP BY size HAVING COUNT(*) > 1) "
+                                            "ORDER BY size, in_cache_root DESC, accessed_time DESC").fetchall()
+
+    def rebuild(self, cache_maps: typing.Iterable[typing.Tuple[int, str]]) -> None:
+        """
+        Replace the whole index with the entries of the cache maps, in a single transaction.
+        Cache maps that cannot be read are skipped. Content MD5s and stats are read from the cache map v2 next to each
+        cache map.
+
+        :param cache_maps: the (file handle ID, path to the cache map file) pairs of every cache directory
+        """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM cache_entries")
+            for file_handle_id, cache_map_path in cache_maps:
+                try:
+                    with open(cache_map_path, 'r') as f:
+                        cache_map = json.load(f)
+                    # the last write of the cache map is the best estimate of when its entries were registered
+                    registered_time = os.path.getmtime(cache_map_path)
+                except (OSError, ValueError):
+                    continue
+                content_md5s, stats = _read_cache_map_v2(
+                    os.path.join(os.path.dirname(cache_map_path), CACHE_MAP_V2_FILE_NAME), cache_map)
+                self._insert(file_handle_id, cache_map, registered_time, content_md5s, stats)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _set_cache_map(self,
+                       file_handle_id: int,
+                       cache_map: typing.Dict[str, str],
+                       registered_time: float,
+                       content_md5s: typing.Dict[str, str],
+                       stats: typing.Dict[str, typing.Tuple[int, int]]
+                       ) -> None:
+        """Must be called within a transaction, holding the lock"""
+        indexed = {path: (modified_time, (modified_time_ns, size))
+                   for path, modified_time, modified_time_ns, size in self._connection.execute(
+                       "SELECT path, modified_time, modified_time_ns, size FROM cache_entries WHERE file_handle_id = ?",
+                       (file_handle_id,))}
+        self._connection.executemany("DELETE FROM cache_entries WHERE file_handle_id = ? AND path = ?",
+                                     [(file_handle_id, path) for path in indexed if path not in cache_map])
+        self._insert(file_handle_id,
+                     {path: modified_time for path, modified_time in cache_map.items()
+                      if path not in indexed or indexed[path][0] != modified_time or path in content_md5s or
+                      (path in stats and indexed[path][1] != tuple(stats[path]))},
+                     registered_time,
+                     content_md5s,
+                     stats)
+
+    def _insert(self,
+                file_handle_id: int,
+                cache_map: typing.Dict[str, str],
+                registered_time: float,
+                content_md5s: typing.Dict[str, str],
+                stats: typing.Dict[str, typing.Tuple[int, int]] = None
+                ) -> None:
+        """Must be called within a transaction, holding the lock"""
+        stats = stats or {}
+        self._connection.executemany("INSERT OR REPLACE INTO cache_entries "
+                                     "(file_handle_id, path, modified_time, modified_time_ns, size, in_cache_root, "
+                                     "registered_time, accessed_time, content_md5) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     [(file_handle_id, path, modified_time) +
+                                      (tuple(stats[path]) if path in stats else (None, _get_size(path))) +
+                                      (path.startswith(self._root_prefix), registered_time, registered_time,
+                                       content_md5s.get(path))
+                                      for path, modified_time in cache_map.items()])
+
+
+def _read_cache_map_v2(cache_map_v2_path: str,
+                       cache_map: typing.Dict[str, str]
+                       ) -> typing.Tuple[typing.Dict[str, str], typing.Dict[str, typing.Tuple[int, int]]]:
+    """
+    :return: the content MD5s, and the (modified time in nanoseconds, size), of the cache map v2 entries that were
+        registered with the modified time of the cache map
+    """
+    content_md5s = {}
+    stats = {}
+    try:
+        with open(cache_map_v2_path, 'r') as f:
+            cache_map_v2 = json.load(f)
+        entries = [(path, entry) for path, entry in cache_map_v2.items()
+                   if isinstance(entry, dict) and entry.get('modifiedTime') == cache_map.get(path)]
+    except (OSError, ValueError, AttributeError):
+        return content_md5s, stats
+    for path, entry in entries:
+        if entry.get('contentMd5'):
+            content_md5s[path] = entry['contentMd5']
+        try:
+            stats[path] = (int(entry['modifiedTimeNs']), int(entry['size']))
+        except (TypeError, KeyError, ValueError):
+            continue
+    return content_md5s, stats
+
+
+def _get_size(path: str) -> typing.Optional[int]:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
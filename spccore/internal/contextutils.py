@@ -0,0 +1,18 @@
+import contextlib
+
+"""
+Helpers for context managers.
+
+Example::
+
+    with progress if progress is not None else _null_context():
+        ...
+"""
+
+
+def _null_context():
+    """
+    :return: a context manager that does nothing, for the with statements whose context manager is optional.
+        contextlib.nullcontext needs Python 3.7; contextlib.suppress() without exception types does nothing.
+    """
+    return contextlib.suppress()
@@ -0,0 +1,203 @@
+import collections
+import concurrent.futures
+import hashlib
+import os
+import threading
+import typing
+
+from spccore.constants import *
+from .pathutils import memory_map, normalize_path
+
+"""
+A process wide service that computes the MD5 digests of local files, shared by the upload engine and the cache.
+
+Digests are remembered by path, size and modification time, so an unmodified file is hashed once however many times
+its digest is asked for: a file the cache compared with a remote file is not hashed again to be uploaded.
+
+The MD5 of a whole file can only be computed from its first byte to its last, but the MD5s of its parts are
+independent of each other. While the calling thread feeds the parts to the digest of the whole file, a pool of threads
+computes the digests of the parts; hashlib releases the GIL while it hashes large buffers, so both run on separate
+cores and the file is read once. Many files are hashed at once by the same kind of pool of threads. A pool of
+processes would fork a process that holds live threads, whose locks the child may inherit held and deadlock on.
+
+Example::
+
+    hashing_service = get_hashing_service()
+    content_md5, part_md5s = hashing_service.md5s_of_file(path, part_size)
+    md5s = hashing_service.md5_of_files(paths)
+"""
+
+_FileKey = typing.Tuple[str, int, int]
+
+
+class _Digests:
+    """The digests of one version of a file: the MD5 of the content, and the MD5s of its parts for each part size"""
+
+    __slots__ = ('content_md5', 'part_md5s')
+
+    def __init__(self):
+        self.content_md5 = None
+        self.part_md5s = {}
+
+
+class HashingService:
+    """
+    Implements a thread safe, remembering MD5 service for local files
+    """
+
+    def __init__(self,
+                 *,
+                 max_threads: int = HASHING_MAX_THREADS,
+                 max_remembered_files: int = HASHING_MAX_REMEMBERED_FILES
+                 ) -> None:
+        """
+        :param max_threads: the max number of parts, or of files by md5_of_files(), hashed at the same time
+        :param max_remembered_files: the max number of files whose digests are remembered, the least recently used
+            are forgotten first
+        """
+        self.max_threads = max_threads
+        self.max_remembered_files = max_remembered_files
+        self._digests = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def md5_of_file(self, path: str) -> str:
+        """
+        :param path: the path to the file
+        :return: the MD5 hex digest of the content of the file
+        """
+        key = _file_key(path)
+        content_md5 = self._recall(key).content_md5
+        if content_md5 is None:
+            content_md5 = _md5_of_path(path)
+            self._remember(key, content_md5=content_md5)
+        return content_md5
+
+    def md5s_of_file(self, path: str, part_size: int) -> typing.Tuple[str, typing.List[str]]:
+        """
+        Compute the MD5 of a file and the MD5s of its parts in a single read of the file.
+        An empty file has a single empty part.
+
+        :param path: the path to the file
+        :param part_size: the size of each part but the last
+        :return: the MD5 hex digest of the content, and the MD5 hex digests of the parts in order
+        """
+        key = _file_key(path)
+        digests = self._recall(key)
+        content_md5 = digests.content_md5
+        part_md5s = digests.part_md5s.get(part_size)
+        if content_md5 is not None and part_md5s is not None:
+            return content_md5, part_md5s
+
+        content_digest = hashlib.md5() if content_md5 is None else None
+        # bounds the parts read ahead of the pool, for files that cannot be mapped
+        read_ahead = threading.BoundedSemaphore(2 * self.max_threads)
+        futures = []
+        with open(path, 'rb') as f, memory_map(f) as mapped, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+            for part in _iter_parts(f, mapped, part_size):
+                if content_digest is not None:
+                    content_digest.update(part)
+                read_ahead.acquire()
+                future = executor.submit(_md5_hex, part)
+                future.add_done_callback(lambda _: read_ahead.release())
+                futures.append(future)
+            part_md5s = [future.result() for future in futures]
+        if content_digest is not None:
+            content_md5 = content_digest.hexdigest()
+        self._remember(key, content_md5=content_md5, part_size=part_size, part_md5s=part_md5s)
+        return content_md5, part_md5s
+
+    def md5_of_files(self, paths: typing.Sequence[str]) -> typing.List[str]:
+        """
+        Compute the MD5s of many files, the files that were not hashed yet in a pool of threads
+
+        :param paths: the paths to the files
+        :return: the MD5 hex digests of the content of the files, in the order of paths
+        """
+        keys = [_file_key(path) for path in paths]
+        md5s = [self._recall(key).content_md5 for key in keys]
+        missing = [index for index, md5 in enumerate(md5s) if md5 is None]
+        if len(missing) > 1 and self.max_threads > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_threads, len(missing))) as executor:
+                computed = list(executor.map(_md5_of_path, [paths[index] for index in missing]))
+        else:
+            computed = [_md5_of_path(paths[index]) for index in missing]
+        for index, md5 in zip(missing, computed):
+            md5s[index] = md5
+            self._remember(keys[index], content_md5=md5)
+        return md5s
+
+    def _recall(self, key: _FileKey) -> _Digests:
+        with self._lock:
+            digests = self._digests.get(key)
+            if digests is None:
+                return _Digests()
+            self._digests.move_to_end(key)
+            return digests
+
+    def _remember(self,
+                  key: _FileKey,
+                  *,
+                  content_md5: str,
+                  part_size: int = None,
+                  part_md5s: typing.List[str] = None
+                  ) -> None:
+        with self._lock:
+            digests = self._digests.get(key)
+            if digests is None:
+                digests = self._digests[key] = _Digests()
+            self._digests.move_to_end(key)
+            digests.content_md5 = content_md5
+            if part_size is not None:
+                digests.part_md5s[part_size] = part_md5s
+            while len(self._digests) > self.max_remembered_files:
+                self._digests.popitem(last=False)
+
+
+def _file_key(path: str) -> _FileKey:
+    stat = os.stat(path)
+    return normalize_path(path), stat.st_size, stat.st_mtime_ns
+
+
+def _iter_parts(f: typing.BinaryIO, mapped, part_size: int) -> typing.Iterator[typing.Union[bytes, memoryview]]:
+    """
+    :return: an iterator over the parts of a file, memoryview slices of the mapping when the file is mapped
+    """
+    if mapped is None:
+        part = f.read(part_size)
+        yield part
+        while len(part) == part_size:
+            part = f.read(part_size)
+            if part:
+                yield part
+        return
+    view = memoryview(mapped)
+    for start in range(0, len(mapped), part_size):
+        yield view[start:start + part_size]
+
+
+def _md5_hex(data: typing.Union[bytes, memoryview]) -> str:
+    return hashlib.md5(data).hexdigest()
+
+
+def _md5_of_path(path: str) -> str:
+    """
+    Hash a file from a memory mapping, or chunk by chunk when it cannot be mapped
+    """
+    with open(path, 'rb') as f, memory_map(f) as mapped:
+        if mapped is not None:
+            return hashlib.md5(mapped).hexdigest()
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: f.read(HASHING_CHUNK_SIZE_BYTES), b''):
+            md5.update(chunk)
+        return md5.hexdigest()
+
+
+_hashing_service = HashingService()
+
+
+def get_hashing_service() -> HashingService:
+    """
+    :return: the hashing service shared by every client of this process
+    """
+    return _hashing_service
@@ -1,6 +1,8 @@
 import errno
 import os
 import shutil
+import socket
+import uuid
 
 from spccore.internal.timeutils import *
 from spccore.internal.dozer import *
@@ -25,12 +27,22 @@ Example::
 
 Since both user1 and user2 are using the same lock "foo", while user1 is holding the lock, the user2 will wait.
 Therefore, {do something} and {do something else} will be executed in sequential.
+
+A SharedLock of the same name is held by any number of readers at the same time, but never together with the Lock.
+Each reader holds a file of its own in the <name>.readers directory. A writer makes the <name>.lock directory first,
+then waits for the readers to leave; readers do not enter while that directory exists, so writers are never starved.
+
+Example::
+    with SharedLock("foo"):
+        // read, while other readers of "foo" may read too
 """
 
 LOCK_DEFAULT_MAX_AGE = datetime.timedelta(seconds=10)
 DEFAULT_BLOCKING_TIMEOUT = datetime.timedelta(seconds=70)
 CACHE_UNLOCK_WAIT_TIME_SEC = 0.5
 LOCK_FILE_SUFFIX = 'lock'
+LOCK_READERS_DIR_SUFFIX = 'readers'
+LOCK_SHARED_WAIT_TIME_SEC = 0.01
 LOCK_UPDATE_WAIT_TIME_SEC = 0.001
 
 
@@ -82,7 +94,10 @@ class Lock(object):
         try_lock_start_time = time.time()
         while time.time() - try_lock_start_time < timeout.total_seconds():
             if self._acquire_lock(break_old_locks=break_old_locks):
-                return True
+                if self._wait_for_readers(try_lock_start_time, timeout):
+                    return True
+                self.release()
+                break
             else:
                 doze(CACHE_UNLOCK_WAIT_TIME_SEC)
         raise LockException("Could not obtain a lock on the file cache within timeout: {timeout}."
@@ -163,6 +178,25 @@ class Lock(object):
                 return False
         return self._has_lock()
 
+    @property
+    def readers_dir_path(self) -> str:
+        """The directory holding a file for each holder of a SharedLock of the same name"""
+        return os.path.join(self.current_working_directory, ".".join([self.name, LOCK_READERS_DIR_SUFFIX]))
+
+    def _wait_for_readers(self, try_lock_start_time: float, timeout: datetime.timedelta) -> bool:
+        """
+        Hold the lock until the holders of SharedLocks of the same name leave. No reader enters meanwhile.
+
+        :return: True when the readers left within timeout; otherwise False.
+        """
+        while _has_fresh_readers(self.readers_dir_path, self.max_age):
+            if time.time() - try_lock_start_time >= timeout.total_seconds():
+                return False
+            doze(LOCK_SHARED_WAIT_TIME_SEC)
+            # a writer waiting longer than max_age must not look abandoned
+            self._update_lock_time()
+        return True
+
     def _update_lock_time(self):
         """
         Update the lock time of the given lock
@@ -182,3 +216,145 @@ class Lock(object):
 
     def __exit__(self, exc_type, exc_value, traceback) -> None:
         self.release()
+
+
+class SharedLock(Lock):
+    """
+    Implements the shared side of a reader-writer lock: any number of SharedLocks of the same name are held at the
+    same time, but not while a Lock of that name is held or being acquired, which gives writers the preference.
+
+    A reader holds a file named after its host, process and a random ID in the <name>.readers directory, so the lock
+    works across processes and hosts sharing the file system. Files older than max_age are left by readers that died
+    and are removed by writers.
+    """
+
+    def __init__(self,
+                 name: str,
+                 *,
+                 current_working_directory: str = None,
+                 max_age: datetime.timedelta = LOCK_DEFAULT_MAX_AGE,
+                 default_blocking_timeout: datetime.timedelta = DEFAULT_BLOCKING_TIMEOUT
+                 ) -> None:
+        """
+        :param name: the name of the lock, shared with the Lock it excludes
+        :param current_working_directory: the parent directory of the lock.
+        :param max_age: the max time one thread can hold a lock.
+        :param default_blocking_timeout: the time one thread will wait and try to acquire the lock.
+        """
+        super().__init__(name,
+                         current_working_directory=current_working_directory,
+                         max_age=max_age,
+                         default_blocking_timeout=default_blocking_timeout)
+        self.reader_file_path = os.path.join(self.readers_dir_path, "{}.{}.{}".format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex))
+
+    def release(self) -> None:
+        """
+        Release lock or do nothing if lock is not held
+
+        :raises OSError: when it fails to release a lock
+        """
+        if self._has_lock():
+            _remove_reader_file(self.reader_file_path)
+            try:
+                # leaves no empty directory behind the last reader
+                os.rmdir(self.readers_dir_path)
+            except OSError:
+                pass
+
+    def _has_lock(self) -> bool:
+        if self.last_updated_time is None:
+            return False
+        try:
+            return from_epoch_time_to_iso(os.path.getmtime(self.reader_file_path)) == self.last_updated_time
+        except OSError:
+            return False
+
+    def _get_age(self) -> int:
+        try:
+            return time.time() - os.path.getmtime(self.reader_file_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT and err.errno != errno.EACCES:
+                raise
+        return 0
+
+    def _acquire_lock(self, *, break_old_locks: bool = True) -> bool:
+        """
+        Attempt to acquire lock: enter unless a writer holds or is acquiring the lock.
+
+        :param break_old_locks: set to False to also wait for writer locks older than max_age. Default True.
+        :return: True on success; otherwise False.
+        :raises OSError: when it fails to acquire a lock
+        """
+        if self.renew():
+            return True
+        if self._writer_present(break_old_locks):
+            return False
+        os.makedirs(self.readers_dir_path, exist_ok=True)
+        try:
+            with open(self.reader_file_path, 'w'):
+                pass
+        except FileNotFoundError:
+            # the last reader removed the directory meanwhile
+            return False
+        self._update_lock_time()
+        # a writer that made its directory after the check above has not seen this reader yet, or is waiting for it
+        if self._writer_present(break_old_locks):
+            _remove_reader_file(self.reader_file_path)
+            return False
+        return self._has_lock()
+
+    def _wait_for_readers(self, try_lock_start_time: float, timeout: datetime.timedelta) -> bool:
+        # readers do not exclude each other
+        return True
+
+    def _writer_present(self, break_old_locks: bool) -> bool:
+        try:
+            age = time.time() - os.path.getmtime(self.lock_dir_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return False
+        # a writer lock older than max_age was abandoned, and the next writer will break it
+        return not break_old_locks or age <= self.max_age.total_seconds()
+
+    def _update_lock_time(self):
+        time.sleep(LOCK_UPDATE_WAIT_TIME_SEC)
+        update_time = time.time()
+        os.utime(self.reader_file_path, (0, update_time))
+        self.last_updated_time = from_epoch_time_to_iso(update_time)
+
+
+def _has_fresh_readers(readers_dir_path: str, max_age: datetime.timedelta) -> bool:
+    """
+    Check for SharedLock holders, and remove the files of the readers that did not renew within max_age
+
+    :return: True when at least one reader holds the lock
+    """
+    try:
+        reader_files = os.listdir(readers_dir_path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return False
+    has_fresh_readers = False
+    for reader_file in reader_files:
+        reader_file_path = os.path.join(readers_dir_path, reader_file)
+        try:
+            age = time.time() - os.path.getmtime(reader_file_path)
+        except OSError:
+            # the reader left
+            continue
+        if age <= max_age.total_seconds():
+            has_fresh_readers = True
+        else:
+            _remove_reader_file(reader_file_path)
+    return has_fresh_readers
+
+
+def _remove_reader_file(reader_file_path: str) -> None:
+    try:
+        os.remove(reader_file_path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
@@ -1,10 +1,23 @@
+import contextlib
+import errno
 import math
+import mmap
 import os
 import re
+import shutil
 import typing
 
 from spccore.internal.timeutils import *
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# ioctl request code that asks the file system to share the source's extents with the destination
+FICLONE = 0x40049409
+MATERIALIZE_TEMP_FILE_SUFFIX = '.synapse_materialize'
+
 
 # To be compatible with R
 def normalize_path(path: str) -> typing.Optional[str]:
@@ -26,3 +39,129 @@ def get_modified_time(path: str) -> typing.Optional[int]:
     if os.path.exists(path):
         return os.path.getmtime(path)
     return None
+
+
+def materialize_file(source: str, destination: str, *, hardlink: bool = False) -> None:
+    """
+    Make destination hold the same content as source without downloading it again.
+    A reflink (copy-on-write clone) is attempted first, then a regular copy. Both leave destination an independent
+    file. With hardlink, a hardlink is attempted before them; source and destination then share one inode, so writing
+    to either changes both.
+    The destination is replaced atomically, so readers never see a partially written file.
+
+    :param source: the path to an existing file
+    :param destination: the path to create or replace
+    :param hardlink: set to True to try a hardlink first. Default False.
+    :raises OSError: when the content could not be materialized
+    """
+    directory = os.path.dirname(os.path.abspath(destination))
+    os.makedirs(directory, exist_ok=True)
+    temp_path = destination + MATERIALIZE_TEMP_FILE_SUFFIX
+    remove_if_exists(temp_path)
+    try:
+        strategies = (os.link, _reflink, shutil.copyfile) if hardlink else (_reflink, shutil.copyfile)
+        for strategy in strategies:
+            try:
+                strategy(source, temp_path)
+                break
+            except OSError:
+                remove_if_exists(temp_path)
+                if strategy is shutil.copyfile:
+                    raise
+        os.replace(temp_path, destination)
+    except OSError:
+        remove_if_exists(temp_path)
+        raise
+
+
+def link_file(source: str, destination: str) -> None:
+    """
+    Replace destination with a hardlink to source, atomically, so both paths share the storage of one file.
+
+    :param source: the path to an existing file
+    :param destination: the path to an existing file on the same file system
+    :raises OSError: when the link could not be made, for example across file systems
+    """
+    temp_path = destination + MATERIALIZE_TEMP_FILE_SUFFIX
+    remove_if_exists(temp_path)
+    try:
+        os.link(source, temp_path)
+        os.replace(temp_path, destination)
+    except OSError:
+        remove_if_exists(temp_path)
+        raise
+
+
+def get_free_disk_space(path: str) -> typing.Tuple[int, int]:
+    """
+    Find the file system a path is, or would be, created on and the space left on it.
+
+    :param path: a directory, which does not have to exist yet
+    :return: the (device ID, free bytes) of the file system of the closest existing ancestor of path
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev, shutil.disk_usage(path).free
+
+
+def preallocate_file(f: typing.BinaryIO, size: int) -> None:
+    """
+    Reserve size bytes on disk for a file that is about to be written, so the writes do not fragment the file.
+    The file size becomes size; truncate the file at the last byte written if fewer bytes end up being written.
+    Does nothing on platforms and file systems that cannot preallocate.
+
+    :param f: the file opened for writing
+    :param size: the number of bytes to reserve
+    :raises OSError: when the file system does not have size bytes left
+    """
+    if size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as error:
+        if error.errno == errno.ENOSPC:
+            raise
+
+
+@contextlib.contextmanager
+def memory_map(f: typing.BinaryIO) -> typing.Iterator[typing.Optional[mmap.mmap]]:
+    """
+    Map a file read-only for the duration of the block
+
+    :param f: the file opened for reading
+    :return: the mapping, or None for files that cannot be mapped, such as empty files
+    """
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        mapped = None
+    try:
+        yield mapped
+    finally:
+        if mapped is not None:
+            try:
+                mapped.close()
+            except BufferError:
+                # a slice is still referenced somewhere; the mapping is released with the last reference
+                pass
+
+
+def _reflink(source: str, destination: str) -> None:
+    """
+    Clone source into destination by sharing the underlying blocks (btrfs, XFS)
+
+    :raises OSError: when the platform or the file system does not support reflinks
+    """
+    if fcntl is None:
+        raise OSError("reflink is not supported on this platform")
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def remove_if_exists(path: str) -> None:
+    """Remove the file identified by path, doing nothing when it does not exist"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
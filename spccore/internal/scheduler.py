@@ -0,0 +1,182 @@
+import contextlib
+import threading
+import time
+import typing
+
+from spccore.constants import *
+
+"""
+A process wide scheduler shared by every upload and download.
+
+Each transfer submits its parts through a channel of a priority class. The scheduler bounds the number of parts in
+flight across all transfers and, when a cap is set, the bytes per second they transfer together. Whenever parts of
+a higher priority class are waiting, parts of lower classes wait too, so a background sync cannot starve the
+transfer a user is waiting on.
+
+Example::
+
+    scheduler = get_transfer_scheduler()
+    scheduler.max_bytes_per_second = 10 * 1024 * 1024
+    channel = scheduler.channel(TRANSFER_PRIORITY_BULK)
+    channel.throttle(len(data))
+    with channel.slot():
+        upload(data)
+"""
+
+
+class TransferScheduler:
+    """
+    Implements a thread safe limit on the parts in flight and a token bucket on the bandwidth, both served by priority
+    """
+
+    def __init__(self,
+                 *,
+                 max_in_flight_parts: typing.Optional[int] = DEFAULT_TRANSFER_MAX_IN_FLIGHT_PARTS,
+                 max_bytes_per_second: typing.Optional[float] = None
+                 ) -> None:
+        """
+        :param max_in_flight_parts: the max number of parts transferred at the same time. Set to None for no limit.
+        :param max_bytes_per_second: the max aggregate bandwidth. Default None, no cap.
+        """
+        self._condition = threading.Condition()
+        self._max_in_flight_parts = max_in_flight_parts
+        self._max_bytes_per_second = max_bytes_per_second
+        self._in_flight_parts = 0
+        self._waiting_for_slot = {priority: 0 for priority in TRANSFER_PRIORITIES}
+        self._waiting_for_bandwidth = {priority: 0 for priority in TRANSFER_PRIORITIES}
+        self._tokens = 0.0
+        self._refilled_at = time.monotonic()
+
+    @property
+    def max_in_flight_parts(self) -> typing.Optional[int]:
+        return self._max_in_flight_parts
+
+    @max_in_flight_parts.setter
+    def max_in_flight_parts(self, value: typing.Optional[int]) -> None:
+        if value is not None and value < 1:
+            raise ValueError("max_in_flight_parts must be at least 1.")
+        with self._condition:
+            self._max_in_flight_parts = value
+            self._condition.notify_all()
+
+    @property
+    def max_bytes_per_second(self) -> typing.Optional[float]:
+        return self._max_bytes_per_second
+
+    @max_bytes_per_second.setter
+    def max_bytes_per_second(self, value: typing.Optional[float]) -> None:
+        if value is not None and value <= 0:
+            raise ValueError("max_bytes_per_second must be positive.")
+        with self._condition:
+            self._refill()
+            self._max_bytes_per_second = value
+            self._condition.notify_all()
+
+    @property
+    def in_flight_parts(self) -> int:
+        """The number of parts being transferred"""
+        return self._in_flight_parts
+
+    def channel(self, priority: str) -> 'TransferChannel':
+        """
+        :param priority: one of TRANSFER_PRIORITIES
+        :return: the channel transfers of this priority submit their parts through
+        """
+        if priority not in TRANSFER_PRIORITIES:
+            raise ValueError("priority must be one of {}.".format(TRANSFER_PRIORITIES))
+        return TransferChannel(self, priority)
+
+    @contextlib.contextmanager
+    def slot(self, priority: str) -> typing.Iterator[None]:
+        """
+        Hold one of the in flight slots while the block runs. Waits until a slot is free and no part of a higher
+        priority is waiting for one.
+
+        :param priority: one of TRANSFER_PRIORITIES
+        """
+        with self._condition:
+            self._waiting_for_slot[priority] += 1
+            try:
+                while (self._max_in_flight_parts is not None
+                       and self._in_flight_parts >= self._max_in_flight_parts) \
+                        or self._is_preempted(self._waiting_for_slot, priority):
+                    self._condition.wait()
+            finally:
+                self._waiting_for_slot[priority] -= 1
+            self._in_flight_parts += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight_parts -= 1
+                self._condition.notify_all()
+
+    def throttle(self, number_of_bytes: int, priority: str) -> None:
+        """
+        Wait until number_of_bytes may be transferred under the bandwidth cap. The bucket holds at most one second of
+        bandwidth; a request larger than the tokens available takes them all and leaves a debt the next requests wait
+        out, so the average rate stays within the cap.
+
+        :param number_of_bytes: the number of bytes about to be transferred
+        :param priority: one of TRANSFER_PRIORITIES
+        """
+        with self._condition:
+            self._waiting_for_bandwidth[priority] += 1
+            try:
+                while True:
+                    self._refill()
+                    if self._max_bytes_per_second is None:
+                        return
+                    if self._tokens > 0 and not self._is_preempted(self._waiting_for_bandwidth, priority):
+                        self._tokens -= number_of_bytes
+                        return
+                    # woken up early when the cap changes or a higher priority request is served
+                    self._condition.wait(max(-self._tokens, 1) / self._max_bytes_per_second)
+            finally:
+                self._waiting_for_bandwidth[priority] -= 1
+                self._condition.notify_all()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self._max_bytes_per_second is not None:
+            self._tokens = min(self._max_bytes_per_second,
+                               self._tokens + (now - self._refilled_at) * self._max_bytes_per_second)
+        self._refilled_at = now
+
+    @staticmethod
+    def _is_preempted(waiting: typing.Dict[str, int], priority: str) -> bool:
+        higher_priorities = TRANSFER_PRIORITIES[:TRANSFER_PRIORITIES.index(priority)]
+        return any(waiting[higher_priority] for higher_priority in higher_priorities)
+
+
+class TransferChannel:
+    """
+    The view of a TransferScheduler for the transfers of one priority class
+    """
+
+    def __init__(self, scheduler: TransferScheduler, priority: str) -> None:
+        self.scheduler = scheduler
+        self.priority = priority
+
+    def __eq__(self, other):
+        return isinstance(other, TransferChannel) \
+            and self.scheduler is other.scheduler and self.priority == other.priority
+
+    def __hash__(self):
+        return hash((id(self.scheduler), self.priority))
+
+    def slot(self):
+        return self.scheduler.slot(self.priority)
+
+    def throttle(self, number_of_bytes: int) -> None:
+        self.scheduler.throttle(number_of_bytes, self.priority)
+
+
+_transfer_scheduler = TransferScheduler()
+
+
+def get_transfer_scheduler() -> TransferScheduler:
+    """
+    :return: the scheduler shared by every client of this process
+    """
+    return _transfer_scheduler
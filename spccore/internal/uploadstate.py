@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+
+from .pathutils import normalize_path, remove_if_exists
+
+"""
+The state of the multipart upload of a local file, persisted so that a later run can resume the upload after the
+process died.
+
+Each file being uploaded has a state file in the state directory, named after the hash of its normalized path. It
+holds the size and modification time of the file when the upload started, the MD5 of its content, the part size and
+the upload ID. The parts Synapse already accepted are not recorded: resuming the upload returns them in its
+partsState, so only the missing parts are read, hashed and sent again.
+
+A state is only used again while the size and modification time of the file are unchanged, which also spares
+hashing the whole file a second time.
+
+Example::
+
+    state = UploadState.load(state_dir, path)
+    if state.upload_id is None:
+        state.begin(content_md5, part_size, upload_id)
+    ...
+    state.remove()
+"""
+
+UPLOAD_STATE_FILE_SUFFIX = '.upload'
+
+
+class UploadState:
+    """
+    Implements the persisted state of the multipart upload of a local file
+    """
+
+    def __init__(self, state_path: str, *, size: int, modified_time_ns: int) -> None:
+        """
+        :param state_path: the path to the state file
+        :param size: the size of the file being uploaded
+        :param modified_time_ns: the modification time of the file being uploaded, in nanoseconds
+        """
+        self.state_path = state_path
+        self.size = size
+        self.modified_time_ns = modified_time_ns
+        self.content_md5 = None
+        self.part_size = None
+        self.upload_id = None
+
+    @classmethod
+    def load(cls, state_dir: str, path: str) -> 'UploadState':
+        """
+        Read the state of the upload of a file. A state recorded for another size or modification time of the file,
+        or that cannot be read, is discarded.
+
+        :param state_dir: the directory holding the state files
+        :param path: the path to the file being uploaded
+        :return: the recorded state, or an empty state
+        """
+        stat = os.stat(path)
+        state_name = hashlib.sha1(normalize_path(path).encode('utf-8')).hexdigest() + UPLOAD_STATE_FILE_SUFFIX
+        state = cls(os.path.join(state_dir, state_name), size=stat.st_size, modified_time_ns=stat.st_mtime_ns)
+        try:
+            with open(state.state_path, 'r') as f:
+                header = json.loads(f.readline())
+                if (header['size'], header['modifiedTimeNs']) != (state.size, state.modified_time_ns):
+                    raise ValueError("the file changed since the upload started")
+                state.content_md5 = header['contentMd5']
+                state.part_size = header['partSize']
+                state.upload_id = header['uploadId']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError):
+            remove_if_exists(state.state_path)
+            state = cls(state.state_path, size=stat.st_size, modified_time_ns=stat.st_mtime_ns)
+        return state
+
+    def begin(self, content_md5: str, part_size: int, upload_id: str) -> None:
+        """
+        Record the upload the file is sent with. Nothing is written when the state already records this upload.
+
+        :param content_md5: the MD5 hex digest of the content of the file
+        :param part_size: the part size of the upload
+        :param upload_id: the ID of the multipart upload
+        """
+        if (self.content_md5, self.part_size, self.upload_id) == (content_md5, part_size, upload_id):
+            return
+        self.content_md5 = content_md5
+        self.part_size = part_size
+        self.upload_id = upload_id
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path, 'w') as f:
+            f.write(json.dumps({'size': self.size,
+                                'modifiedTimeNs': self.modified_time_ns,
+                                'contentMd5': content_md5,
+                                'partSize': part_size,
+                                'uploadId': upload_id}) + '\n')
+
+    def remove(self) -> None:
+        """
+        Drop the state once the upload is complete
+        """
+        remove_if_exists(self.state_path)
@@ -0,0 +1,191 @@
+import collections
+import datetime
+import threading
+import time
+import typing
+import urllib.parse as urllib_parse
+
+from spccore.constants import *
+
+"""
+A cache of presigned URLs keyed by (file handle ID, associated object ID, associated object type).
+
+Presigned URLs stay valid for a while after Synapse issues them. Instead of asking Synapse for a new URL for every
+attempt, the transfer engine asks this cache, which reuses a URL until shortly before it expires and then refreshes
+it, together with every other URL of a pending download that is about to expire, in a single batch request.
+
+A key is pending from the time its URL is fetched until the transfer engine releases it once its download completes.
+Released and expired URLs are dropped, and the cache holds at most max_entries URLs, so its memory stays bounded
+however many files a client downloads.
+
+Example::
+
+    url_cache = PresignedUrlCache(fetch_file_results)
+    url_cache.prefetch([(123, "syn456", "FileEntity")])
+    url = url_cache.get((123, "syn456", "FileEntity"))['preSignedURL']
+    ...
+    url_cache.release([(123, "syn456", "FileEntity")])
+"""
+
+PRESIGNED_URL_EXPIRY_MARGIN = datetime.timedelta(seconds=60)
+PRESIGNED_URL_DEFAULT_TIME_TO_LIVE = datetime.timedelta(minutes=5)
+PRESIGNED_URL_CACHE_MAX_ENTRIES = 10 * SYNAPSE_FILE_HANDLE_BATCH_MAX_SIZE
+AWS_V4_DATE_FORMAT = "%Y%m%dT%H%M%SZ"
+
+PresignedUrlKey = typing.Tuple[int, str, str]
+
+
+class PresignedUrlCache:
+    """
+    Implements a thread safe, expiry-aware cache of the FileResults returned by the file handle batch request
+    """
+
+    def __init__(self,
+                 fetch_file_results: typing.Callable[[typing.Sequence[PresignedUrlKey]],
+                                                     typing.Dict[PresignedUrlKey, dict]],
+                 *,
+                 expiry_margin: datetime.timedelta = PRESIGNED_URL_EXPIRY_MARGIN,
+                 default_time_to_live: datetime.timedelta = PRESIGNED_URL_DEFAULT_TIME_TO_LIVE,
+                 batch_size: int = SYNAPSE_FILE_HANDLE_BATCH_MAX_SIZE,
+                 max_entries: int = PRESIGNED_URL_CACHE_MAX_ENTRIES
+                 ) -> None:
+        """
+        :param fetch_file_results: the function that requests FileResults from Synapse for at most batch_size keys
+        :param expiry_margin: URLs that expire within this margin are refreshed before they are used
+        :param default_time_to_live: the validity assumed for URLs whose expiry cannot be read from the URL
+        :param batch_size: the max number of keys per fetch_file_results call
+        :param max_entries: the max number of URLs and of pending keys held, the oldest are dropped first
+        """
+        self._fetch_file_results = fetch_file_results
+        self.expiry_margin = expiry_margin
+        self.default_time_to_live = default_time_to_live
+        self.batch_size = batch_size
+        self.max_entries = max_entries
+        # key -> (FileResult, expiry in epoch seconds), the oldest fetch first
+        self._entries = collections.OrderedDict()
+        # the keys whose downloads have not completed, as keys of an ordered set
+        self._pending = collections.OrderedDict()
+        self._entries_lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+
+    def get(self, key: PresignedUrlKey) -> dict:
+        """
+        Return a FileResult whose presigned URL is valid for at least the expiry margin. The key becomes pending.
+        When the URL has to be refreshed, the URLs of the other pending keys that are about to expire, or expired,
+        are refreshed in the same batch request.
+
+        :param key: the (file handle ID, associated object ID, associated object type) to look up
+        :return: the FileResult for the key
+        """
+        with self._entries_lock:
+            self._add_pending([key])
+        file_result = self._get_fresh(key)
+        if file_result is not None:
+            return file_result
+        with self._fetch_lock:
+            # another thread may have refreshed the key while this one was waiting
+            file_result = self._get_fresh(key)
+            if file_result is not None:
+                return file_result
+            soon = time.time() + 2 * self.expiry_margin.total_seconds()
+            with self._entries_lock:
+                expiring = [k for k in self._pending
+                            if k != key and (k not in self._entries or self._entries[k][1] <= soon)]
+            return self._fetch([key] + expiring[:self.batch_size - 1])[key]
+
+    def prefetch(self, keys: typing.Iterable[PresignedUrlKey]) -> None:
+        """
+        Make sure the cache holds a valid URL for each key, fetching the missing and stale ones in batches.
+        The keys become pending.
+
+        :param keys: the keys that are about to be used
+        """
+        keys = list(collections.OrderedDict.fromkeys(keys))
+        with self._entries_lock:
+            self._add_pending(keys)
+        with self._fetch_lock:
+            missing = [key for key in keys if self._get_fresh(key) is None]
+            for start in range(0, len(missing), self.batch_size):
+                self._fetch(missing[start:start + self.batch_size])
+
+    def invalidate(self, key: PresignedUrlKey) -> None:
+        """
+        Drop the URL of a key, for example after the storage provider rejected it
+
+        :param key: the key to drop
+        """
+        with self._entries_lock:
+            self._entries.pop(key, None)
+
+    def release(self, keys: typing.Iterable[PresignedUrlKey]) -> None:
+        """
+        Drop the URLs of keys whose downloads completed, so they are neither held nor refreshed any more
+
+        :param keys: the keys to release
+        """
+        with self._entries_lock:
+            for key in keys:
+                self._pending.pop(key, None)
+                self._entries.pop(key, None)
+
+    def _get_fresh(self, key: PresignedUrlKey) -> typing.Optional[dict]:
+        now = time.time()
+        with self._entries_lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= now:
+                # an expired URL is of no use to anyone
+                del self._entries[key]
+        if entry is None or entry[1] - self.expiry_margin.total_seconds() <= now:
+            return None
+        return entry[0]
+
+    def _add_pending(self, keys: typing.Iterable[PresignedUrlKey]) -> None:
+        """Must be called holding the entries lock"""
+        for key in keys:
+            self._pending[key] = None
+            self._pending.move_to_end(key)
+        while len(self._pending) > self.max_entries:
+            self._pending.popitem(last=False)
+
+    def _fetch(self, keys: typing.Sequence[PresignedUrlKey]) -> typing.Dict[PresignedUrlKey, dict]:
+        fetched_time = time.time()
+        file_results = self._fetch_file_results(keys)
+        default_expiry = fetched_time + self.default_time_to_live.total_seconds()
+        fetched = {}
+        with self._entries_lock:
+            for key in keys:
+                file_result = file_results.get(key)
+                if file_result is None:
+                    file_result = {'fileHandleId': str(key[0]), 'failureCode': 'NOT_FOUND'}
+                url = file_result.get('preSignedURL')
+                expiry = get_presigned_url_expiry(url) if url else None
+                fetched[key] = file_result
+                self._entries[key] = (file_result, default_expiry if expiry is None else expiry)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return fetched
+
+
+def get_presigned_url_expiry(url: str) -> typing.Optional[float]:
+    """
+    Read the expiry of a presigned URL from its query string.
+    Supports AWS and Google Cloud Storage V4 signatures (X-Amz-Date/X-Amz-Expires, X-Goog-Date/X-Goog-Expires) and
+    V2 signatures (Expires).
+
+    :param url: the presigned URL
+    :return: the expiry in epoch seconds, or None when the URL does not carry one
+    """
+    query = {name.lower(): value
+             for name, value in urllib_parse.parse_qsl(urllib_parse.urlparse(url).query)}
+    try:
+        for prefix in ('x-amz-', 'x-goog-'):
+            if prefix + 'date' in query and prefix + 'expires' in query:
+                signed_at = datetime.datetime.strptime(query[prefix + 'date'], AWS_V4_DATE_FORMAT)
+                signed_at = signed_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+                return signed_at + int(query[prefix + 'expires'])
+        if 'expires' in query:
+            return float(query['expires'])
+    except ValueError:
+        pass
+    return None
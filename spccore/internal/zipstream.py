@@ -0,0 +1,165 @@
+import struct
+import typing
+import zipfile
+import zlib
+
+"""
+A reader for zip archives that arrive as a stream of bytes.
+
+zipfile.ZipFile reads the central directory at the end of the archive first, so it needs a seekable file. This
+reader walks the local file headers from the start of the archive instead, so each member can be extracted while the
+archive is still being received and the archive itself never has to be stored.
+
+Only the features of the archives Synapse packages are supported: stored members with their sizes in the local
+header, deflated members, and data descriptors after deflated members. Encrypted members and zip64 sizes are not.
+
+Example::
+
+    for name, chunks in iter_zip_members(response.iter_content(chunk_size=1024 * 1024)):
+        with open(name, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+"""
+
+ZIP_LOCAL_FILE_HEADER_SIGNATURE = b'PK\x03\x04'
+ZIP_DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+# signature, version, flags, method, time, date, crc32, compressed size, size, name length, extra field length
+ZIP_LOCAL_FILE_HEADER = struct.Struct('<4sHHHHHIIIHH')
+ZIP_DATA_DESCRIPTOR = struct.Struct('<III')
+ZIP_FLAG_ENCRYPTED = 0x1
+ZIP_FLAG_DATA_DESCRIPTOR = 0x8
+ZIP_FLAG_UTF8 = 0x800
+ZIP_ZIP64_SIZE = 0xFFFFFFFF
+ZIP_READ_SIZE = 64 * 1024
+
+
+def iter_zip_members(chunks: typing.Iterable[bytes]) -> typing.Iterator[typing.Tuple[str, typing.Iterator[bytes]]]:
+    """
+    Walk the members of a zip archive in the order they are stored.
+
+    Each member is yielded as its name and an iterator over its uncompressed content. The content of a member has to
+    be consumed before the next member is requested; whatever is left of it is skipped. The CRC-32 of each member is
+    verified before its content iterator ends, so a corrupt member raises from its content before the caller takes
+    the content as complete.
+
+    :param chunks: the bytes of the archive, in order
+    :return: an iterator over (member name, iterator over the member content) pairs
+    :raises zipfile.BadZipFile: when the archive is truncated, corrupted or uses an unsupported feature. The content
+        iterator of a member raises it too.
+    """
+    reader = _ChunkReader(chunks)
+    while True:
+        signature = reader.read(len(ZIP_LOCAL_FILE_HEADER_SIGNATURE))
+        if signature != ZIP_LOCAL_FILE_HEADER_SIGNATURE:
+            # the central directory follows the last member
+            return
+        header = signature + reader.read_exactly(ZIP_LOCAL_FILE_HEADER.size - len(signature))
+        _, _, flags, method, _, _, crc, compressed_size, size, name_length, extra_length = \
+            ZIP_LOCAL_FILE_HEADER.unpack(header)
+        name = reader.read_exactly(name_length).decode('utf-8' if flags & ZIP_FLAG_UTF8 else 'cp437')
+        reader.read_exactly(extra_length)
+        if flags & ZIP_FLAG_ENCRYPTED:
+            raise zipfile.BadZipFile("Member {} is encrypted".format(name))
+        has_data_descriptor = bool(flags & ZIP_FLAG_DATA_DESCRIPTOR)
+        if ZIP_ZIP64_SIZE in (compressed_size, size):
+            raise zipfile.BadZipFile("Member {} uses zip64 sizes".format(name))
+        if method == zipfile.ZIP_STORED:
+            if has_data_descriptor:
+                raise zipfile.BadZipFile("Stored member {} has no size in its header".format(name))
+            content = _iter_stored(reader, compressed_size)
+        elif method == zipfile.ZIP_DEFLATED:
+            content = _iter_deflated(reader)
+        else:
+            raise zipfile.BadZipFile("Member {} uses unsupported compression method {}".format(name, method))
+
+        checked = _iter_checked(reader, name, content, crc, has_data_descriptor)
+        yield name, checked
+        # skip what the caller did not read
+        for _ in checked:
+            pass
+
+
+class _ChunkReader:
+    """Reads exact amounts of bytes from an iterable of chunks, and takes back bytes that were read too far"""
+
+    def __init__(self, chunks: typing.Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def read(self, size: int) -> bytes:
+        """:return: the next size bytes, or less at the end of the stream"""
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_exactly(self, size: int) -> bytes:
+        """:raises zipfile.BadZipFile: when the stream ends before size bytes"""
+        data = self.read(size)
+        if len(data) < size:
+            raise zipfile.BadZipFile("Unexpected end of the zip archive")
+        return data
+
+    def read_some(self) -> bytes:
+        """:return: the buffered bytes or the next chunk, empty at the end of the stream"""
+        if not self._buffer:
+            return bytes(next(self._chunks, b''))
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+    def unread(self, data: bytes) -> None:
+        self._buffer[:0] = data
+
+
+def _iter_checked(reader: _ChunkReader,
+                  name: str,
+                  content: typing.Iterator[bytes],
+                  crc: int,
+                  has_data_descriptor: bool
+                  ) -> typing.Iterator[bytes]:
+    """
+    Pass the content of a member through, then read its data descriptor, if any, and check its CRC-32 before ending
+
+    :raises zipfile.BadZipFile: when the CRC-32 of the content is not the one recorded in the archive
+    """
+    value = 0
+    for chunk in content:
+        value = zlib.crc32(chunk, value)
+        yield chunk
+    if has_data_descriptor:
+        head = reader.read_exactly(len(ZIP_DATA_DESCRIPTOR_SIGNATURE))
+        if head == ZIP_DATA_DESCRIPTOR_SIGNATURE:
+            head = b''
+        # the signature of the data descriptor is optional
+        crc = ZIP_DATA_DESCRIPTOR.unpack(head + reader.read_exactly(ZIP_DATA_DESCRIPTOR.size - len(head)))[0]
+    if value != crc:
+        raise zipfile.BadZipFile("Bad CRC-32 for member {}".format(name))
+
+
+def _iter_stored(reader: _ChunkReader, size: int) -> typing.Iterator[bytes]:
+    remaining = size
+    while remaining:
+        data = reader.read_exactly(min(remaining, ZIP_READ_SIZE))
+        remaining -= len(data)
+        yield data
+
+
+def _iter_deflated(reader: _ChunkReader) -> typing.Iterator[bytes]:
+    # the deflate stream marks its own end, so the compressed size is not needed
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    while not decompressor.eof:
+        data = reader.read_some()
+        if not data:
+            raise zipfile.BadZipFile("Unexpected end of the zip archive")
+        try:
+            content = decompressor.decompress(data)
+        except zlib.error as error:
+            raise zipfile.BadZipFile(str(error))
+        if content:
+            yield content
+    reader.unread(decompressor.unused_data)
@@ -0,0 +1,168 @@
+import collections
+import threading
+import time
+import typing
+
+from .constants import *
+
+"""
+Progress of long transfers.
+
+Worker threads report into counters that only they write, so reporting a chunk takes no lock. A single aggregator
+thread sums the counters at a fixed interval and hands a ProgressSnapshot to a callback; any thread may also poll
+snapshot() while the transfer runs. The counter of a thread that ended, such as a worker of a batch whose executor
+shut down, is folded into a total of ended threads and dropped, so a progress used for many batches keeps one counter
+per live thread.
+
+Example::
+
+    progress = TransferProgress(callback=print, interval=1)
+    client.download_file_handles(download_requests, progress=progress)
+"""
+
+ProgressSnapshot = collections.namedtuple('ProgressSnapshot', ['transferred_bytes',
+                                                               'total_bytes',
+                                                               'completed_files',
+                                                               'total_files',
+                                                               'bytes_per_second',
+                                                               'eta_seconds',
+                                                               'elapsed_seconds'])
+ProgressSnapshot.__doc__ = """
+The progress of a transfer at one point in time. total_bytes only counts the files whose size is known so far, and
+eta_seconds is None until a rate has been measured.
+"""
+
+_TRANSFERRED_BYTES = 0
+_COMPLETED_FILES = 1
+_TOTAL_BYTES = 2
+_TOTAL_FILES = 3
+
+
+class TransferProgress:
+    """
+    Collects the progress of one or more transfers and reports it at a configurable interval
+    """
+
+    def __init__(self,
+                 *,
+                 callback: typing.Callable[[ProgressSnapshot], None] = None,
+                 interval: float = PROGRESS_DEFAULT_INTERVAL_SEC
+                 ) -> None:
+        """
+        :param callback: called with a ProgressSnapshot every interval seconds while a transfer runs, and once when
+            it ends. Default None, only snapshot() reports progress.
+        :param interval: the number of seconds between two calls of the callback
+        """
+        if interval <= 0:
+            raise ValueError("interval must be positive.")
+        self.callback = callback
+        self.interval = interval
+        self._local = threading.local()
+        # (thread, counter) of each live thread that reported progress; each counter is only written by its thread
+        self._counters = []
+        # the counts of the threads that ended
+        self._ended_totals = [0] * 4
+        self._counters_lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self._last_sample = (self._started_at, 0)
+        self._bytes_per_second = None
+        self._sample_lock = threading.Lock()
+        self._reporters = 0
+        self._reporter_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._reporter = None
+
+    def add_bytes(self, number_of_bytes: int) -> None:
+        """Record transferred bytes. A negative value takes back bytes that have to be transferred again."""
+        self._counter()[_TRANSFERRED_BYTES] += number_of_bytes
+
+    def add_files(self, number_of_files: int = 1) -> None:
+        """Record completed files"""
+        self._counter()[_COMPLETED_FILES] += number_of_files
+
+    def expect_bytes(self, number_of_bytes: int) -> None:
+        """Add to the number of bytes to transfer"""
+        self._counter()[_TOTAL_BYTES] += number_of_bytes
+
+    def expect_files(self, number_of_files: int) -> None:
+        """Add to the number of files to complete"""
+        self._counter()[_TOTAL_FILES] += number_of_files
+
+    def snapshot(self) -> ProgressSnapshot:
+        """
+        :return: the progress so far. The rate is measured since the previous snapshot taken at least a second ago.
+        """
+        with self._counters_lock:
+            self._fold_ended_counters()
+            totals = list(self._ended_totals)
+            counters = [counter for _, counter in self._counters]
+        for counter in counters:
+            for index, value in enumerate(counter):
+                totals[index] += value
+        now = time.monotonic()
+        with self._sample_lock:
+            sampled_at, sampled_bytes = self._last_sample
+            if now - sampled_at >= min(self.interval, 1):
+                self._bytes_per_second = (totals[_TRANSFERRED_BYTES] - sampled_bytes) / (now - sampled_at)
+                self._last_sample = (now, totals[_TRANSFERRED_BYTES])
+            bytes_per_second = self._bytes_per_second
+        eta_seconds = None
+        if bytes_per_second:
+            eta_seconds = max(totals[_TOTAL_BYTES] - totals[_TRANSFERRED_BYTES], 0) / bytes_per_second
+        return ProgressSnapshot(transferred_bytes=totals[_TRANSFERRED_BYTES],
+                                total_bytes=totals[_TOTAL_BYTES],
+                                completed_files=totals[_COMPLETED_FILES],
+                                total_files=totals[_TOTAL_FILES],
+                                bytes_per_second=bytes_per_second,
+                                eta_seconds=eta_seconds,
+                                elapsed_seconds=now - self._started_at)
+
+    def __enter__(self):
+        """Start the aggregator, if there is a callback. Transfers nest, and only the outermost one starts it."""
+        with self._reporter_lock:
+            self._reporters += 1
+            if self._reporters == 1 and self.callback is not None:
+                self._stop.clear()
+                self._reporter = threading.Thread(target=self._report, name="TransferProgress", daemon=True)
+                self._reporter.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Fold the counters of the worker threads that ended, then stop the aggregator and report the final progress"""
+        with self._counters_lock:
+            self._fold_ended_counters()
+        with self._reporter_lock:
+            self._reporters -= 1
+            if self._reporters > 0 or self._reporter is None:
+                return
+            self._stop.set()
+            self._reporter.join()
+            self._reporter = None
+        self.callback(self.snapshot())
+
+    def _report(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.callback(self.snapshot())
+
+    def _counter(self) -> typing.List[int]:
+        counter = getattr(self._local, 'counter', None)
+        if counter is None:
+            counter = self._local.counter = [0] * 4
+            # only taken the first time a thread reports
+            with self._counters_lock:
+                self._fold_ended_counters()
+                self._counters.append((threading.current_thread(), counter))
+        return counter
+
+    def _fold_ended_counters(self) -> None:
+        """Add the counters of the threads that ended to the totals of ended threads and drop them"""
+        # must be called holding the counters lock
+        live = []
+        for thread, counter in self._counters:
+            if thread.is_alive():
+                live.append((thread, counter))
+            else:
+                # the thread is gone, so its counter is final
+                for index, value in enumerate(counter):
+                    self._ended_totals[index] += value
+        self._counters = live
@@ -0,0 +1,250 @@
+import collections
+import concurrent.futures
+import mimetypes
+import os
+import typing
+
+from .constants import *
+from .download import DownloadRequest, DOWNLOAD_STATUS_FAILED, DOWNLOAD_STATUS_UP_TO_DATE
+from .exceptions import *
+from .internal.cache import Cache
+from .internal.lock import LockException
+from .internal.pathutils import normalize_path
+
+RemoteFile = collections.namedtuple('RemoteFile', ['path',
+                                                   'file_handle_id',
+                                                   'object_id',
+                                                   'object_type',
+                                                   'content_size',
+                                                   'content_md5'])
+RemoteFile.__doc__ = """
+A file of a Synapse container in a sync manifest.
+
+path is relative to the container, with '/' separators. content_size and content_md5 come from the file handle and
+may be None when unknown, in which case a local file only matches when the cache vouches for it.
+"""
+
+
+class SyncResult:
+    """
+    The outcome of a sync, keyed by path relative to the synced directory
+
+    ...
+
+    Attributes
+    ----------
+    unchanged : list
+        The paths whose local and remote content already match.
+    transferred : dict
+        A map between each transferred path and its DownloadResult when syncing from Synapse, or the File Handle
+        created in Synapse when syncing to Synapse.
+    failed : dict
+        A map between each path that failed to transfer and its error.
+    extraneous : list
+        The paths that only exist at the destination. They are left untouched.
+    """
+
+    def __init__(self):
+        self.unchanged = []
+        self.transferred = {}
+        self.failed = {}
+        self.extraneous = []
+
+    def __repr__(self):
+        return "SyncResult(unchanged={}, transferred={}, failed={}, extraneous={})".format(
+            len(self.unchanged), len(self.transferred), len(self.failed), len(self.extraneous))
+
+
+# Helper functions
+# These methods are not designed to be used outside of this package.
+
+
+def _sync_from_synapse(client,
+                       remote_files: typing.Iterable[RemoteFile],
+                       local_dir: str,
+                       *,
+                       max_threads: int,
+                       **transfer_options
+                       ) -> SyncResult:
+    """
+    Download the remote files that are missing or differ under local_dir
+
+    :param client: the SynapseBaseClient used to talk to Synapse
+    :param remote_files: the manifest of the container
+    :param local_dir: the local directory to mirror the container to
+    :param max_threads: the max number of directories scanned and files hashed at the same time
+    :param transfer_options: passed to download_file_handles()
+    :return: the SyncResult
+    """
+    result = SyncResult()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+        local_files = _scan_tree(local_dir, executor) if os.path.isdir(local_dir) else {}
+        remote_files = {remote_file.path: remote_file for remote_file in remote_files}
+        result.extraneous.extend(sorted(set(local_files) - set(remote_files)))
+        checks = {executor.submit(_is_unchanged,
+                                  client._cache,
+                                  remote_file,
+                                  _local_path(local_dir, relative_path),
+                                  local_files.get(relative_path)): relative_path
+                  for relative_path, remote_file in remote_files.items()}
+        changed = []
+        for future in concurrent.futures.as_completed(checks):
+            if future.result():
+                result.unchanged.append(checks[future])
+            else:
+                changed.append(checks[future])
+
+    download_requests = {}
+    for relative_path in sorted(changed):
+        remote_file = remote_files[relative_path]
+        download_request = DownloadRequest(remote_file.file_handle_id,
+                                           remote_file.object_id,
+                                           remote_file.object_type,
+                                           _local_path(local_dir, relative_path))
+        download_requests[download_request] = relative_path
+    download_results = client.download_file_handles(list(download_requests),
+                                                    use_multiple_threads=max_threads > 1,
+                                                    **transfer_options)
+    for download_request, download_result in download_results.items():
+        relative_path = download_requests[download_request]
+        if download_result.status == DOWNLOAD_STATUS_FAILED:
+            result.failed[relative_path] = download_result.error
+        elif download_result.status == DOWNLOAD_STATUS_UP_TO_DATE:
+            result.unchanged.append(relative_path)
+        else:
+            result.transferred[relative_path] = download_result
+    result.unchanged.sort()
+    return result
+
+
+def _sync_to_synapse(client,
+                     local_dir: str,
+                     remote_files: typing.Iterable[RemoteFile],
+                     *,
+                     max_threads: int,
+                     **transfer_options
+                     ) -> SyncResult:
+    """
+    Upload the local files under local_dir that are missing from, or differ from, the remote files
+
+    :param client: the SynapseBaseClient used to talk to Synapse
+    :param local_dir: the local directory to mirror to the container
+    :param remote_files: the manifest of the container
+    :param max_threads: the max number of directories scanned, files hashed and files uploaded at the same time
+    :param transfer_options: passed to upload_file_handle()
+    :return: the SyncResult
+    """
+    result = SyncResult()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+        local_files = _scan_tree(local_dir, executor)
+        remote_files = {remote_file.path: remote_file for remote_file in remote_files}
+        result.extraneous.extend(sorted(set(remote_files) - set(local_files)))
+        checks = {}
+        changed = []
+        for relative_path, local_file in local_files.items():
+            if relative_path in remote_files:
+                checks[executor.submit(_is_unchanged,
+                                       client._cache,
+                                       remote_files[relative_path],
+                                       _local_path(local_dir, relative_path),
+                                       local_file)] = relative_path
+            else:
+                changed.append(relative_path)
+        for future in concurrent.futures.as_completed(checks):
+            if future.result():
+                result.unchanged.append(checks[future])
+            else:
+                changed.append(checks[future])
+
+        # each upload also splits its parts across threads; the transfer scheduler bounds the parts in flight
+        uploads = {executor.submit(_upload, client, _local_path(local_dir, relative_path), **transfer_options):
+                   relative_path
+                   for relative_path in sorted(changed)}
+        for future in concurrent.futures.as_completed(uploads):
+            try:
+                result.transferred[uploads[future]] = future.result()
+            except (SynapseClientError, OSError, LockException, ValueError) as error:
+                result.failed[uploads[future]] = error
+    result.unchanged.sort()
+    return result
+
+
+def _upload(client, path: str, **transfer_options) -> dict:
+    """
+    Upload a file and register it in the cache, so the next sync recognizes it without hashing it.
+    The upload is not failed when the file cannot be registered; the next sync hashes it instead.
+
+    :return: the File Handle created in Synapse
+    """
+    content_type = mimetypes.guess_type(path)[0] or UPLOAD_DEFAULT_CONTENT_TYPE
+    file_handle = client.upload_file_handle(path, content_type, **transfer_options)
+    try:
+        client._cache.register(int(file_handle['id']), path, content_md5=file_handle.get('contentMd5'))
+    except (OSError, LockException):
+        pass
+    return file_handle
+
+
+def _is_unchanged(cache: Cache,
+                  remote_file: RemoteFile,
+                  path: str,
+                  local_file: typing.Optional[os.stat_result]
+                  ) -> bool:
+    """
+    Compare a local file with a remote file: by size first, then by the cache, then by MD5.
+    A match found by MD5 is registered in the cache so the next comparison does not hash the file again.
+
+    :param cache: the cache that records the unmodified local copies of each file handle
+    :param remote_file: the remote file
+    :param path: the path of the local file
+    :param local_file: the stat of the local file, or None when it does not exist
+    :return: True when the local file has the content of the remote file
+    """
+    if local_file is None:
+        return False
+    if remote_file.content_size is not None and local_file.st_size != remote_file.content_size:
+        return False
+    if normalize_path(path) in cache.get_all_unmodified_cached_file_paths(remote_file.file_handle_id):
+        return True
+    if remote_file.content_md5 is None:
+        return False
+    return cache.register_if_content_matches(remote_file.file_handle_id, path, remote_file.content_md5)
+
+
+def _scan_tree(root: str, executor: concurrent.futures.Executor) -> typing.Dict[str, os.stat_result]:
+    """
+    Scan a directory tree, one directory per task
+
+    :param root: the directory to scan
+    :param executor: the executor that scans the directories
+    :return: a map between the path of each file relative to root, with '/' separators, and its stat
+    """
+    files = {}
+    pending = {executor.submit(_scan_dir, root, '')}
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            dir_files, sub_dirs = future.result()
+            files.update(dir_files)
+            pending.update(executor.submit(_scan_dir, os.path.join(root, *sub_dir.split('/')), sub_dir)
+                           for sub_dir in sub_dirs)
+    return files
+
+
+def _scan_dir(path: str, relative_path: str) -> typing.Tuple[typing.Dict[str, os.stat_result], typing.List[str]]:
+    """
+    :return: the files of a directory with their stat, and its sub directories, by path relative to the scanned root
+    """
+    files = {}
+    sub_dirs = []
+    for entry in os.scandir(path):
+        entry_path = relative_path + '/' + entry.name if relative_path else entry.name
+        if entry.is_dir(follow_symlinks=False):
+            sub_dirs.append(entry_path)
+        elif entry.is_file() and not entry.name.endswith(DOWNLOAD_TEMP_FILE_SUFFIX):
+            files[entry_path] = entry.stat()
+    return files, sub_dirs
+
+
+def _local_path(local_dir: str, relative_path: str) -> str:
+    return os.path.join(local_dir, *relative_path.split('/'))
@@ -0,0 +1,742 @@
+import concurrent.futures
+import functools
+import hashlib
+import math
+import mimetypes
+import mmap
+import os
+import tempfile
+import threading
+import typing
+
+import requests
+
+from .constants import *
+from .exceptions import *
+from .internal.autotune import ConcurrencyTuner
+from .internal.contextutils import _null_context
+from .internal.dozer import doze
+from .internal.hashing import HashingService, get_hashing_service
+from .internal.pathutils import memory_map
+from .internal.scheduler import TransferChannel
+from .internal.uploadstate import UploadState
+from .progress import TransferProgress
+
+MULTIPART_UPLOAD_STATE_COMPLETED = "COMPLETED"
+ADD_PART_STATE_SUCCESS = "ADD_SUCCESS"
+
+Stream = typing.Union[typing.BinaryIO, typing.Iterable[bytes]]
+
+
+class UploadResult:
+    """
+    An upload result. Results are immutable and compare equal when all attributes are equal.
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        The local path of the file.
+    file_handle : dict
+        The File Handle created in Synapse. None when the upload failed.
+    error : Exception
+        The reason the upload failed. None when the upload succeeded.
+    """
+
+    __slots__ = ('path', 'file_handle', 'error')
+
+    def __init__(self, path: str, file_handle: typing.Optional[dict], *, error: Exception = None):
+        """
+
+        :param path:
+        :param file_handle:
+        :param error:
+        """
+
+        object.__setattr__(self, 'path', path)
+        object.__setattr__(self, 'file_handle', file_handle)
+        object.__setattr__(self, 'error', error)
+
+    def _key(self) -> tuple:
+        return self.path, self.file_handle, self.error
+
+    def __setattr__(self, name, value):
+        raise AttributeError("UploadResult is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("UploadResult is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, UploadResult):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        # file handles are dicts, which are not hashable
+        return hash((self.path, self.error))
+
+    def __repr__(self):
+        return "UploadResult(path={!r}, file_handle={!r}, error={!r})".format(*self._key())
+
+
+# Helper functions
+# These methods are not designed to be used outside of this package.
+
+
+def _upload_file_handle(client,
+                        path: str,
+                        content_type: str,
+                        *,
+                        generate_preview: bool,
+                        storage_location_id: int,
+                        max_threads: int,
+                        channel: TransferChannel = None,
+                        progress: TransferProgress = None,
+                        state_dir: str = None,
+                        hashing_service: HashingService = None
+                        ) -> dict:
+    """
+    Upload a local file to Synapse with a multipart upload.
+
+    With a state directory, the upload ID and the MD5 and part size of the file are persisted there until the
+    upload completes. When the process dies mid-upload, uploading the unchanged file again
+    skips hashing it and only sends the parts Synapse does not have.
+
+    :param client: the SynapseBaseClient used to talk to Synapse
+    :param path: the path to the local file
+    :param content_type: the content type of the file
+    :param generate_preview: set to True to generate preview
+    :param storage_location_id: the ID of the Storage Location to upload to
+    :param max_threads: the max number of parts uploaded at the same time
+    :param channel: the channel of the transfer scheduler to submit the parts to. Default None, unscheduled.
+    :param progress: the progress to report the upload to. Default None, not reported.
+    :param state_dir: the directory to persist the state of the upload in. Default None, not persisted.
+    :param hashing_service: the service that hashes the files. Default None, the service shared by the process.
+    :return: the File Handle created in Synapse
+    """
+    if progress is not None:
+        progress.expect_files(1)
+    with progress if progress is not None else _null_context():
+        file_handle = _upload_file(client,
+                                   path,
+                                   content_type,
+                                   generate_preview=generate_preview,
+                                   storage_location_id=storage_location_id,
+                                   max_threads=max_threads,
+                                   channel=channel,
+                                   progress=progress,
+                                   state_dir=state_dir,
+                                   hashing_service=hashing_service)
+        if progress is not None:
+            progress.add_files()
+        return file_handle
+
+
+def _upload_file_handles(client,
+                         paths: typing.Sequence[str],
+                         content_type: typing.Optional[str],
+                         *,
+                         generate_preview: bool,
+                         storage_location_id: int,
+                         max_threads: int,
+                         channel: TransferChannel = None,
+                         progress: TransferProgress = None,
+                         state_dir: str = None,
+                         hashing_service: HashingService = None
+                         ) -> typing.List[UploadResult]:
+    """
+    Upload many local files to Synapse, up to max_threads files at the same time.
+
+    Each file takes several round trips to Synapse; uploading the files side by side overlaps the round trips of one
+    file with the transfers of the others. Files that fit in a single part are read and hashed in one go and sent
+    from the worker itself. Larger files are uploaded part by part, like in _upload_file_handle.
+
+    :param client: the SynapseBaseClient used to talk to Synapse
+    :param paths: the paths to the local files
+    :param content_type: the content type of all files. Set to None to guess the content type of each file from its
+        name.
+    :param generate_preview: set to True to generate previews
+    :param storage_location_id: the ID of the Storage Location to upload to
+    :param max_threads: the max number of files uploaded at the same time, and of parts of a large file
+    :param channel: the channel of the transfer scheduler to submit the transfers to. Default None, unscheduled.
+    :param progress: the progress to report the uploads to. Default None, not reported.
+    :param state_dir: the directory to persist the state of the uploads of larger files in. Default None, not
+        persisted.
+    :param hashing_service: the service that hashes the files. Default None, the service shared by the process.
+    :return: the results, in the order of paths
+    """
+    def upload(path):
+        try:
+            file_content_type = content_type or mimetypes.guess_type(path)[0] or UPLOAD_DEFAULT_CONTENT_TYPE
+            upload_file = _upload_single_part if os.path.getsize(path) <= UPLOAD_SINGLE_PART_MAX_SIZE_BYTES \
+                else functools.partial(_upload_file, max_threads=max_threads, state_dir=state_dir,
+                                       hashing_service=hashing_service)
+            result = UploadResult(path, upload_file(client,
+                                                    path,
+                                                    file_content_type,
+                                                    generate_preview=generate_preview,
+                                                    storage_location_id=storage_location_id,
+                                                    channel=channel,
+                                                    progress=progress))
+        except (SynapseClientError, OSError, requests.RequestException) as error:
+            result = UploadResult(path, None, error=error)
+        if progress is not None:
+            progress.add_files()
+        return result
+
+    if progress is not None:
+        progress.expect_files(len(paths))
+    with progress if progress is not None else _null_context(), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+        return list(executor.map(upload, paths))
+
+
+def _upload_file(client,
+                 path: str,
+                 content_type: str,
+                 *,
+                 generate_preview: bool,
+                 storage_location_id: int,
+                 max_threads: int,
+                 channel: typing.Optional[TransferChannel],
+                 progress: typing.Optional[TransferProgress],
+                 state_dir: str = None,
+                 hashing_service: HashingService = None
+                 ) -> dict:
+    """
+    Upload a local file part by part, from a memory mapping of the file when it can be mapped.
+    With a state directory, resume the upload recorded there for the unchanged file, if any. Otherwise the hashing
+    service computes the MD5 of the file and of its parts in one pass, or recalls them if it already did.
+
+    :return: the File Handle created in Synapse
+    """
+    state = UploadState.load(state_dir, path) if state_dir is not None else None
+    with open(path, 'rb') as f, memory_map(f) as mapped:
+        file_size = os.fstat(f.fileno()).st_size
+        if state is not None and state.upload_id is not None:
+            # only the missing parts are hashed, as they are uploaded
+            content_md5, part_size, part_md5s = state.content_md5, state.part_size, None
+        else:
+            part_size = _get_part_size(file_size)
+            if hashing_service is None:
+                hashing_service = get_hashing_service()
+            content_md5, part_md5s = hashing_service.md5s_of_file(path, part_size)
+        file_handle = _upload_seekable(client,
+                                       mapped if mapped is not None else f,
+                                       file_name=os.path.basename(path),
+                                       content_type=content_type,
+                                       content_md5=content_md5,
+                                       file_size=file_size,
+                                       part_size=part_size,
+                                       part_md5s=part_md5s,
+                                       generate_preview=generate_preview,
+                                       storage_location_id=storage_location_id,
+                                       max_threads=max_threads,
+                                       channel=channel,
+                                       progress=progress,
+                                       state=state)
+    if state is not None:
+        state.remove()
+    return file_handle
+
+
+def _upload_single_part(client,
+                        path: str,
+                        content_type: str,
+                        *,
+                        generate_preview: bool,
+                        storage_location_id: int,
+                        channel: typing.Optional[TransferChannel],
+                        progress: typing.Optional[TransferProgress]
+                        ) -> dict:
+    """
+    Upload a local file that fits in a single part from the calling thread
+
+    :return: the File Handle created in Synapse
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    part_size = _get_part_size(len(data))
+    content_md5 = hashlib.md5(data).hexdigest()
+    status = _start_multipart_upload(client,
+                                     file_name=os.path.basename(path),
+                                     content_type=content_type,
+                                     content_md5=content_md5,
+                                     file_size=len(data),
+                                     part_size=part_size,
+                                     generate_preview=generate_preview,
+                                     storage_location_id=storage_location_id)
+    if progress is not None:
+        _expect_upload(progress, status, len(data), part_size)
+    if status['state'] != MULTIPART_UPLOAD_STATE_COMPLETED:
+        if _get_missing_part_numbers(status):
+            # the single part is the whole content
+            _upload_part(client, status['uploadId'], 1, data, part_md5=content_md5, channel=channel,
+                         progress=progress)
+        status = _complete_multipart_upload(client, status['uploadId'])
+    return _get_file_handle(client, status['resultFileHandleId'])
+
+
+def _upload_stream(client,
+                   stream: Stream,
+                   file_name: str,
+                   content_type: str,
+                   *,
+                   size: typing.Optional[int],
+                   content_md5: typing.Optional[str],
+                   generate_preview: bool,
+                   storage_location_id: int,
+                   max_threads: int,
+                   max_buffered_parts: int,
+                   channel: TransferChannel = None,
+                   progress: TransferProgress = None
+                   ) -> dict:
+    """
+    Upload the content of a binary file-like object or of an iterator of bytes to Synapse.
+
+    A multipart upload has to declare the size and the MD5 of the whole content before the first part is sent.
+    When both are given, each part is hashed and uploaded as soon as it fills. Otherwise the content is hashed while
+    it is buffered, in memory up to max_buffered_parts parts and in a temporary file beyond, and uploaded from the
+    buffer once the stream ends.
+
+    :param client: the SynapseBaseClient used to talk to Synapse
+    :param stream: a binary file-like object or an iterable of bytes
+    :param file_name: the name of the file in Synapse
+    :param content_type: the content type of the file
+    :param size: the size of the content in bytes, if known
+    :param content_md5: the MD5 hex digest of the content, if known
+    :param generate_preview: set to True to generate preview
+    :param storage_location_id: the ID of the Storage Location to upload to
+    :param max_threads: the max number of parts uploaded at the same time
+    :param max_buffered_parts: the max number of parts held in memory
+    :param channel: the channel of the transfer scheduler to submit the parts to. Default None, unscheduled.
+    :param progress: the progress to report the upload to. Default None, not reported.
+    :return: the File Handle created in Synapse
+    """
+    if progress is not None:
+        progress.expect_files(1)
+    with progress if progress is not None else _null_context():
+        file_handle = _upload_content(client,
+                                      stream,
+                                      file_name,
+                                      content_type,
+                                      size=size,
+                                      content_md5=content_md5,
+                                      generate_preview=generate_preview,
+                                      storage_location_id=storage_location_id,
+                                      max_threads=max_threads,
+                                      max_buffered_parts=max_buffered_parts,
+                                      channel=channel,
+                                      progress=progress)
+    if progress is not None:
+        progress.add_files()
+    return file_handle
+
+
+def _upload_content(client,
+                    stream: Stream,
+                    file_name: str,
+                    content_type: str,
+                    *,
+                    size: typing.Optional[int],
+                    content_md5: typing.Optional[str],
+                    generate_preview: bool,
+                    storage_location_id: int,
+                    max_threads: int,
+                    max_buffered_parts: int,
+                    channel: typing.Optional[TransferChannel],
+                    progress: typing.Optional[TransferProgress]
+                    ) -> dict:
+    """
+    Upload a stream part by part when its size and MD5 are known, or from a buffer of its content otherwise
+
+    :return: the File Handle created in Synapse
+    """
+    if size is not None and content_md5 is not None:
+        part_size = _get_part_size(size)
+        status = _start_multipart_upload(client,
+                                         file_name=file_name,
+                                         content_type=content_type,
+                                         content_md5=content_md5,
+                                         file_size=size,
+                                         part_size=part_size,
+                                         generate_preview=generate_preview,
+                                         storage_location_id=storage_location_id)
+        if progress is not None:
+            _expect_upload(progress, status, size, part_size)
+        if status['state'] != MULTIPART_UPLOAD_STATE_COMPLETED:
+            missing = _get_missing_part_numbers(status)
+            parts = ((part_number, data) for part_number, data in enumerate(_iter_parts(stream, part_size), 1)
+                     if part_number in missing)
+            _upload_parts(client, status['uploadId'], parts, max_threads=max_threads,
+                          max_buffered_parts=max_buffered_parts, tuner=_get_tuner(max_threads), channel=channel,
+                          progress=progress)
+            status = _complete_multipart_upload(client, status['uploadId'])
+        return _get_file_handle(client, status['resultFileHandleId'])
+
+    buffer_size = max_buffered_parts * UPLOAD_DEFAULT_PART_SIZE_BYTES
+    with tempfile.SpooledTemporaryFile(max_size=buffer_size) as spool:
+        md5 = hashlib.md5()
+        for chunk in _iter_chunks(stream, UPLOAD_DEFAULT_PART_SIZE_BYTES):
+            md5.update(chunk)
+            spool.write(chunk)
+        file_size = spool.tell()
+        return _upload_seekable(client,
+                                spool,
+                                file_name=file_name,
+                                content_type=content_type,
+                                content_md5=md5.hexdigest(),
+                                file_size=file_size,
+                                part_size=_get_part_size(file_size),
+                                generate_preview=generate_preview,
+                                storage_location_id=storage_location_id,
+                                max_threads=max_threads,
+                                channel=channel,
+                                progress=progress)
+
+
+def _upload_seekable(client,
+                     f: typing.Union[typing.BinaryIO, mmap.mmap],
+                     *,
+                     file_name: str,
+                     content_type: str,
+                     content_md5: str,
+                     file_size: int,
+                     part_size: int,
+                     part_md5s: typing.Sequence[str] = None,
+                     generate_preview: bool,
+                     storage_location_id: int,
+                     max_threads: int,
+                     channel: TransferChannel = None,
+                     progress: TransferProgress = None,
+                     state: UploadState = None
+                     ) -> dict:
+    """
+    Upload the parts of a seekable binary file that Synapse does not have yet.
+    The parts of a memory mapped file are memoryview slices of the mapping; the parts of other files are read.
+    Parts whose MD5 is not in part_md5s are hashed as they are uploaded.
+    The state, if any, records the upload so that a later run resumes it.
+
+    :return: the File Handle created in Synapse
+    """
+    status = _start_multipart_upload(client,
+                                     file_name=file_name,
+                                     content_type=content_type,
+                                     content_md5=content_md5,
+                                     file_size=file_size,
+                                     part_size=part_size,
+                                     generate_preview=generate_preview,
+                                     storage_location_id=storage_location_id)
+    if progress is not None:
+        _expect_upload(progress, status, file_size, part_size)
+    if status['state'] != MULTIPART_UPLOAD_STATE_COMPLETED:
+        if state is not None:
+            state.begin(content_md5, part_size, status['uploadId'])
+
+        def read_parts():
+            for part_number in sorted(_get_missing_part_numbers(status)):
+                start = (part_number - 1) * part_size
+                if isinstance(f, mmap.mmap):
+                    yield part_number, memoryview(f)[start:start + part_size]
+                else:
+                    f.seek(start)
+                    yield part_number, f.read(part_size)
+
+        if not isinstance(f, mmap.mmap):
+            # reading happens on the calling thread, so only the parts in flight are held in memory
+            max_threads = min(max_threads, max(1, UPLOAD_MAX_BUFFERED_BYTES // part_size))
+        _upload_parts(client, status['uploadId'], read_parts(), max_threads=max_threads,
+                      max_buffered_parts=max_threads + 1, tuner=_get_tuner(max_threads), part_md5s=part_md5s,
+                      channel=channel, progress=progress)
+        status = _complete_multipart_upload(client, status['uploadId'])
+    return _get_file_handle(client, status['resultFileHandleId'])
+
+
+def _upload_parts(client,
+                  upload_id: str,
+                  parts: typing.Iterable[typing.Tuple[int, typing.Union[bytes, memoryview]]],
+                  *,
+                  max_threads: int,
+                  max_buffered_parts: int,
+                  tuner: ConcurrencyTuner = None,
+                  part_md5s: typing.Sequence[str] = None,
+                  channel: TransferChannel = None,
+                  progress: TransferProgress = None
+                  ) -> None:
+    """
+    Upload parts as they are produced. The next part is only read once fewer than max_buffered_parts parts are
+    waiting or being uploaded, so memory stays bounded however large the content is. With a tuner, the number of
+    parts submitted and not finished stays within the limit the tuner sets from the measured throughput; the next
+    part is read ahead while they are in flight and only submitted once one of them finishes.
+
+    :param client: the SynapseBaseClient used to talk to Synapse
+    :param upload_id: the ID of the multipart upload
+    :param parts: the (part number, data) pairs to upload
+    :param max_threads: the max number of parts uploaded at the same time
+    :param max_buffered_parts: the max number of parts held in memory
+    :param tuner: the tuner of the number of parts in flight. Default None, up to max_threads parts.
+    :param part_md5s: the MD5 hex digests of all the parts, in order. Default None, each part is hashed.
+    :param channel: the channel of the transfer scheduler to submit the parts to. Default None, unscheduled.
+    :param progress: the progress to report the uploaded parts to. Default None, not reported.
+    :raises SynapseClientError: when a part fails to upload
+    """
+    if tuner is None:
+        slots = _Slots(lambda: max_buffered_parts)
+    else:
+        # the part read ahead is held without a slot, so it counts against max_buffered_parts
+        slots = _Slots(lambda: max(1, min(max_buffered_parts - 1, tuner.limit)))
+    failed = threading.Event()
+
+    def on_done(future):
+        if future.exception() is not None:
+            failed.set()
+        slots.release()
+
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
+        for part_number, data in _throttle(parts, slots, failed, read_ahead=tuner is not None):
+            part_md5 = part_md5s[part_number - 1] if part_md5s is not None else None
+            future = executor.submit(_upload_part, client, upload_id, part_number, data, part_md5=part_md5,
+                                     tuner=tuner, channel=channel, progress=progress)
+            future.add_done_callback(on_done)
+            futures.append(future)
+    for future in futures:
+        future.result()
+
+
+class _Slots:
+    """
+    A counting semaphore whose size may change while it is in use
+    """
+
+    def __init__(self, size: typing.Callable[[], int]) -> None:
+        """
+        :param size: returns the number of slots, called each time a slot is requested
+        """
+        self._size = size
+        self._taken = 0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self._taken >= self._size():
+                self._condition.wait()
+            self._taken += 1
+
+    def release(self) -> None:
+        with self._condition:
+            self._taken -= 1
+            self._condition.notify_all()
+
+
+def _throttle(items: typing.Iterable, slots: _Slots, stop: threading.Event, *, read_ahead: bool = False
+              ) -> typing.Iterator:
+    """
+    Take a slot before producing each item; the consumer gives the slot back once it is done with the item.
+    With read_ahead, the next item is read before waiting for its slot instead of after.
+    Stops early when stop is set.
+    """
+    iterator = iter(items)
+    while True:
+        if read_ahead:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            slots.acquire()
+            if stop.is_set():
+                slots.release()
+                return
+        else:
+            slots.acquire()
+            if stop.is_set():
+                slots.release()
+                return
+            try:
+                item = next(iterator)
+            except StopIteration:
+                slots.release()
+                return
+        yield item
+
+
+def _upload_part(client,
+                 upload_id: str,
+                 part_number: int,
+                 data: typing.Union[bytes, memoryview],
+                 *,
+                 part_md5: str = None,
+                 tuner: ConcurrencyTuner = None,
+                 channel: TransferChannel = None,
+                 progress: TransferProgress = None
+                 ) -> None:
+    """
+    Upload one part to its presigned URL and add it to the multipart upload.
+    Failed attempts are retried up to UPLOAD_MAX_ATTEMPTS times with a new presigned URL. The tuner, if any, learns
+    about throttled attempts and completed parts. The channel, if any, paces each attempt. The progress, if any,
+    counts the part once it is uploaded.
+    The part is hashed unless its MD5 is given.
+
+    :raises SynapseClientError: when the part cannot be uploaded
+    """
+    if part_md5 is None:
+        part_md5 = hashlib.md5(data).hexdigest()
+    for attempt in range(1, UPLOAD_MAX_ATTEMPTS + 1):
+        try:
+            presigned_url = _get_part_presigned_urls(client, upload_id, [part_number])[part_number]
+            if channel is not None:
+                channel.throttle(len(data))
+            with channel.slot() if channel is not None else _null_context():
+                response = client._requests_session.put(presigned_url['uploadPresignedUrl'],
+                                                        data=data,
+                                                        headers=presigned_url.get('signedHeaders') or {})
+            check_storage_status_code_and_raise_error(response)
+            break
+        except SynapseTooManyRequestError:
+            if tuner is not None:
+                tuner.throttled()
+            if attempt == UPLOAD_MAX_ATTEMPTS:
+                raise
+            doze(UPLOAD_RETRY_BACKOFF_SEC * 2 ** (attempt - 1))
+        except (SynapseUnauthorizedError, SynapseServerError, SynapseTemporarilyUnavailableError,
+                requests.ConnectionError, requests.Timeout):
+            if attempt == UPLOAD_MAX_ATTEMPTS:
+                raise
+            doze(UPLOAD_RETRY_BACKOFF_SEC * 2 ** (attempt - 1))
+    if tuner is not None:
+        tuner.record(len(data))
+    _add_part(client, upload_id, part_number, part_md5)
+    if progress is not None:
+        progress.add_bytes(len(data))
+
+
+def _start_multipart_upload(client,
+                            *,
+                            file_name: str,
+                            content_type: str,
+                            content_md5: str,
+                            file_size: int,
+                            part_size: int,
+                            generate_preview: bool,
+                            storage_location_id: int
+                            ) -> dict:
+    """
+    Start a multipart upload, or resume the one Synapse already has for the same content
+
+    :return: the MultipartUploadStatus
+    """
+    request_body = {
+        'contentMD5Hex': content_md5,
+        'fileName': file_name,
+        'generatePreview': generate_preview,
+        'contentType': content_type,
+        'partSizeBytes': part_size,
+        'fileSizeBytes': file_size,
+        'storageLocationId': storage_location_id,
+    }
+    return client.post('/file/multipart', request_body=request_body, endpoint=client._default_file_endpoint)
+
+
+def _get_part_presigned_urls(client, upload_id: str, part_numbers: typing.Sequence[int]) -> typing.Dict[int, dict]:
+    """
+    :return: a map between each part number and its PartPresignedUrl
+    """
+    response = client.post('/file/multipart/{}/presigned/url/batch'.format(upload_id),
+                           request_body={'uploadId': upload_id, 'partNumbers': list(part_numbers)},
+                           endpoint=client._default_file_endpoint)
+    return {presigned_url['partNumber']: presigned_url for presigned_url in response['partPresignedUrls']}
+
+
+def _add_part(client, upload_id: str, part_number: int, part_md5: str) -> None:
+    """
+    Tell Synapse a part has been uploaded
+
+    :raises SynapseClientError: when Synapse rejects the part
+    """
+    response = client.put('/file/multipart/{}/add/{}'.format(upload_id, part_number),
+                          request_parameters={'partMD5Hex': part_md5},
+                          endpoint=client._default_file_endpoint)
+    if response.get('addPartState') != ADD_PART_STATE_SUCCESS:
+        raise SynapseClientError(message="Failed to add part {} to upload {}: {}".format(
+            part_number, upload_id, response.get('errorMessage')))
+
+
+def _complete_multipart_upload(client, upload_id: str) -> dict:
+    """
+    :return: the MultipartUploadStatus of the completed upload
+    """
+    return client.put('/file/multipart/{}/complete'.format(upload_id), endpoint=client._default_file_endpoint)
+
+
+def _get_file_handle(client, file_handle_id: str) -> dict:
+    return client.get('/fileHandle/{}'.format(file_handle_id), endpoint=client._default_file_endpoint)
+
+
+def _expect_upload(progress: TransferProgress, status: dict, file_size: int, part_size: int) -> None:
+    """
+    Add the size of the content to the progress, and count the parts Synapse already has as transferred
+    """
+    progress.expect_bytes(file_size)
+    missing_bytes = sum(min(part_size, file_size - (part_number - 1) * part_size)
+                        for part_number in _get_missing_part_numbers(status))
+    progress.add_bytes(file_size - missing_bytes)
+
+
+def _get_missing_part_numbers(status: dict) -> typing.Set[int]:
+    """
+    :param status: the MultipartUploadStatus
+    :return: the numbers of the parts Synapse does not have yet
+    """
+    return {part_number for part_number, state in enumerate(status.get('partsState', ''), 1) if state == '0'}
+
+
+def _get_part_size(file_size: int) -> int:
+    """
+    Small files use the default part size. Larger files use bigger parts, in whole MiB, so that they take about
+    UPLOAD_TARGET_NUMBER_OF_PARTS parts, up to UPLOAD_MAX_AUTOTUNED_PART_SIZE_BYTES to bound the memory held by the
+    parts in flight. Huge files use whatever part size the Synapse limit on the number of parts requires.
+
+    :return: the part size for a file of file_size bytes, within the Synapse limit on the number of parts
+    """
+    mib = 1024 * 1024
+    part_size = int(math.ceil(file_size / UPLOAD_TARGET_NUMBER_OF_PARTS / mib)) * mib
+    part_size = min(max(part_size, UPLOAD_DEFAULT_PART_SIZE_BYTES), UPLOAD_MAX_AUTOTUNED_PART_SIZE_BYTES)
+    return max(part_size,
+               SYNAPSE_MULTIPART_MIN_PART_SIZE_BYTES,
+               int(math.ceil(file_size / SYNAPSE_MULTIPART_MAX_NUMBER_OF_PARTS)))
+
+
+def _get_tuner(max_threads: int) -> typing.Optional[ConcurrencyTuner]:
+    """
+    :return: a tuner that grows the number of parts in flight up to max_threads, or None for a single thread
+    """
+    return ConcurrencyTuner(maximum=max_threads) if max_threads > 1 else None
+
+
+def _iter_chunks(stream: Stream, chunk_size: int) -> typing.Iterator[bytes]:
+    """
+    :return: an iterator over the chunks of a binary file-like object, or over the items of an iterable of bytes
+    """
+    if hasattr(stream, 'read'):
+        return iter(lambda: stream.read(chunk_size), b'')
+    return (bytes(chunk) for chunk in stream if chunk)
+
+
+def _iter_parts(stream: Stream, part_size: int) -> typing.Iterator[bytes]:
+    """
+    Regroup the chunks of a stream into parts of exactly part_size bytes, except for the last one.
+    An empty stream yields a single empty part.
+
+    :return: an iterator over the parts
+    """
+    buffer = bytearray()
+    produced = False
+    for chunk in _iter_chunks(stream, part_size):
+        buffer += chunk
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+            produced = True
+    if buffer or not produced:
+        yield bytes(buffer)
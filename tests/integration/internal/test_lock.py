@@ -1,3 +1,6 @@
+import pytest
+import threading
+
 from spccore.internal.lock import *
 
 
@@ -83,3 +86,45 @@ def test_nested_context_managers():
         with Lock(".foo", max_age=datetime.timedelta(seconds=2)) as user2_lock:
             assert user2_lock._has_lock()
         assert user1_lock._has_lock() is False
+
+
+def test_shared_lock():
+    reader1_lock = SharedLock("foo", max_age=datetime.timedelta(seconds=2))
+    reader2_lock = SharedLock("foo", max_age=datetime.timedelta(seconds=2))
+    writer_lock = Lock("foo", max_age=datetime.timedelta(seconds=2))
+
+    with reader1_lock, reader2_lock:
+        assert reader1_lock._has_lock()
+        assert reader2_lock._has_lock()
+        with pytest.raises(LockException):
+            writer_lock.blocking_acquire(timeout=datetime.timedelta(seconds=1))
+        assert writer_lock._has_lock() is False
+
+    with writer_lock:
+        assert reader1_lock._acquire_lock() is False
+    assert reader1_lock._acquire_lock()
+    reader1_lock.release()
+
+
+def test_writer_preference():
+    reader1_lock = SharedLock("foo", max_age=datetime.timedelta(seconds=5))
+    reader2_lock = SharedLock("foo", max_age=datetime.timedelta(seconds=5))
+    writer_lock = Lock("foo", max_age=datetime.timedelta(seconds=5))
+    events = []
+
+    def write():
+        with writer_lock:
+            events.append("write")
+
+    with reader1_lock:
+        writer = threading.Thread(target=write)
+        writer.start()
+        # the waiting writer holds off new readers
+        while not os.path.exists(writer_lock.lock_dir_path):
+            time.sleep(0.01)
+        assert reader2_lock._acquire_lock() is False
+        events.append("read")
+    writer.join()
+    assert events == ["read", "write"]
+    assert reader2_lock._acquire_lock()
+    reader2_lock.release()
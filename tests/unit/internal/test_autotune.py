@@ -0,0 +1,65 @@
+import pytest
+from unittest.mock import patch
+
+from spccore.internal.autotune import *
+
+
+def record_window(tuner, seconds, number_of_bytes=100):
+    """Complete one window of parts that took the given number of seconds"""
+    with patch.object(time, "monotonic", return_value=seconds):
+        tuner._reset_window()
+    with patch.object(time, "monotonic", return_value=2 * seconds):
+        for _ in range(max(tuner.limit, 2)):
+            tuner.record(number_of_bytes)
+
+
+def test_invalid_bounds():
+    with pytest.raises(ValueError):
+        ConcurrencyTuner(maximum=0)
+    with pytest.raises(ValueError):
+        ConcurrencyTuner(maximum=2, minimum=3)
+
+
+def test_initial_limit_within_bounds():
+    assert ConcurrencyTuner(maximum=1).limit == 1
+    assert ConcurrencyTuner(maximum=8, initial=4).limit == 4
+
+
+def test_grows_while_throughput_improves():
+    tuner = ConcurrencyTuner(maximum=8)
+    record_window(tuner, 10)
+    assert tuner.limit == 3
+    record_window(tuner, 5)
+    assert tuner.limit == 4
+
+
+def test_turns_around_when_throughput_stops_improving():
+    tuner = ConcurrencyTuner(maximum=8)
+    record_window(tuner, 10)
+    assert tuner.limit == 3
+    # 3 parts of 100 bytes in 10 seconds is faster, but not by 5%
+    record_window(tuner, 10, number_of_bytes=68)
+    assert tuner.limit == 2
+
+
+def test_stays_within_maximum():
+    tuner = ConcurrencyTuner(maximum=3)
+    record_window(tuner, 10)
+    assert tuner.limit == 3
+    record_window(tuner, 1)
+    assert tuner.limit == 2
+
+
+def test_throttled_halves_and_lowers_ceiling():
+    tuner = ConcurrencyTuner(maximum=16, initial=8)
+    tuner.throttled()
+    assert tuner.limit == 4
+    for seconds in (64, 32, 16, 8, 4, 2):
+        record_window(tuner, seconds)
+    assert tuner.limit <= 7
+
+
+def test_throttled_stays_above_minimum():
+    tuner = ConcurrencyTuner(maximum=4, initial=1)
+    tuner.throttled()
+    assert tuner.limit == 1
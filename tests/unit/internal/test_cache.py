@@ -1,11 +1,14 @@
 import collections
+import itertools
 import pytest
 from unittest.mock import patch, call, mock_open
 
 
 from spccore.internal.cache import *
 from spccore.internal.cache import _cache_dirs, _is_modified, _write_cache_map, _get_cache_map, _get_file_handle_id, \
-    _get_all_non_modified_paths, _purge_cache_dir
+    _purge_cache_dir, _read_purge_checkpoint, _write_purge_checkpoint, \
+    _get_cache_map_without_lock, _get_cache_map_v2, _get_non_modified_paths, _read_cache_map_v2_file, \
+    _get_cache_map_with_shared_lock
 
 
 # test _purge_cache_dir
@@ -185,34 +188,78 @@ def test_private_is_modified_empty_cache_map():
 
 
 # test _write_cache_map
-def test_private_write_cache_map_cache_dir_not_exist(cache_dir):
-    to_write = {}
-    cache_map_file = os.path.join(cache_dir, SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME)
-    with patch.object(os.path, "exists", return_value=False) as mock_exists, \
-            patch.object(os, "makedirs") as mock_makedirs, \
-            patch("builtins.open", mock_open()) as mock_file, \
-            patch.object(json, "dump") as mock_json_dump:
-        _write_cache_map(to_write, cache_dir)
-        mock_exists.assert_called_once_with(cache_dir)
-        mock_makedirs.assert_called_once_with(cache_dir)
-        mock_file.assert_called_once_with(cache_map_file, 'w')
-        mock_json_dump.assert_called_once_with(to_write, mock_file())
-        mock_file().write.assert_called_once_with('\n')
+def test_private_write_cache_map_cache_dir_not_exist(tmp_path):
+    cache_dir = str(tmp_path / "456" / "123456")
+    _write_cache_map({"/a": "2019-07-01T00:00:00.000Z"}, cache_dir)
+    with open(os.path.join(cache_dir, SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME), 'r') as f:
+        # the trailing new line is for R's JSON parser
+        assert f.read() == '{"/a": "2019-07-01T00:00:00.000Z"}\n'
+    assert os.listdir(cache_dir) == [SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME]
 
 
-def test_private_write_cache_map_cache_dir_exist(cache_dir):
-    to_write = {}
+def test_private_write_cache_map_cache_dir_exist(tmp_path):
+    cache_dir = str(tmp_path)
     cache_map_file = os.path.join(cache_dir, SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME)
-    with patch.object(os.path, "exists", return_value=True) as mock_exists, \
-            patch.object(os, "makedirs") as mock_makedirs, \
-            patch("builtins.open", mock_open()) as mock_file, \
-            patch.object(json, "dump") as mock_json_dump:
-        _write_cache_map(to_write, cache_dir)
-        mock_exists.assert_called_once_with(cache_dir)
-        mock_makedirs.assert_not_called()
-        mock_file.assert_called_once_with(cache_map_file, 'w')
-        mock_json_dump.assert_called_once_with(to_write, mock_file())
-        mock_file().write.assert_called_once_with('\n')
+    _write_cache_map({"/a": "2019-07-01T00:00:00.000Z"}, cache_dir)
+    with patch.object(os, "replace", wraps=os.replace) as mock_replace:
+        _write_cache_map({}, cache_dir)
+        # published by renaming a complete file over the cache map
+        temp_file, target = mock_replace.call_args[0]
+        assert target == cache_map_file and temp_file.endswith(CACHE_MAP_TEMP_FILE_SUFFIX)
+    assert _get_cache_map(cache_dir) == {}
+    assert os.listdir(cache_dir) == [SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME]
+
+
+def test_private_write_cache_map_failure_keeps_cache_map(tmp_path):
+    cache_dir = str(tmp_path)
+    _write_cache_map({"/a": "2019-07-01T00:00:00.000Z"}, cache_dir)
+    with patch.object(json, "dump", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            _write_cache_map({}, cache_dir)
+    assert _get_cache_map(cache_dir) == {"/a": "2019-07-01T00:00:00.000Z"}
+    assert os.listdir(cache_dir) == [SYNAPSE_DEFAULT_CACHE_MAP_FILE_NAME]
+
+
+# test _get_cache_map_without_lock
+def test_private_get_cache_map_without_lock(cache_dir):
+    with patch("spccore.internal.cache._get_cache_map", return_value={}) as mock_get_cache_map, \
+            patch.object(Lock, "blocking_acquire") as mock_lock:
+        assert _get_cache_map_without_lock(cache_dir) == {}
+        mock_get_cache_map.assert_called_once_with(cache_dir)
+        mock_lock.assert_not_called()
+
+
+def test_private_get_cache_map_without_lock_torn_read(cache_dir):
+    with patch("spccore.internal.cache._get_cache_map", side_effect=[ValueError(), {}]) as mock_get_cache_map, \
+            patch.object(Lock, "blocking_acquire", return_value=True) as mock_lock:
+        assert _get_cache_map_without_lock(cache_dir) == {}
+        assert mock_get_cache_map.call_count == 2
+        mock_lock.assert_called_once_with()
+
+
+def test_private_get_cache_map_without_lock_torn_read_takes_exclusive_lock(cache_dir):
+    with patch("spccore.internal.cache._get_cache_map", side_effect=[ValueError(), {}]), \
+            patch.object(Lock, "blocking_acquire", autospec=True, return_value=True) as mock_lock:
+        assert _get_cache_map_without_lock(cache_dir) == {}
+        assert type(mock_lock.call_args[0][0]) is Lock
+
+
+# test _get_cache_map_with_shared_lock
+def test_private_get_cache_map_with_shared_lock(cache_dir):
+    with patch("spccore.internal.cache._get_cache_map", return_value={}) as mock_get_cache_map, \
+            patch.object(Lock, "blocking_acquire", autospec=True, return_value=True) as mock_lock:
+        assert _get_cache_map_with_shared_lock(cache_dir) == {}
+        mock_get_cache_map.assert_called_once_with(cache_dir)
+        assert [type(args[0]) for args, _ in mock_lock.call_args_list] == [SharedLock]
+
+
+def test_private_get_cache_map_with_shared_lock_rewritten_in_place(cache_dir):
+    # an older client that does not wait for shared holders was rewriting the map
+    with patch("spccore.internal.cache._get_cache_map", side_effect=[ValueError(), {}]) as mock_get_cache_map, \
+            patch.object(Lock, "blocking_acquire", autospec=True, return_value=True) as mock_lock:
+        assert _get_cache_map_with_shared_lock(cache_dir) == {}
+        assert mock_get_cache_map.call_count == 2
+        assert [type(args[0]) for args, _ in mock_lock.call_args_list] == [SharedLock, Lock]
 
 
 # test _get_cache_map
@@ -238,26 +285,55 @@ def test_private_get_cache_map_exist(cache_dir):
         mock_json_load.assert_called_once_with(mock_file())
 
 
-# test _get_all_non_modified_paths
-def test_private_get_all_non_modified_paths(cache_dir):
+# test _get_non_modified_paths
+def test_private_get_non_modified_paths(tmp_path):
+    modified = write_file(str(tmp_path), "file.txt", 1561939381)
+    unmodified = write_file(str(tmp_path), "file2.txt", 1561939381)
     cache_map = collections.OrderedDict([
-        ("/some/path/to/file.txt", '2019-07-01T00:00:00.000Z'),
-        ("/some/other/path/to/file2.txt", '2019-07-01T00:03:01.000Z')
+        (modified, '2019-07-01T00:00:00.000Z'),
+        (unmodified, from_epoch_time_to_iso(1561939381)),
+        ("/not/exist.txt", '2019-07-01T00:03:01.000Z')
     ])
+    assert _get_non_modified_paths(cache_map) == [unmodified]
 
-    def side_effect(path):
-        values = {
-            "/some/path/to/file.txt": '2019-07-01T00:00:00.001Z',
-            "/some/other/path/to/file2.txt": '2019-07-01T00:03:01.000Z'
-        }
-        return values[path]
 
-    with patch("spccore.internal.cache._get_cache_map", return_value=cache_map) as mock_get_cache_map, \
-            patch("spccore.internal.cache.get_modified_time_in_iso", side_effect=side_effect) as mock_get_mtime_in_iso:
-        assert _get_all_non_modified_paths(cache_dir) == ["/some/other/path/to/file2.txt"]
-        mock_get_cache_map.assert_called_once_with(cache_dir)
-        mock_get_mtime_in_iso.assert_has_calls([call("/some/path/to/file.txt"),
-                                                call("/some/other/path/to/file2.txt")])
+def test_private_get_non_modified_paths_with_cache_map_v2(tmp_path):
+    path = write_file(str(tmp_path), "file.txt", 1561939381)
+    cache_map = {path: from_epoch_time_to_iso(1561939381)}
+    stat = os.stat(path)
+    assert _get_non_modified_paths(cache_map, {path: (stat.st_mtime_ns, stat.st_size)}) == [path]
+    # a rewrite within the same second, found by the nanosecond modified time or the size
+    assert _get_non_modified_paths(cache_map, {path: (stat.st_mtime_ns - 1, stat.st_size)}) == []
+    assert _get_non_modified_paths(cache_map, {path: (stat.st_mtime_ns, stat.st_size + 1)}) == []
+
+
+def test_private_get_non_modified_paths_stats_once(tmp_path):
+    path = write_file(str(tmp_path), "file.txt", 1561939381)
+    with patch.object(os, "stat", wraps=os.stat) as mock_stat:
+        assert _get_non_modified_paths({path: from_epoch_time_to_iso(1561939381)}) == [path]
+        mock_stat.assert_called_once_with(path)
+
+
+# test _get_cache_map_v2
+def test_private_get_cache_map_v2(tmp_path):
+    cache_dir = str(tmp_path)
+    with open(os.path.join(cache_dir, CACHE_MAP_V2_FILE_NAME), 'w') as f:
+        json.dump({"/a": {"modifiedTime": "2019-07-01T00:00:00.000Z", "modifiedTimeNs": 1, "size": 2},
+                   "/b": {"modifiedTime": "2019-07-01T00:00:00.000Z", "modifiedTimeNs": 3, "size": 4},
+                   "/c": {"modifiedTime": "2019-07-01T00:00:00.000Z"}}, f)
+    # /b was registered again by a client that does not write the cache map v2
+    cache_map = {"/a": "2019-07-01T00:00:00.000Z",
+                 "/b": "2019-07-02T00:00:00.000Z",
+                 "/c": "2019-07-01T00:00:00.000Z"}
+    assert _get_cache_map_v2(cache_dir, cache_map) == {"/a": (1, 2)}
+
+
+def test_private_get_cache_map_v2_unreadable(tmp_path):
+    cache_dir = str(tmp_path)
+    assert _get_cache_map_v2(cache_dir, {"/a": "2019-07-01T00:00:00.000Z"}) == {}
+    with open(os.path.join(cache_dir, CACHE_MAP_V2_FILE_NAME), 'w') as f:
+        f.write("{")
+    assert _get_cache_map_v2(cache_dir, {"/a": "2019-07-01T00:00:00.000Z"}) == {}
 
 
 @pytest.fixture
@@ -297,6 +373,9 @@ class TestCache:
     def test_constructor_with_custom_cache_location(self, custom_cache):
         assert custom_cache.cache_root_dir == CUSTOM_CACHE_LOCATION
 
+    def test_constructor_shares_hashing_service(self, cache):
+        assert cache.hashing_service is get_hashing_service()
+
     def test_constructor_with_invalid_cache_location(self):
         with pytest.raises(TypeError):
             Cache(cache_root_dir=123)
@@ -326,7 +405,7 @@ class TestCache:
     def test_get_all_unmodified_cached_file_paths_cache_dir_not_exists(self, cache, file_handle_id, cache_dir):
         with patch.object(Lock, "blocking_acquire", return_value=True) as mock_lock, \
                 patch.object(os.path, "exists", return_value=False) as mock_exists, \
-                patch("spccore.internal.cache._get_all_non_modified_paths",
+                patch("spccore.internal.cache._get_non_modified_paths",
                       return_value=list(cache_dir)) as mock_private:
             assert cache.get_all_unmodified_cached_file_paths(file_handle_id) == list()
             mock_lock.assert_not_called()
@@ -336,12 +415,72 @@ class TestCache:
     def test_get_all_unmodified_cached_file_paths_cache_dir_exists(self, cache, file_handle_id, cache_dir):
         with patch.object(Lock, "blocking_acquire", return_value=True) as mock_lock, \
                 patch.object(os.path, "exists", return_value=True) as mock_exists, \
-                patch("spccore.internal.cache._get_all_non_modified_paths",
+                patch("spccore.internal.cache._get_cache_map", return_value={}) as mock_get_cache_map, \
+                patch("spccore.internal.cache._get_non_modified_paths",
                       return_value=list(cache_dir)) as mock_private:
             assert cache.get_all_unmodified_cached_file_paths(file_handle_id) == list(cache_dir)
             mock_lock.assert_called_once_with()
             mock_exists.assert_called_once_with(cache_dir)
-            mock_private.assert_called_once_with(cache_dir)
+            mock_get_cache_map.assert_called_once_with(cache_dir)
+            mock_private.assert_called_once_with({}, {})
+
+    def test_get_all_unmodified_cached_file_paths_reuses_parsed_cache_map(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path))
+        path = normalize_path(str(tmp_path / "a.txt"))
+        with open(path, 'w') as f:
+            f.write("a")
+        cache.register(1, path)
+        assert cache.get_all_unmodified_cached_file_paths(1) == [path]
+        with patch.object(Lock, "blocking_acquire") as mock_lock, \
+                patch("spccore.internal.cache._get_cache_map") as mock_get_cache_map:
+            assert cache.get_all_unmodified_cached_file_paths(1) == [path]
+            mock_lock.assert_not_called()
+            mock_get_cache_map.assert_not_called()
+
+    def test_get_all_unmodified_cached_file_paths_finds_rewrite_within_a_second(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path))
+        path = write_file(str(tmp_path), "a.txt", 1561939381)
+        cache.register(1, path)
+        # R clients read a cache map of ISO modified times
+        assert _get_cache_map(cache.get_cache_dir(1)) == {path: from_epoch_time_to_iso(1561939381)}
+        assert cache.get_all_unmodified_cached_file_paths(1) == [path]
+        with open(path, 'w') as f:
+            f.write("rewritten")
+        os.utime(path, (1561939381.5, 1561939381.5))
+        assert get_modified_time_in_iso(path) == from_epoch_time_to_iso(1561939381)
+        assert cache.get_all_unmodified_cached_file_paths(1) == []
+
+    def test_get_all_unmodified_cached_file_paths_lock_free(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path), lock_free_reads=True)
+        path = normalize_path(str(tmp_path / "a.txt"))
+        with open(path, 'w') as f:
+            f.write("a")
+        cache.register(1, path)
+        cache._parsed_cache_maps.clear()
+        with patch.object(Lock, "blocking_acquire") as mock_lock:
+            assert cache.get_all_unmodified_cached_file_paths(1) == [path]
+            mock_lock.assert_not_called()
+
+    def test_get_all_unmodified_cached_file_paths_rereads_changed_cache_map(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path))
+        path = normalize_path(str(tmp_path / "a.txt"))
+        with open(path, 'w') as f:
+            f.write("a")
+        cache.register(1, path)
+        assert cache.get_all_unmodified_cached_file_paths(1) == [path]
+        # another client empties the cache map
+        _write_cache_map({}, cache.get_cache_dir(1))
+        assert cache.get_all_unmodified_cached_file_paths(1) == []
+
+    def test_get_all_unmodified_cached_file_paths_parsed_cache_maps_bounded(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path), max_parsed_cache_maps=1)
+        path = normalize_path(str(tmp_path / "a.txt"))
+        with open(path, 'w') as f:
+            f.write("a")
+        for file_handle_id in (1, 2):
+            cache.register(file_handle_id, path)
+            cache.get_all_unmodified_cached_file_paths(file_handle_id)
+        assert list(cache._parsed_cache_maps._entries) == [cache.get_cache_dir(2)]
 
     # test register
     def test_register_invalid_file_handle_id_type(self, cache):
@@ -371,23 +510,41 @@ class TestCache:
 
     def test_register_file_path_exist(self, cache, file_handle_id, file_path, cache_dir):
         iso_time = '2019-07-01T00:03:01.000Z'
+        entry = {'modifiedTime': iso_time, 'modifiedTimeNs': 1561940581000000000, 'size': 1}
         expected_cache_map = {file_path: iso_time}
         with patch.object(os.path, "exists", return_value=True) as mock_exists, \
                 patch("spccore.internal.cache.Cache.get_cache_dir", return_value=cache_dir) as mock_get_cache_dir, \
-                patch("spccore.internal.cache.get_modified_time_in_iso", return_value=iso_time) as mock_get_mtime, \
+                patch("spccore.internal.cache._get_cache_map_v2_entry", return_value=entry) as mock_get_entry, \
                 patch.object(Lock, "blocking_acquire", return_value=True) as mock_lock, \
                 patch("spccore.internal.cache._get_cache_map", return_value={}) as mock_get_cache_map, \
+                patch("spccore.internal.cache._read_cache_map_v2_file", return_value={}), \
+                patch("spccore.internal.cache._write_cache_map_v2") as mock_write_cache_map_v2, \
                 patch("spccore.internal.cache._write_cache_map") as mock_write_cache_map, \
                 patch("spccore.internal.cache._renew_lock") as mock_renew:
             assert expected_cache_map == cache.register(file_handle_id, file_path)
             mock_exists.assert_called_once_with(file_path)
             mock_get_cache_dir.assert_called_once_with(file_handle_id)
-            mock_get_mtime.assert_called_once_with(normalize_path(file_path))
+            mock_get_entry.assert_called_once_with(normalize_path(file_path), None)
             mock_lock.assert_called_once_with()
             mock_get_cache_map.assert_called_once_with(cache_dir)
+            mock_write_cache_map_v2.assert_called_once_with({normalize_path(file_path): entry}, cache_dir)
             mock_write_cache_map.assert_called_once_with(expected_cache_map, cache_dir)
             assert mock_renew.call_count == 1
 
+    # test register_if_content_matches
+    def test_register_if_content_matches(self, cache, file_handle_id, file_path):
+        with patch.object(cache.hashing_service, "md5_of_file", return_value="abc") as mock_md5, \
+                patch("spccore.internal.cache.Cache.register") as mock_register:
+            assert cache.register_if_content_matches(file_handle_id, file_path, "abc")
+            mock_md5.assert_called_once_with(file_path)
+            mock_register.assert_called_once_with(file_handle_id, file_path, content_md5="abc")
+
+    def test_register_if_content_matches_md5_differs(self, cache, file_handle_id, file_path):
+        with patch.object(cache.hashing_service, "md5_of_file", return_value="abc"), \
+                patch("spccore.internal.cache.Cache.register") as mock_register:
+            assert not cache.register_if_content_matches(file_handle_id, file_path, "def")
+            mock_register.assert_not_called()
+
     # test remove
     def test_remove_with_invalid_input(self, cache):
         with pytest.raises(TypeError):
@@ -511,3 +668,361 @@ class TestCache:
             mock_private_cache_dirs.assert_called_once_with(SYNAPSE_DEFAULT_CACHE_ROOT_DIR)
             mock_purge_cache_dir.assert_has_calls([call(before_date, cache_dir, True),
                                                    call(before_date, other_dir, True)])
+
+
+# test register_many and lookup_many
+
+class TestBatchOperations:
+
+    def test_register_many(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path / "cache"))
+        paths = [write_file(str(tmp_path), name, 0) for name in ("a.txt", "b.txt", "c.txt")]
+        missing_path = str(tmp_path / "missing.txt")
+        with patch.object(Lock, "blocking_acquire", autospec=True, side_effect=Lock.blocking_acquire) as mock_lock, \
+                patch("spccore.internal.cache._write_cache_map", wraps=_write_cache_map) as mock_write_cache_map:
+            results = cache.register_many([(1, paths[0]), (2, paths[1]), (1, missing_path), (1, paths[2])],
+                                          max_threads=2)
+            # one lock and one write per cache map
+            assert mock_lock.call_count == 2
+            assert mock_write_cache_map.call_count == 2
+        assert results[:2] == [None, None] and results[3] is None
+        assert isinstance(results[2], ValueError)
+        assert sorted(cache.get_all_unmodified_cached_file_paths(1)) == [paths[0], paths[2]]
+        assert cache.get_all_unmodified_cached_file_paths(2) == [paths[1]]
+
+    def test_register_many_lock_failure(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path / "cache"))
+        path = write_file(str(tmp_path), "a.txt", 0)
+        error = LockException("Could not obtain a lock")
+        with patch.object(Lock, "blocking_acquire", side_effect=error):
+            assert cache.register_many([(1, path), (1, path)]) == [error, error]
+
+    def test_register_many_invalid_input(self, cache):
+        with pytest.raises(TypeError):
+            cache.register_many([("1", "a.txt")])
+
+    def test_lookup_many(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path / "cache"))
+        path = write_file(str(tmp_path), "a.txt", 0)
+        cache.register(1, path)
+        with patch("spccore.internal.cache.Cache._get_all_unmodified_cached_file_paths",
+                   side_effect=lambda file_handle_id: [path] if file_handle_id == 1 else []) as mock_lookup:
+            assert cache.lookup_many([1, 2, 1], max_threads=2) == [[path], [], [path]]
+            # each cache map is read once
+            assert mock_lookup.call_count == 2
+
+    def test_lookup_many_invalid_input(self, cache):
+        with pytest.raises(TypeError):
+            cache.lookup_many(["1"])
+
+
+# test the cache with an index
+
+def write_file(directory, name, mtime):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write(name)
+    os.utime(path, (mtime, mtime))
+    return normalize_path(path)
+
+
+class TestIndexedCache:
+
+    JULY_1 = from_datetime_to_epoch_time(datetime.datetime(2019, 7, 1))
+    JULY_3 = from_datetime_to_epoch_time(datetime.datetime(2019, 7, 3))
+
+    def test_constructor_builds_index_from_cache_maps(self, tmp_path):
+        cache_root_dir = str(tmp_path)
+        path = write_file(cache_root_dir, "a.txt", self.JULY_1)
+        Cache(cache_root_dir=cache_root_dir).register(1, path)
+        with patch("spccore.internal.cache._get_cache_map") as mock_get_cache_map:
+            indexed_cache = Cache(cache_root_dir=cache_root_dir, use_index=True)
+            assert indexed_cache.get_all_unmodified_cached_file_paths(1) == [path]
+            mock_get_cache_map.assert_not_called()
+
+    def test_register_and_remove_update_index(self, tmp_path):
+        cache_root_dir = str(tmp_path)
+        cache = Cache(cache_root_dir=cache_root_dir, use_index=True)
+        path = write_file(cache_root_dir, "a.txt", self.JULY_1)
+        cache.register(1, path)
+        assert cache._index.get_cache_map(1) == _get_cache_map(cache.get_cache_dir(1))
+        assert cache.get_all_unmodified_cached_file_paths(1) == [path]
+        cache.remove(1, file_path=path)
+        assert cache._index.get_cache_map(1) == {}
+        assert cache.get_all_unmodified_cached_file_paths(1) == []
+
+    def test_purge_visits_only_old_cache_dirs(self, tmp_path):
+        cache_root_dir = str(tmp_path)
+        cache = Cache(cache_root_dir=cache_root_dir, use_index=True)
+        old_path = write_file(cache_root_dir, "old.txt", self.JULY_1)
+        new_path = write_file(cache_root_dir, "new.txt", self.JULY_3)
+        cache.register(1, old_path)
+        cache.register(1, new_path)
+        cache.register(2, new_path)
+        with patch("spccore.internal.cache._purge_cache_dir", wraps=_purge_cache_dir) as mock_purge_cache_dir:
+            assert cache.purge(datetime.datetime(2019, 7, 2)) == [old_path]
+            mock_purge_cache_dir.assert_called_once_with(datetime.datetime(2019, 7, 2), cache.get_cache_dir(1), False,
+                                                         index=cache._index)
+        assert not os.path.exists(old_path)
+        assert cache._index.get_cache_map(1) == _get_cache_map(cache.get_cache_dir(1))
+        assert cache.get_all_unmodified_cached_file_paths(1) == [new_path]
+
+    def test_purge_cache_dir_removed_by_other_client(self, tmp_path):
+        cache_root_dir = str(tmp_path)
+        cache = Cache(cache_root_dir=cache_root_dir, use_index=True)
+        cache.register(1, write_file(cache_root_dir, "a.txt", self.JULY_1))
+        shutil.rmtree(cache.get_cache_dir(1))
+        assert cache.purge(datetime.datetime(2019, 7, 2)) == []
+        assert cache._index.get_cache_map(1) == {}
+
+    def test_index_lookup_validates_nanosecond_modified_time(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path), use_index=True)
+        path = write_file(str(tmp_path), "a.txt", self.JULY_1)
+        cache.register(1, path)
+        stat = os.stat(path)
+        assert cache._index.get_cache_map_with_stats(1)[1] == {path: (stat.st_mtime_ns, stat.st_size)}
+        assert cache.get_all_unmodified_cached_file_paths(1) == [path]
+        # a rewrite within the same second, also after a rebuild from the cache maps
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert cache.get_all_unmodified_cached_file_paths(1) == []
+        cache.rebuild_index()
+        assert cache.get_all_unmodified_cached_file_paths(1) == []
+
+    def test_rebuild_index_without_index(self, cache):
+        with pytest.raises(ValueError):
+            cache.rebuild_index()
+
+
+# test the cache with a capacity
+
+class TestBoundedCache:
+
+    @pytest.fixture(autouse=True)
+    def increasing_time(self):
+        # entries registered or looked up one after the other never share an access time
+        with patch("spccore.internal.cacheindex.time.time", side_effect=itertools.count()):
+            yield
+
+    def write_cached_file(self, cache, file_handle_id, size):
+        cache_dir = cache.get_cache_dir(file_handle_id)
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, "file.txt")
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return normalize_path(path)
+
+    def test_constructor_uses_index(self, tmp_path):
+        assert Cache(cache_root_dir=str(tmp_path), max_entries=1)._index is not None
+
+    def test_register_evicts_least_recently_used_entries(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path / "cache"), max_entries=2)
+        outside_path = write_file(str(tmp_path), "outside.txt", 0)
+        cache.register(1, outside_path)
+        paths = [self.write_cached_file(cache, file_handle_id, 1) for file_handle_id in (2, 3)]
+        cache.register(2, paths[0])
+        # a lookup makes entry 1 more recently used than entry 2
+        assert cache.get_all_unmodified_cached_file_paths(1) == [outside_path]
+        cache.register(3, paths[1])
+        assert cache.get_all_unmodified_cached_file_paths(2) == []
+        assert _get_cache_map(cache.get_cache_dir(2)) == {}
+        assert not os.path.exists(paths[0])
+        assert cache.get_all_unmodified_cached_file_paths(1) == [outside_path]
+        assert cache.get_all_unmodified_cached_file_paths(3) == [paths[1]]
+
+    def test_register_evicts_files_under_cache_root_over_max_bytes(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path / "cache"), max_bytes=25)
+        outside_path = write_file(str(tmp_path), "outside.txt", 0)
+        cache.register(1, outside_path)
+        paths = [self.write_cached_file(cache, file_handle_id, 10) for file_handle_id in (2, 3, 4)]
+        for file_handle_id, path in zip((2, 3, 4), paths):
+            cache.register(file_handle_id, path)
+        assert [os.path.exists(path) for path in paths] == [False, True, True]
+        # the file outside the cache root does not count, so it is kept although it is the least recently used
+        assert cache.get_all_unmodified_cached_file_paths(1) == [outside_path]
+        assert cache._index.get_usage() == (3, 20)
+
+    def test_register_keeps_entry_over_max_bytes(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path), max_bytes=5)
+        path = self.write_cached_file(cache, 1, 10)
+        cache.register(1, path)
+        assert cache.get_all_unmodified_cached_file_paths(1) == [path]
+
+    def test_evict(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path))
+        paths = [self.write_cached_file(cache, file_handle_id, 1) for file_handle_id in (1, 2)]
+        for file_handle_id, path in zip((1, 2), paths):
+            cache.register(file_handle_id, path)
+        assert cache.evict() == []
+        bounded_cache = Cache(cache_root_dir=str(tmp_path), max_entries=1)
+        assert bounded_cache.evict() == [paths[0]]
+        assert not os.path.exists(paths[0])
+
+
+# test iter_purge
+
+class TestIterPurge:
+
+    JULY_1 = from_datetime_to_epoch_time(datetime.datetime(2019, 7, 1))
+    BEFORE_DATE = datetime.datetime(2019, 7, 2)
+    FILE_HANDLE_IDS = (1, 1001, 2, 3)
+
+    @pytest.fixture
+    def setup(self, tmp_path):
+        cache_root_dir = str(tmp_path / "cache")
+        files_dir = str(tmp_path / "files")
+        os.makedirs(files_dir)
+        cache = Cache(cache_root_dir=cache_root_dir)
+        paths = []
+        for file_handle_id in self.FILE_HANDLE_IDS:
+            path = write_file(files_dir, "{}.txt".format(file_handle_id), self.JULY_1)
+            cache.register(file_handle_id, path)
+            paths.append(path)
+        return cache, paths
+
+    def checkpoint(self, cache):
+        return _read_purge_checkpoint(os.path.join(cache.cache_root_dir, CACHE_PURGE_CHECKPOINT_FILE_NAME))
+
+    def test_iter_purge(self, setup):
+        cache, paths = setup
+        assert sorted(cache.iter_purge(self.BEFORE_DATE, max_threads=2)) == sorted(paths)
+        assert not any(os.path.exists(path) for path in paths)
+        assert list(_cache_dirs(cache.cache_root_dir)) == []
+        assert not os.path.exists(os.path.join(cache.cache_root_dir, CACHE_PURGE_CHECKPOINT_FILE_NAME))
+
+    def test_iter_purge_dry_run(self, setup):
+        cache, paths = setup
+        assert list(cache.iter_purge(self.BEFORE_DATE, dry_run=True, max_files=1, max_threads=1)) == paths[:1]
+        assert all(os.path.exists(path) for path in paths)
+        assert not os.path.exists(os.path.join(cache.cache_root_dir, CACHE_PURGE_CHECKPOINT_FILE_NAME))
+
+    def test_iter_purge_max_files_resumes(self, setup):
+        cache, paths = setup
+        # bucket 1 holds file handles 1 and 1001; the purge stops within it, so the next one starts over at it
+        assert list(cache.iter_purge(self.BEFORE_DATE, max_files=1, max_threads=1)) == [paths[0]]
+        assert self.checkpoint(cache) == 1
+        assert list(cache.iter_purge(self.BEFORE_DATE, max_files=1, max_threads=1)) == [paths[1]]
+        assert self.checkpoint(cache) == 2
+        assert list(cache.iter_purge(self.BEFORE_DATE, max_threads=1)) == paths[2:]
+        assert not os.path.exists(os.path.join(cache.cache_root_dir, CACHE_PURGE_CHECKPOINT_FILE_NAME))
+
+    def test_iter_purge_wraps_around(self, setup):
+        cache, paths = setup
+        _write_purge_checkpoint(os.path.join(cache.cache_root_dir, CACHE_PURGE_CHECKPOINT_FILE_NAME), 3)
+        assert list(cache.iter_purge(self.BEFORE_DATE, max_threads=1)) == [paths[3]] + paths[:3]
+
+    def test_iter_purge_time_budget_spent(self, setup):
+        cache, paths = setup
+        assert list(cache.iter_purge(self.BEFORE_DATE, time_budget_sec=0)) == []
+        assert all(os.path.exists(path) for path in paths)
+        assert self.checkpoint(cache) == 1
+
+    def test_iter_purge_closed_early(self, setup):
+        cache, paths = setup
+        removed = cache.iter_purge(self.BEFORE_DATE, max_threads=1)
+        assert next(removed) == paths[0]
+        removed.close()
+        assert self.checkpoint(cache) == 2
+
+    def test_iter_purge_with_index(self, setup):
+        cache, paths = setup
+        indexed_cache = Cache(cache_root_dir=cache.cache_root_dir, use_index=True)
+        with patch("spccore.internal.cache._get_buckets") as mock_get_buckets:
+            assert sorted(indexed_cache.iter_purge(self.BEFORE_DATE)) == sorted(paths)
+            mock_get_buckets.assert_not_called()
+        assert indexed_cache._index.get_cache_map(1) == {}
+
+    def test_iter_purge_invalid_date(self, cache):
+        with pytest.raises(TypeError):
+            cache.iter_purge(0)
+
+
+class TestDedupe:
+
+    JULY_1 = from_datetime_to_epoch_time(datetime.datetime(2019, 7, 1))
+
+    @pytest.fixture
+    def cache(self, tmp_path):
+        return Cache(cache_root_dir=str(tmp_path), dedupe=True)
+
+    def write(self, cache, name, content):
+        path = os.path.join(cache.cache_root_dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        os.utime(path, (self.JULY_1, self.JULY_1))
+        return normalize_path(path)
+
+    def test_register_links_to_copy_with_same_content(self, cache):
+        first = self.write(cache, "first.txt", "content")
+        second = self.write(cache, "second.txt", "content")
+        cache.register(1, first, content_md5="abc")
+        cache.register(2, second, content_md5="abc")
+        assert os.stat(first).st_ino == os.stat(second).st_ino
+        assert cache.get_all_unmodified_cached_file_paths(1) == [first]
+        assert cache.get_all_unmodified_cached_file_paths(2) == [second]
+        assert sorted(cache.get_all_unmodified_cached_file_paths_with_content("abc")) == [first, second]
+
+    def test_register_without_dedupe_records_content(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path), use_index=True)
+        first = self.write(cache, "first.txt", "content")
+        second = self.write(cache, "second.txt", "content")
+        cache.register(1, first, content_md5="abc")
+        cache.register(2, second, content_md5="abc")
+        assert os.stat(first).st_ino != os.stat(second).st_ino
+        assert sorted(cache.get_all_unmodified_cached_file_paths_with_content("abc")) == [first, second]
+
+    def test_register_keeps_content_md5_of_unchanged_file(self, cache):
+        path = self.write(cache, "a.txt", "content")
+        cache.register(1, path, content_md5="abc")
+        cache.register(1, path)
+        assert cache.get_all_unmodified_cached_file_paths_with_content("abc") == [path]
+        assert _read_cache_map_v2_file(cache.get_cache_dir(1))[path]['contentMd5'] == "abc"
+
+    def test_register_does_not_link_to_modified_copy(self, cache):
+        first = self.write(cache, "first.txt", "content")
+        second = self.write(cache, "second.txt", "content")
+        cache.register(1, first, content_md5="abc")
+        with open(first, 'w') as f:
+            f.write("changed")
+        cache.register(2, second, content_md5="abc")
+        assert os.stat(first).st_ino != os.stat(second).st_ino
+        assert cache.get_all_unmodified_cached_file_paths_with_content("abc") == [second]
+
+    def test_get_all_unmodified_cached_file_paths_with_content_without_index(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path))
+        path = self.write(cache, "a.txt", "content")
+        cache.register(1, path, content_md5="abc")
+        assert cache.get_all_unmodified_cached_file_paths_with_content("abc") == []
+
+    def test_dedupe_files(self, tmp_path):
+        cache = Cache(cache_root_dir=str(tmp_path), use_index=True)
+        first = self.write(cache, "first.txt", "content")
+        second = self.write(cache, "second.txt", "content")
+        other = self.write(cache, "other.txt", "CONTENT")
+        cache.register(1, first)
+        cache.register(2, second)
+        cache.register(3, other)
+        assert cache.dedupe_files(dry_run=True) == []
+        linked = cache.dedupe_files()
+        assert len(linked) == 1
+        assert os.stat(first).st_ino == os.stat(second).st_ino
+        assert os.stat(first).st_ino != os.stat(other).st_ino
+        # the replaced file is registered again with the stat of the shared file
+        assert cache.get_all_unmodified_cached_file_paths(1) == [first]
+        assert cache.get_all_unmodified_cached_file_paths(2) == [second]
+        assert cache.get_all_unmodified_cached_file_paths(3) == [other]
+        md5 = cache.hashing_service.md5_of_file(first)
+        assert sorted(cache.get_all_unmodified_cached_file_paths_with_content(md5)) == [first, second]
+        assert cache.dedupe_files() == []
+
+    def test_dedupe_files_dry_run(self, cache):
+        first = self.write(cache, "first.txt", "content")
+        second = self.write(cache, "second.txt", "content")
+        cache.register(1, first)
+        cache.register(2, second, content_md5="abc")
+        cache._index.set_cache_map(1, _get_cache_map(cache.get_cache_dir(1)), {first: "abc"})
+        assert cache.dedupe_files(dry_run=True) == [second]
+        assert os.stat(first).st_ino != os.stat(second).st_ino
+
+    def test_dedupe_files_without_index(self, tmp_path):
+        with pytest.raises(ValueError):
+            Cache(cache_root_dir=str(tmp_path)).dedupe_files()
@@ -0,0 +1,178 @@
+import itertools
+import json
+import os
+import pytest
+from unittest.mock import patch
+
+from spccore.internal.cacheindex import *
+from spccore.internal.pathutils import normalize_path
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = CacheIndex(str(tmp_path / "index.sqlite"))
+    yield index
+    index.close()
+
+
+def test_constructor_creates_index(tmp_path):
+    index_path = str(tmp_path / "dir" / "index.sqlite")
+    index = CacheIndex(index_path)
+    assert index.created
+    index.close()
+    index = CacheIndex(index_path)
+    assert not index.created
+    index.close()
+
+
+def test_set_cache_map(index):
+    index.set_cache_map(1, {"/a": "2019-07-01T00:00:00.000Z", "/b": "2019-07-02T00:00:00.000Z"})
+    index.set_cache_map(2, {"/c": "2019-07-03T00:00:00.000Z"})
+    index.set_cache_map(1, {"/b": "2019-07-04T00:00:00.000Z"})
+    assert index.get_cache_map(1) == {"/b": "2019-07-04T00:00:00.000Z"}
+    assert index.get_cache_map(2) == {"/c": "2019-07-03T00:00:00.000Z"}
+    assert index.get_cache_map(3) == {}
+
+
+def test_set_cache_map_records_size(index, tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_bytes(b"content")
+    index.set_cache_map(1, {str(path): "2019-07-01T00:00:00.000Z", "/missing": "2019-07-01T00:00:00.000Z"})
+    sizes = dict(index._connection.execute("SELECT path, size FROM cache_entries"))
+    assert sizes == {str(path): len(b"content"), "/missing": None}
+
+
+def test_set_cache_map_keeps_registered_time_of_unchanged_entries(index):
+    index.set_cache_map(1, {"/a": "2019-07-01T00:00:00.000Z"})
+    registered_time = index._connection.execute("SELECT registered_time FROM cache_entries").fetchone()[0]
+    index.set_cache_map(1, {"/a": "2019-07-01T00:00:00.000Z", "/b": "2019-07-01T00:00:00.000Z"})
+    assert index._connection.execute("SELECT registered_time FROM cache_entries WHERE path = '/a'").fetchone()[0] \
+        == registered_time
+
+
+def test_get_file_handle_ids_modified_before(index):
+    index.set_cache_map(3, {"/a": "2019-07-01T00:00:00.000Z", "/b": "2019-08-01T00:00:00.000Z"})
+    index.set_cache_map(1, {"/c": "2019-07-02T00:00:00.000Z"})
+    index.set_cache_map(2, {"/d": "2019-09-01T00:00:00.000Z"})
+    assert index.get_file_handle_ids_modified_before("2019-07-02T00:00:00.000Z") == [1, 3]
+    assert index.get_file_handle_ids_modified_before("2019-01-01T00:00:00.000Z") == []
+
+
+def test_rebuild(index, tmp_path):
+    index.set_cache_map(9, {"/stale": "2019-07-01T00:00:00.000Z"})
+    cache_map_path = str(tmp_path / "1.cacheMap")
+    with open(cache_map_path, 'w') as f:
+        json.dump({"/a": "2019-07-01T00:00:00.000Z"}, f)
+    corrupted_path = str(tmp_path / "2.cacheMap")
+    with open(corrupted_path, 'w') as f:
+        f.write("{")
+    index.rebuild([(1, cache_map_path), (2, corrupted_path), (3, str(tmp_path / "missing"))])
+    assert index.get_cache_map(1) == {"/a": "2019-07-01T00:00:00.000Z"}
+    assert index.get_cache_map(9) == {}
+    registered_time = index._connection.execute("SELECT registered_time FROM cache_entries").fetchone()[0]
+    assert registered_time == os.path.getmtime(cache_map_path)
+
+
+def test_rebuild_reads_content_md5s(index, tmp_path):
+    cache_dir = tmp_path / "1"
+    cache_dir.mkdir()
+    cache_map_path = str(cache_dir / ".cacheMap")
+    with open(cache_map_path, 'w') as f:
+        json.dump({"/a": "2019-07-01T00:00:00.000Z", "/b": "2019-07-02T00:00:00.000Z"}, f)
+    with open(str(cache_dir / CACHE_MAP_V2_FILE_NAME), 'w') as f:
+        # /b was registered again without its content MD5
+        json.dump({"/a": {"modifiedTime": "2019-07-01T00:00:00.000Z", "contentMd5": "abc"},
+                   "/b": {"modifiedTime": "2019-07-01T00:00:00.000Z", "contentMd5": "def"}}, f)
+    index.rebuild([(1, cache_map_path)])
+    assert index.get_entries_with_content("abc") == [(1, "/a")]
+    assert index.get_entries_with_content("def") == []
+
+
+def test_rebuild_reads_stats(index, tmp_path):
+    cache_dir = tmp_path / "1"
+    cache_dir.mkdir()
+    cache_map_path = str(cache_dir / ".cacheMap")
+    with open(cache_map_path, 'w') as f:
+        json.dump({"/a": "2019-07-01T00:00:00.000Z", "/b": "2019-07-02T00:00:00.000Z"}, f)
+    with open(str(cache_dir / CACHE_MAP_V2_FILE_NAME), 'w') as f:
+        json.dump({"/a": {"modifiedTime": "2019-07-01T00:00:00.000Z", "modifiedTimeNs": 5, "size": 3},
+                   "/b": {"modifiedTime": "2019-07-01T00:00:00.000Z", "modifiedTimeNs": 6, "size": 4}}, f)
+    index.rebuild([(1, cache_map_path)])
+    assert index.get_cache_map_with_stats(1) == ({"/a": "2019-07-01T00:00:00.000Z",
+                                                  "/b": "2019-07-02T00:00:00.000Z"},
+                                                 {"/a": (5, 3)})
+
+
+def test_set_cache_map_records_stats(index):
+    index.set_cache_map(1, {"/a": "2019-07-01T00:00:00.000Z"}, {"/a": "abc"}, {"/a": (5, 3)})
+    # unchanged entries keep their stats and content MD5, entries registered with another stat lose the MD5
+    index.set_cache_map(1, {"/a": "2019-07-01T00:00:00.000Z"})
+    assert index.get_cache_map_with_stats(1)[1] == {"/a": (5, 3)}
+    index.set_cache_map(1, {"/a": "2019-07-01T00:00:00.000Z"}, stats={"/a": (5, 3)})
+    assert index.get_entries_with_content("abc") == [(1, "/a")]
+    index.set_cache_map(1, {"/a": "2019-07-01T00:00:00.000Z"}, stats={"/a": (6, 3)})
+    assert index.get_cache_map_with_stats(1)[1] == {"/a": (6, 3)}
+    assert index.get_entries_with_content("abc") == []
+
+
+def test_set_cache_map_records_content_md5(index):
+    index.set_cache_map(1, {"/a": "2019-07-01T00:00:00.000Z"}, {"/a": "abc"})
+    index.set_cache_map(2, {"/b": "2019-07-01T00:00:00.000Z"})
+    index.set_cache_map(2, {"/b": "2019-07-01T00:00:00.000Z"}, {"/b": "abc"})
+    assert sorted(index.get_entries_with_content("abc")) == [(1, "/a"), (2, "/b")]
+    # unchanged entries keep their content MD5, modified ones lose it
+    index.set_cache_map(1, {"/a": "2019-07-01T00:00:00.000Z"})
+    index.set_cache_map(2, {"/b": "2019-07-02T00:00:00.000Z"})
+    assert index.get_entries_with_content("abc") == [(1, "/a")]
+
+
+def test_get_entries_with_shared_size(index, tmp_path):
+    for name, content in (("a", b"123"), ("b", b"456"), ("c", b"1234"), ("d", b""), ("e", b"")):
+        (tmp_path / name).write_bytes(content)
+    paths = {name: str(tmp_path / name) for name in "abcde"}
+    index.set_cache_map(1, {paths["a"]: "2019-07-01T00:00:00.000Z", paths["c"]: "2019-07-01T00:00:00.000Z"},
+                        {paths["a"]: "abc"})
+    index.set_cache_map(2, {paths[name]: "2019-07-01T00:00:00.000Z" for name in "bde"})
+    assert sorted(index.get_entries_with_shared_size()) == [(1, paths["a"], "abc"), (2, paths["b"], None)]
+
+
+def test_get_usage(tmp_path):
+    index = CacheIndex(str(tmp_path / "index.sqlite"))
+    in_root = tmp_path / "in_root.txt"
+    in_root.write_bytes(b"12345")
+    outside_dir = tmp_path.parent / (tmp_path.name + "_outside")
+    outside_dir.mkdir()
+    outside = outside_dir / "outside.txt"
+    outside.write_bytes(b"1234567")
+    index.set_cache_map(1, {normalize_path(str(in_root)): "2019-07-01T00:00:00.000Z",
+                            normalize_path(str(outside)): "2019-07-01T00:00:00.000Z"})
+    assert index.get_usage() == (2, 5)
+    # replacing an entry does not count it twice
+    index.set_cache_map(1, {normalize_path(str(in_root)): "2019-07-02T00:00:00.000Z"})
+    assert index.get_usage() == (1, 5)
+    index.set_cache_map(1, {})
+    assert index.get_usage() == (0, 0)
+    index.close()
+
+
+def test_get_least_recently_used(index):
+    with patch('spccore.internal.cacheindex.time.time', side_effect=itertools.count()):
+        index.set_cache_map(1, {"/a": "2019-07-01T00:00:00.000Z"})
+        index.set_cache_map(2, {"/b": "2019-07-01T00:00:00.000Z"})
+        index.set_cache_map(3, {"/c": "2019-07-01T00:00:00.000Z"})
+        index.touch(1, ["/a"])
+    assert [entry[:2] for entry in index.get_least_recently_used(2)] == [(2, "/b"), (3, "/c")]
+    assert index.get_least_recently_used(2, in_cache_root=True) == []
+
+
+def test_constructor_rebuilds_other_schema_version(tmp_path):
+    index_path = str(tmp_path / "index.sqlite")
+    index = CacheIndex(index_path)
+    index.set_cache_map(1, {"/a": "2019-07-01T00:00:00.000Z"})
+    with index._connection:
+        index._connection.execute("PRAGMA user_version = 1")
+    index.close()
+    index = CacheIndex(index_path)
+    assert index.created
+    assert index.get_cache_map(1) == {}
+    index.close()
@@ -0,0 +1,11 @@
+import pytest
+
+from spccore.internal.contextutils import _null_context
+
+
+def test_null_context():
+    with _null_context() as value:
+        assert value is None
+    with pytest.raises(ValueError):
+        with _null_context():
+            raise ValueError()
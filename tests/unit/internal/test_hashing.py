@@ -0,0 +1,93 @@
+import hashlib
+import os
+import pytest
+from unittest.mock import patch
+
+from spccore.internal.hashing import *
+from spccore.internal.hashing import _md5_of_path
+
+
+@pytest.fixture
+def hashing_service():
+    return HashingService(max_threads=2, max_remembered_files=2)
+
+
+def write(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def test_md5_of_file(hashing_service, tmp_path):
+    path = write(tmp_path, "a.txt", b"content")
+    assert hashing_service.md5_of_file(path) == md5(b"content")
+
+
+@pytest.mark.parametrize("content", [b"", b"abc", b"abcdefgh", b"abcdefghij"])
+def test_md5s_of_file(hashing_service, tmp_path, content):
+    path = write(tmp_path, "a.bin", content)
+    parts = [content[i:i + 4] for i in range(0, len(content), 4)] or [b""]
+    assert hashing_service.md5s_of_file(path, 4) == (md5(content), [md5(part) for part in parts])
+
+
+def test_md5s_of_file_unmapped(hashing_service, tmp_path):
+    path = write(tmp_path, "a.bin", b"abcdefghij")
+    with patch('spccore.internal.hashing.memory_map') as mock_memory_map:
+        mock_memory_map.return_value.__enter__.return_value = None
+        assert hashing_service.md5s_of_file(path, 4) == (md5(b"abcdefghij"),
+                                                         [md5(b"abcd"), md5(b"efgh"), md5(b"ij")])
+
+
+def test_file_is_hashed_once(hashing_service, tmp_path):
+    path = write(tmp_path, "a.bin", b"abcdefghij")
+    with patch('spccore.internal.hashing._md5_of_path', wraps=_md5_of_path) as mock_md5_of_path:
+        content_md5 = hashing_service.md5_of_file(path)
+        assert hashing_service.md5_of_file(path) == content_md5
+    assert mock_md5_of_path.call_count == 1
+    part_md5s = hashing_service.md5s_of_file(path, 4)[1]
+    # the parts of each size are hashed once
+    with patch('spccore.internal.hashing.open') as mock_open:
+        assert hashing_service.md5s_of_file(path, 4) == (content_md5, part_md5s)
+        mock_open.assert_not_called()
+
+
+def test_modified_file_is_hashed_again(hashing_service, tmp_path):
+    path = write(tmp_path, "a.txt", b"content")
+    hashing_service.md5_of_file(path)
+    write(tmp_path, "a.txt", b"other content")
+    assert hashing_service.md5_of_file(path) == md5(b"other content")
+
+
+def test_least_recently_used_files_are_forgotten(hashing_service, tmp_path):
+    paths = [write(tmp_path, name, name.encode()) for name in ("a", "b", "c")]
+    for path in paths:
+        hashing_service.md5_of_file(path)
+    with patch('spccore.internal.hashing._md5_of_path', wraps=_md5_of_path) as mock_md5_of_path:
+        hashing_service.md5_of_file(paths[2])
+        mock_md5_of_path.assert_not_called()
+        hashing_service.md5_of_file(paths[0])
+        mock_md5_of_path.assert_called_once_with(paths[0])
+
+
+def test_md5_of_files(hashing_service, tmp_path):
+    paths = [write(tmp_path, name, name.encode() * 100) for name in ("a", "b", "c")]
+    assert hashing_service.md5_of_files(paths) == [md5(name.encode() * 100) for name in ("a", "b", "c")]
+
+    # a pool of threads, so no process is forked from a process holding live threads
+    with patch('concurrent.futures.ProcessPoolExecutor') as mock_process_pool:
+        hashing_service.max_remembered_files = 0
+        assert hashing_service.md5_of_files(paths) == [md5(name.encode() * 100) for name in ("a", "b", "c")]
+        mock_process_pool.assert_not_called()
+
+
+def test_md5_of_files_missing_file(hashing_service, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        hashing_service.md5_of_files([os.path.join(str(tmp_path), "missing")])
+
+
+def test_get_hashing_service():
+    assert get_hashing_service() is get_hashing_service()
@@ -2,6 +2,7 @@ import pytest
 from unittest.mock import patch, call
 
 from spccore.internal.lock import *
+from spccore.internal.lock import _has_fresh_readers
 
 
 @pytest.fixture
@@ -303,3 +304,97 @@ class TestLock:
             assert mock_time.call_count == 2
             mock_acquire_lock.assert_has_calls([call(break_old_locks=False)])
             mock_doze.assert_not_called()
+
+    def test_blocking_acquire_waits_for_readers(self, lock):
+        with patch.object(time, "time", side_effect=(0, 1, 2)), \
+                patch.object(lock, "_acquire_lock", return_value=True), \
+                patch("spccore.internal.lock._has_fresh_readers", side_effect=(True, False)) as mock_has_readers, \
+                patch.object(lock, "_update_lock_time") as mock_update_lock_time, \
+                patch("spccore.internal.lock.doze") as mock_doze:
+            assert lock.blocking_acquire()
+            mock_has_readers.assert_has_calls([call(lock.readers_dir_path, lock.max_age)] * 2)
+            mock_doze.assert_called_once_with(LOCK_SHARED_WAIT_TIME_SEC)
+            mock_update_lock_time.assert_called_once_with()
+
+    def test_blocking_acquire_readers_timeout(self, lock):
+        with pytest.raises(LockException), \
+                patch.object(time, "time", side_effect=(0, 1, 5)), \
+                patch.object(lock, "_acquire_lock", return_value=True), \
+                patch("spccore.internal.lock._has_fresh_readers", return_value=True), \
+                patch.object(lock, "release") as mock_release, \
+                patch("spccore.internal.lock.doze"):
+            lock.blocking_acquire()
+        mock_release.assert_called_once_with()
+
+
+@pytest.fixture
+def shared_lock(tmp_path, name, max_age, timeout):
+    return SharedLock(name, current_working_directory=str(tmp_path), max_age=max_age, default_blocking_timeout=timeout)
+
+
+class TestSharedLock:
+
+    def test_readers_share_the_lock(self, tmp_path, name, max_age):
+        reader1 = SharedLock(name, current_working_directory=str(tmp_path), max_age=max_age)
+        reader2 = SharedLock(name, current_working_directory=str(tmp_path), max_age=max_age)
+        assert reader1._acquire_lock()
+        assert reader2._acquire_lock()
+        assert reader1.reader_file_path != reader2.reader_file_path
+        assert len(os.listdir(reader1.readers_dir_path)) == 2
+
+    def test_private_acquire_lock_with_writer(self, shared_lock):
+        os.makedirs(shared_lock.lock_dir_path)
+        assert shared_lock._acquire_lock() is False
+        assert not os.path.exists(shared_lock.reader_file_path)
+
+    def test_private_acquire_lock_with_old_writer(self, shared_lock):
+        os.makedirs(shared_lock.lock_dir_path)
+        os.utime(shared_lock.lock_dir_path, (0, time.time() - 2))
+        assert shared_lock._acquire_lock(break_old_locks=False) is False
+        assert shared_lock._acquire_lock()
+
+    def test_private_acquire_lock_backs_off_from_racing_writer(self, shared_lock):
+        with patch.object(shared_lock, "_writer_present", side_effect=(False, True)):
+            assert shared_lock._acquire_lock() is False
+        assert not os.path.exists(shared_lock.reader_file_path)
+
+    def test_release(self, shared_lock):
+        assert shared_lock._acquire_lock()
+        assert shared_lock._has_lock()
+        shared_lock.release()
+        assert shared_lock._has_lock() is False
+        assert not os.path.exists(shared_lock.readers_dir_path)
+
+    def test_release_keeps_other_readers(self, tmp_path, name, shared_lock):
+        other_reader = SharedLock(name, current_working_directory=str(tmp_path))
+        assert shared_lock._acquire_lock()
+        assert other_reader._acquire_lock()
+        shared_lock.release()
+        assert other_reader._has_lock()
+
+    def test_renew(self, shared_lock):
+        assert shared_lock._acquire_lock()
+        os.utime(shared_lock.reader_file_path, (0, time.time() - 0.5))
+        assert shared_lock._get_age() >= 0.5
+        assert shared_lock.renew() is False
+        shared_lock.last_updated_time = from_epoch_time_to_iso(os.path.getmtime(shared_lock.reader_file_path))
+        assert shared_lock.renew()
+        assert shared_lock._get_age() < 0.5
+
+
+class TestHasFreshReaders:
+
+    def test_no_readers(self, tmp_path, max_age):
+        assert _has_fresh_readers(str(tmp_path / "missing"), max_age) is False
+
+    def test_removes_old_readers(self, tmp_path, max_age):
+        (tmp_path / "fresh").write_text("")
+        (tmp_path / "old").write_text("")
+        os.utime(str(tmp_path / "old"), (0, time.time() - 2))
+        assert _has_fresh_readers(str(tmp_path), max_age)
+        assert os.listdir(str(tmp_path)) == ["fresh"]
+
+    def test_only_old_readers(self, tmp_path, max_age):
+        (tmp_path / "old").write_text("")
+        os.utime(str(tmp_path / "old"), (0, time.time() - 2))
+        assert _has_fresh_readers(str(tmp_path), max_age) is False
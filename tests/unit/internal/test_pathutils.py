@@ -1,3 +1,7 @@
+import errno
+import os
+
+import pytest
 from unittest.mock import patch
 
 from spccore.internal.pathutils import *
@@ -67,3 +71,97 @@ def test_normalize_path_with_windows_path():
         assert normalize_path(windows_path) == linux_path
         mock_abspath.assert_called_once_with(windows_path)
         mock_normcase.assert_called_once_with(windows_path)
+
+
+# test materialize_file
+def test_materialize_file(tmp_path):
+    source = tmp_path / "source.txt"
+    source.write_text("content")
+    destination = tmp_path / "sub" / "destination.txt"
+    with patch.object(os, "link") as mock_link:
+        materialize_file(str(source), str(destination))
+        mock_link.assert_not_called()
+    assert destination.read_text() == "content"
+    assert os.stat(str(source)).st_ino != os.stat(str(destination)).st_ino
+    assert not os.path.exists(str(destination) + MATERIALIZE_TEMP_FILE_SUFFIX)
+
+
+def test_materialize_file_with_hardlink(tmp_path):
+    source = tmp_path / "source.txt"
+    source.write_text("content")
+    destination = tmp_path / "sub" / "destination.txt"
+    materialize_file(str(source), str(destination), hardlink=True)
+    assert destination.read_text() == "content"
+    assert os.stat(str(source)).st_ino == os.stat(str(destination)).st_ino
+    assert not os.path.exists(str(destination) + MATERIALIZE_TEMP_FILE_SUFFIX)
+
+
+def test_materialize_file_fall_back_to_copy(tmp_path):
+    source = tmp_path / "source.txt"
+    source.write_text("content")
+    destination = tmp_path / "destination.txt"
+    destination.write_text("old content")
+    with patch.object(os, "link", side_effect=OSError()) as mock_link, \
+            patch("spccore.internal.pathutils._reflink", side_effect=OSError()) as mock_reflink:
+        materialize_file(str(source), str(destination), hardlink=True)
+        mock_link.assert_called_once()
+        mock_reflink.assert_called_once()
+    assert destination.read_text() == "content"
+    assert os.stat(str(source)).st_ino != os.stat(str(destination)).st_ino
+
+
+def test_materialize_file_with_missing_source(tmp_path):
+    destination = tmp_path / "destination.txt"
+    with pytest.raises(OSError):
+        materialize_file(str(tmp_path / "missing.txt"), str(destination))
+    assert not destination.exists()
+    assert not os.path.exists(str(destination) + MATERIALIZE_TEMP_FILE_SUFFIX)
+
+
+# test link_file
+def test_link_file(tmp_path):
+    source = tmp_path / "source.txt"
+    source.write_text("content")
+    destination = tmp_path / "destination.txt"
+    destination.write_text("content")
+    link_file(str(source), str(destination))
+    assert os.stat(str(source)).st_ino == os.stat(str(destination)).st_ino
+    assert not os.path.exists(str(destination) + MATERIALIZE_TEMP_FILE_SUFFIX)
+
+
+def test_link_file_failure_keeps_destination(tmp_path):
+    source = tmp_path / "source.txt"
+    source.write_text("content")
+    destination = tmp_path / "destination.txt"
+    destination.write_text("content")
+    with pytest.raises(OSError), patch.object(os, "link", side_effect=OSError()):
+        link_file(str(source), str(destination))
+    assert destination.read_text() == "content"
+    assert os.stat(str(source)).st_ino != os.stat(str(destination)).st_ino
+
+
+def test_get_free_disk_space_of_missing_directory(tmp_path):
+    device, free = get_free_disk_space(str(tmp_path / "not" / "created"))
+    assert device == os.stat(str(tmp_path)).st_dev
+    assert free > 0
+
+
+def test_preallocate_file(tmp_path):
+    with open(str(tmp_path / "out"), 'wb') as f:
+        preallocate_file(f, 1024)
+        f.write(b"abc")
+        f.truncate()
+    assert os.path.getsize(str(tmp_path / "out")) == 3
+
+
+def test_preallocate_file_no_space(tmp_path):
+    with open(str(tmp_path / "out"), 'wb') as f, \
+            patch.object(os, "posix_fallocate", side_effect=OSError(errno.ENOSPC, "No space left"), create=True), \
+            pytest.raises(OSError):
+        preallocate_file(f, 1024)
+
+
+def test_preallocate_file_not_supported(tmp_path):
+    with open(str(tmp_path / "out"), 'wb') as f, \
+            patch.object(os, "posix_fallocate", side_effect=OSError(errno.EOPNOTSUPP, "Not supported"), create=True):
+        preallocate_file(f, 1024)
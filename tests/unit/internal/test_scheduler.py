@@ -0,0 +1,79 @@
+import threading
+
+import pytest
+from unittest.mock import patch
+
+from spccore.internal.scheduler import *
+
+
+@pytest.fixture
+def scheduler():
+    return TransferScheduler(max_in_flight_parts=1)
+
+
+def test_get_transfer_scheduler_is_shared():
+    assert get_transfer_scheduler() is get_transfer_scheduler()
+
+
+def test_invalid_limits(scheduler):
+    with pytest.raises(ValueError):
+        scheduler.max_in_flight_parts = 0
+    with pytest.raises(ValueError):
+        scheduler.max_bytes_per_second = 0
+
+
+def test_channel_invalid_priority(scheduler):
+    with pytest.raises(ValueError):
+        scheduler.channel("urgent")
+
+
+def test_channel_equality(scheduler):
+    assert scheduler.channel(TRANSFER_PRIORITY_BULK) == scheduler.channel(TRANSFER_PRIORITY_BULK)
+    assert scheduler.channel(TRANSFER_PRIORITY_BULK) != scheduler.channel(TRANSFER_PRIORITY_INTERACTIVE)
+    assert scheduler.channel(TRANSFER_PRIORITY_BULK) != TransferScheduler().channel(TRANSFER_PRIORITY_BULK)
+
+
+def test_slot_counts_in_flight_parts(scheduler):
+    with scheduler.channel(TRANSFER_PRIORITY_BULK).slot():
+        assert scheduler.in_flight_parts == 1
+    assert scheduler.in_flight_parts == 0
+
+
+def test_slot_serves_interactive_before_bulk(scheduler):
+    order = []
+    threads = []
+    with scheduler.slot(TRANSFER_PRIORITY_BULK):
+        for priority in (TRANSFER_PRIORITY_BULK, TRANSFER_PRIORITY_INTERACTIVE):
+            def transfer(priority=priority):
+                with scheduler.slot(priority):
+                    order.append(priority)
+            thread = threading.Thread(target=transfer)
+            thread.start()
+            threads.append(thread)
+            # wait for the thread to queue up
+            while scheduler._waiting_for_slot[priority] == 0:
+                pass
+    for thread in threads:
+        thread.join()
+    assert order == [TRANSFER_PRIORITY_INTERACTIVE, TRANSFER_PRIORITY_BULK]
+
+
+def test_throttle_without_cap_does_not_wait(scheduler):
+    with patch.object(scheduler._condition, "wait") as mock_wait:
+        scheduler.throttle(10 ** 12, TRANSFER_PRIORITY_BULK)
+        mock_wait.assert_not_called()
+
+
+def test_throttle_waits_out_the_debt():
+    clock = [0.0]
+
+    def wait(timeout=None):
+        clock[0] += timeout
+
+    with patch.object(time, "monotonic", side_effect=lambda: clock[0]):
+        scheduler = TransferScheduler(max_bytes_per_second=100)
+        with patch.object(scheduler._condition, "wait", side_effect=wait):
+            for _ in range(5):
+                scheduler.throttle(100, TRANSFER_PRIORITY_BULK)
+    # 500 bytes at 100 bytes per second, less the first second the bucket grants up front
+    assert 4 <= clock[0] <= 5
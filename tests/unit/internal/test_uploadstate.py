@@ -0,0 +1,66 @@
+import os
+
+from spccore.internal.uploadstate import *
+
+
+def make_file(tmp_path, content=b"content"):
+    path = tmp_path / "a.bin"
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_load_missing_state(tmp_path):
+    state = UploadState.load(str(tmp_path / "state"), make_file(tmp_path))
+    assert (state.upload_id, state.content_md5, state.part_size) == (None, None, None)
+    assert state.size == 7
+
+
+def test_round_trip(tmp_path):
+    path = make_file(tmp_path)
+    state = UploadState.load(str(tmp_path / "state"), path)
+    state.begin("md5", 8, "7")
+
+    loaded = UploadState.load(str(tmp_path / "state"), path)
+    assert (loaded.upload_id, loaded.content_md5, loaded.part_size) == ("7", "md5", 8)
+
+
+def test_begin_same_upload_does_not_write(tmp_path):
+    path = make_file(tmp_path)
+    state = UploadState.load(str(tmp_path / "state"), path)
+    state.begin("md5", 8, "7")
+
+    loaded = UploadState.load(str(tmp_path / "state"), path)
+    os.remove(loaded.state_path)
+    loaded.begin("md5", 8, "7")
+    assert not os.path.exists(loaded.state_path)
+    loaded.begin("md5", 8, "8")
+    assert UploadState.load(str(tmp_path / "state"), path).upload_id == "8"
+
+
+def test_load_discards_state_of_modified_file(tmp_path):
+    path = make_file(tmp_path)
+    state = UploadState.load(str(tmp_path / "state"), path)
+    state.begin("md5", 8, "7")
+    make_file(tmp_path, b"other content")
+
+    loaded = UploadState.load(str(tmp_path / "state"), path)
+    assert loaded.upload_id is None
+    assert not os.path.exists(state.state_path)
+
+
+def test_load_discards_corrupted_state(tmp_path):
+    path = make_file(tmp_path)
+    state = UploadState.load(str(tmp_path / "state"), path)
+    state.begin("md5", 8, "7")
+    with open(state.state_path, 'w') as f:
+        f.write("{not json")
+
+    assert UploadState.load(str(tmp_path / "state"), path).upload_id is None
+
+
+def test_remove(tmp_path):
+    state = UploadState.load(str(tmp_path / "state"), make_file(tmp_path))
+    state.begin("md5", 8, "7")
+    state.remove()
+    assert not os.path.exists(state.state_path)
+    state.remove()
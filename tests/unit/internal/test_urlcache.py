@@ -0,0 +1,152 @@
+import pytest
+from unittest.mock import patch, Mock
+
+from spccore.internal.urlcache import *
+
+
+AWS_V4_URL = "https://bucket.s3.amazonaws.com/key?X-Amz-Algorithm=AWS4-HMAC-SHA256" \
+             "&X-Amz-Date=20190701T000000Z&X-Amz-Expires=900&X-Amz-Signature=abc"
+AWS_V4_URL_EXPIRY = 1561939200 + 900
+
+
+def file_result(key, url=AWS_V4_URL):
+    return {'fileHandleId': str(key[0]), 'preSignedURL': url}
+
+
+@pytest.fixture
+def fetch():
+    return Mock(side_effect=lambda keys: {key: file_result(key) for key in keys})
+
+
+@pytest.fixture
+def url_cache(fetch):
+    return PresignedUrlCache(fetch, batch_size=2)
+
+
+@pytest.fixture
+def key():
+    return 123, "syn1", "FileEntity"
+
+
+# test get_presigned_url_expiry
+
+def test_get_presigned_url_expiry_aws_v4():
+    assert get_presigned_url_expiry(AWS_V4_URL) == AWS_V4_URL_EXPIRY
+
+
+def test_get_presigned_url_expiry_google_v4():
+    url = "https://storage.googleapis.com/bucket/key?X-Goog-Date=20190701T000000Z&X-Goog-Expires=60"
+    assert get_presigned_url_expiry(url) == 1561939200 + 60
+
+
+def test_get_presigned_url_expiry_v2():
+    assert get_presigned_url_expiry("https://bucket.s3.amazonaws.com/key?Expires=1561939200&Signature=a") \
+        == 1561939200
+
+
+def test_get_presigned_url_expiry_unknown():
+    assert get_presigned_url_expiry("https://example.com/key") is None
+    assert get_presigned_url_expiry("https://example.com/key?Expires=tomorrow") is None
+
+
+class TestPresignedUrlCache:
+
+    def test_get_reuses_url(self, url_cache, fetch, key):
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY - 300):
+            assert url_cache.get(key) == file_result(key)
+            assert url_cache.get(key) == file_result(key)
+        fetch.assert_called_once_with([key])
+
+    def test_get_refreshes_before_expiry(self, url_cache, fetch, key):
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY - 300):
+            url_cache.get(key)
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY - 30):
+            url_cache.get(key)
+        assert fetch.call_count == 2
+
+    def test_get_refreshes_expiring_urls_in_bulk(self, url_cache, fetch, key):
+        other = (456, "syn2", "FileEntity")
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY - 300):
+            url_cache.prefetch([key, other])
+        renewed_url = AWS_V4_URL.replace("T000000Z", "T001000Z")
+        fetch.side_effect = lambda keys: {k: file_result(k, url=renewed_url) for k in keys}
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY - 30):
+            url_cache.get(key)
+            fetch.assert_called_with([key, other])
+            url_cache.get(other)
+        assert fetch.call_count == 2
+
+    def test_get_uses_default_time_to_live(self, fetch, key):
+        fetch.side_effect = lambda keys: {k: file_result(k, url="https://example.com/key") for k in keys}
+        url_cache = PresignedUrlCache(fetch, default_time_to_live=datetime.timedelta(minutes=5))
+        with patch.object(time, "time", return_value=1000):
+            url_cache.get(key)
+        with patch.object(time, "time", return_value=1000 + 200):
+            url_cache.get(key)
+        assert fetch.call_count == 1
+        with patch.object(time, "time", return_value=1000 + 250):
+            url_cache.get(key)
+        assert fetch.call_count == 2
+
+    def test_get_missing_result(self, fetch, key):
+        fetch.side_effect = lambda keys: {}
+        url_cache = PresignedUrlCache(fetch)
+        assert url_cache.get(key) == {'fileHandleId': '123', 'failureCode': 'NOT_FOUND'}
+
+    def test_prefetch_in_batches(self, url_cache, fetch):
+        keys = [(i, "syn1", "FileEntity") for i in range(3)]
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY - 300):
+            url_cache.prefetch(keys + keys)
+            fetch.assert_any_call(keys[:2])
+            fetch.assert_any_call(keys[2:])
+            assert fetch.call_count == 2
+            url_cache.prefetch(keys)
+            assert fetch.call_count == 2
+
+    def test_invalidate(self, url_cache, fetch, key):
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY - 300):
+            url_cache.get(key)
+            url_cache.invalidate(key)
+            url_cache.get(key)
+        assert fetch.call_count == 2
+
+    def test_get_refreshes_only_pending_urls(self, url_cache, fetch, key):
+        done = (456, "syn2", "FileEntity")
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY - 300):
+            url_cache.prefetch([key, done])
+            url_cache.release([done])
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY - 30):
+            url_cache.get(key)
+        fetch.assert_called_with([key])
+
+    def test_get_refreshes_expired_pending_urls(self, url_cache, fetch, key):
+        other = (456, "syn2", "FileEntity")
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY - 300):
+            url_cache.prefetch([key, other])
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY + 1):
+            url_cache.get(other)
+        fetch.assert_called_with([other, key])
+
+    def test_release(self, url_cache, key):
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY - 300):
+            url_cache.get(key)
+        url_cache.release([key])
+        assert url_cache._entries == {}
+        assert len(url_cache._pending) == 0
+
+    def test_get_drops_expired_url(self, url_cache, key):
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY - 300):
+            url_cache.get(key)
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY + 1):
+            assert url_cache._get_fresh(key) is None
+        assert key not in url_cache._entries
+
+    def test_max_entries(self, fetch):
+        url_cache = PresignedUrlCache(fetch, max_entries=2)
+        keys = [(i, "syn1", "FileEntity") for i in range(3)]
+        with patch.object(time, "time", return_value=AWS_V4_URL_EXPIRY - 300):
+            url_cache.prefetch(keys)
+            assert list(url_cache._entries) == keys[1:]
+            assert list(url_cache._pending) == keys[1:]
+            assert url_cache.get(keys[0]) == file_result(keys[0])
+            assert len(url_cache._entries) == 2
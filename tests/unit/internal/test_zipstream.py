@@ -0,0 +1,85 @@
+import io
+import pytest
+import zipfile
+
+from spccore.internal.zipstream import *
+
+
+class UnseekableBuffer(io.RawIOBase):
+    """Makes zipfile write data descriptors, like the archives Synapse streams"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+
+MEMBERS = [("a.txt", b"hello " * 1000), ("dir/b.bin", bytes(range(256))), ("empty.txt", b"")]
+
+
+def make_zip(members, compression, *, seekable=True):
+    buffer = io.BytesIO() if seekable else UnseekableBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=compression) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    return bytes(buffer.getvalue() if seekable else buffer.data)
+
+
+def chunked(data, size=7):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_iter_zip_members(compression):
+    archive = make_zip(MEMBERS, compression)
+    assert [(name, b"".join(content)) for name, content in iter_zip_members(chunked(archive))] == MEMBERS
+
+
+def test_iter_zip_members_data_descriptors():
+    archive = make_zip(MEMBERS, zipfile.ZIP_DEFLATED, seekable=False)
+    assert [(name, b"".join(content)) for name, content in iter_zip_members(chunked(archive))] == MEMBERS
+
+
+def test_iter_zip_members_skips_unread_content():
+    archive = make_zip(MEMBERS, zipfile.ZIP_DEFLATED, seekable=False)
+    assert [name for name, _ in iter_zip_members(chunked(archive))] == [name for name, _ in MEMBERS]
+
+
+def test_iter_zip_members_bad_crc():
+    archive = bytearray(make_zip(MEMBERS[:1], zipfile.ZIP_STORED))
+    # flip a byte of the content, which follows the 30 bytes of the header and the name
+    archive[30 + len("a.txt")] ^= 0xFF
+    with pytest.raises(zipfile.BadZipFile):
+        for _, content in iter_zip_members([bytes(archive)]):
+            b"".join(content)
+
+
+def test_iter_zip_members_bad_crc_raises_before_content_ends():
+    archive = bytearray(make_zip(MEMBERS, zipfile.ZIP_STORED))
+    archive[30 + len("a.txt")] ^= 0xFF
+    members = iter_zip_members([bytes(archive)])
+    name, content = next(members)
+    chunks = []
+    with pytest.raises(zipfile.BadZipFile):
+        for chunk in content:
+            chunks.append(chunk)
+    # every byte was handed out, the check fails before the content iterator ends
+    assert len(b"".join(chunks)) == len(MEMBERS[0][1])
+    # the next members are still read
+    assert [name for name, _ in members] == [name for name, _ in MEMBERS[1:]]
+
+
+def test_iter_zip_members_truncated():
+    archive = make_zip(MEMBERS, zipfile.ZIP_DEFLATED)
+    with pytest.raises(zipfile.BadZipFile):
+        for _, content in iter_zip_members([archive[:100]]):
+            b"".join(content)
+
+
+def test_iter_zip_members_empty_stream():
+    assert list(iter_zip_members([])) == []
@@ -2,10 +2,15 @@ import pytest
 from unittest.mock import patch, Mock
 
 from spccore.baseclient import *
+from spccore.internal.scheduler import get_transfer_scheduler
 from spccore.exceptions import *
 from spccore.baseclient import _enforce_user_agent, _handle_response, _generate_signed_headers, _generate_request_url
 
 
+def interactive_channel(client):
+    return client._transfer_scheduler.channel(TRANSFER_PRIORITY_INTERACTIVE)
+
+
 # _enforce_user_agent
 
 def test__enforce_user_agent_empty():
@@ -169,6 +174,24 @@ class TestSynapseBaseClient:
         assert client._username == username
         assert client._api_key == base64.b64decode(api_key)
         assert client._requests_session is not None
+        assert client._cache.cache_root_dir == SYNAPSE_DEFAULT_CACHE_ROOT_DIR
+        assert client._transfer_scheduler is get_transfer_scheduler()
+
+    def test_constructor_with_custom_cache_root_dir(self):
+        client = SynapseBaseClient(cache_root_dir="here")
+        assert client._cache.cache_root_dir == "here"
+
+    def test_constructor_with_cache_index(self, tmp_path):
+        client = SynapseBaseClient(cache_root_dir=str(tmp_path), use_cache_index=True)
+        assert os.path.exists(client._cache._index.index_path)
+
+    def test_constructor_with_cache_max_bytes(self, tmp_path):
+        client = SynapseBaseClient(cache_root_dir=str(tmp_path), cache_max_bytes=1024)
+        assert client._cache.max_bytes == 1024
+
+    def test_constructor_with_cache_dedupe(self, tmp_path):
+        client = SynapseBaseClient(cache_root_dir=str(tmp_path), cache_dedupe=True)
+        assert client._cache.dedupe
 
     @pytest.fixture
     def client_setup(self):
@@ -336,3 +359,199 @@ class TestSynapseBaseClient:
                                                       username=username,
                                                       api_key=base64.b64decode(api_key),
                                                       headers=None)
+
+    # download_file_handles
+
+    def test_download_file_handles(self, client_setup):
+        _, _, client = client_setup
+        download_requests = [DownloadRequest(1, "syn1", "FileEntity", "a.txt")]
+        results = [DownloadResult("a.txt", DOWNLOAD_STATUS_DOWNLOADED)]
+        with patch('spccore.baseclient._download_file_handles', return_value=results) as mock_download:
+            assert client.download_file_handles(download_requests) == {download_requests[0]: results[0]}
+            mock_download.assert_called_once_with(client,
+                                                  download_requests,
+                                                  cache=client._cache,
+                                                  max_threads=DEFAULT_TRANSFER_MAX_THREADS,
+                                                  channel=interactive_channel(client),
+                                                  progress=None,
+                                                  disk_space_check=None,
+                                                  zip_small_files=False,
+                                                  hardlink_files=False)
+
+    def test_download_file_handles_single_thread(self, client_setup):
+        _, _, client = client_setup
+        with patch('spccore.baseclient._download_file_handles', return_value=[]) as mock_download:
+            client.download_file_handles([], use_multiple_threads=False)
+            mock_download.assert_called_once_with(client, [], cache=client._cache, max_threads=1,
+                                                  channel=interactive_channel(client),
+                                                  progress=None,
+                                                  disk_space_check=None,
+                                                  zip_small_files=False,
+                                                  hardlink_files=False)
+
+    def test_download_file_handles_zip_small_files(self, client_setup):
+        _, _, client = client_setup
+        with patch('spccore.baseclient._download_file_handles', return_value=[]) as mock_download:
+            client.download_file_handles([], zip_small_files=True)
+            assert mock_download.call_args[1]['zip_small_files'] is True
+
+    def test_download_file_handles_hardlink_files(self, client_setup):
+        _, _, client = client_setup
+        with patch('spccore.baseclient._download_file_handles', return_value=[]) as mock_download:
+            client.download_file_handles([], hardlink_files=True)
+            assert mock_download.call_args[1]['hardlink_files'] is True
+
+    def test_download_file_handles_disk_space_check(self, client_setup):
+        _, _, client = client_setup
+        with patch('spccore.baseclient._download_file_handles', return_value=[]) as mock_download:
+            client.download_file_handles([], disk_space_check=DOWNLOAD_DISK_SPACE_CHECK_FAIL)
+            assert mock_download.call_args[1]['disk_space_check'] == DOWNLOAD_DISK_SPACE_CHECK_FAIL
+
+    def test_download_file_handles_invalid_disk_space_check(self, client_setup):
+        _, _, client = client_setup
+        with pytest.raises(ValueError):
+            client.download_file_handles([], disk_space_check="ignore")
+
+    def test_download_file_handles_with_request_batch(self, client_setup):
+        _, _, client = client_setup
+        download_requests = DownloadRequestBatch([DownloadRequest(1, "syn1", "FileEntity", "a.txt")])
+        result_batch = DownloadResultBatch(download_requests)
+        with patch('spccore.baseclient._download_file_handles', return_value=result_batch):
+            assert client.download_file_handles(download_requests) is result_batch
+
+    # download_file_handles_as_completed
+
+    def test_download_file_handles_as_completed(self, client_setup):
+        _, _, client = client_setup
+        download_requests = [DownloadRequest(1, "syn1", "FileEntity", "a.txt"),
+                             DownloadRequest(2, "syn2", "FileEntity", "b.txt")]
+        results = [(1, DownloadResult("b.txt", DOWNLOAD_STATUS_DOWNLOADED)),
+                   (0, DownloadResult("a.txt", DOWNLOAD_STATUS_FROM_CACHE))]
+        with patch('spccore.baseclient._iter_download_file_handles', return_value=iter(results)) as mock_iter:
+            assert list(client.download_file_handles_as_completed(download_requests)) == \
+                [(download_requests[1], results[0][1]), (download_requests[0], results[1][1])]
+            mock_iter.assert_called_once_with(client,
+                                              download_requests,
+                                              cache=client._cache,
+                                              max_threads=DEFAULT_TRANSFER_MAX_THREADS,
+                                              channel=interactive_channel(client),
+                                              progress=None,
+                                              zip_small_files=False,
+                                              hardlink_files=False)
+
+    # upload_file_handle
+
+    def test_upload_file_handle(self, client_setup, tmp_path):
+        _, _, client = client_setup
+        path = str(tmp_path / "a.txt")
+        with open(path, 'w') as f:
+            f.write("content")
+        with patch('spccore.baseclient._upload_file_handle', return_value={'id': '1'}) as mock_upload:
+            assert client.upload_file_handle(path, "text/plain") == {'id': '1'}
+            mock_upload.assert_called_once_with(client,
+                                                path,
+                                                "text/plain",
+                                                generate_preview=False,
+                                                storage_location_id=SYNAPSE_DEFAULT_STORAGE_LOCATION_ID,
+                                                max_threads=UPLOAD_MAX_THREADS,
+                                                channel=interactive_channel(client),
+                                                progress=None,
+                                                state_dir=client._upload_state_dir,
+                                                hashing_service=client._cache.hashing_service)
+
+    def test_upload_file_handle_missing_file(self, client_setup, tmp_path):
+        _, _, client = client_setup
+        with pytest.raises(ValueError):
+            client.upload_file_handle(str(tmp_path / "missing.txt"), "text/plain")
+
+    # upload_file_handles
+
+    def test_upload_file_handles(self, client_setup):
+        _, _, client = client_setup
+        results = [UploadResult("a.txt", {'id': '1'}), UploadResult("b.txt", None, error=OSError())]
+        with patch('spccore.baseclient._upload_file_handles', return_value=results) as mock_upload:
+            assert client.upload_file_handles(["a.txt", "b.txt"], use_multiple_threads=False) == results
+            mock_upload.assert_called_once_with(client,
+                                                ["a.txt", "b.txt"],
+                                                None,
+                                                generate_preview=False,
+                                                storage_location_id=SYNAPSE_DEFAULT_STORAGE_LOCATION_ID,
+                                                max_threads=1,
+                                                channel=interactive_channel(client),
+                                                progress=None,
+                                                state_dir=client._upload_state_dir,
+                                                hashing_service=client._cache.hashing_service)
+
+    def test_upload_file_handles_single_path(self, client_setup):
+        _, _, client = client_setup
+        with pytest.raises(TypeError):
+            client.upload_file_handles("a.txt")
+
+    # upload_file_handle_from_stream
+
+    def test_upload_file_handle_from_stream(self, client_setup):
+        _, _, client = client_setup
+        stream = iter([b"content"])
+        with patch('spccore.baseclient._upload_stream', return_value={'id': '1'}) as mock_upload:
+            assert client.upload_file_handle_from_stream(stream, "a.txt", "text/plain",
+                                                         use_multiple_threads=False) == {'id': '1'}
+            mock_upload.assert_called_once_with(client,
+                                                stream,
+                                                "a.txt",
+                                                "text/plain",
+                                                size=None,
+                                                content_md5=None,
+                                                generate_preview=False,
+                                                storage_location_id=SYNAPSE_DEFAULT_STORAGE_LOCATION_ID,
+                                                max_threads=1,
+                                                max_buffered_parts=UPLOAD_DEFAULT_MAX_BUFFERED_PARTS,
+                                                channel=interactive_channel(client),
+                                                progress=None)
+
+    def test_upload_file_handle_from_stream_invalid_max_buffered_parts(self, client_setup):
+        _, _, client = client_setup
+        with pytest.raises(ValueError):
+            client.upload_file_handle_from_stream(iter([]), "a.txt", "text/plain", max_buffered_parts=0)
+
+    def test_download_file_handles_with_bulk_priority(self, client_setup):
+        _, _, client = client_setup
+        with patch('spccore.baseclient._download_file_handles', return_value=[]) as mock_download:
+            client.download_file_handles([], priority=TRANSFER_PRIORITY_BULK)
+            assert mock_download.call_args[1]['channel'] == client._transfer_scheduler.channel(TRANSFER_PRIORITY_BULK)
+
+    def test_download_file_handles_invalid_priority(self, client_setup):
+        _, _, client = client_setup
+        with pytest.raises(ValueError):
+            client.download_file_handles([], priority="urgent")
+
+    # sync_from_synapse / sync_to_synapse
+
+    def test_sync_from_synapse(self, client_setup):
+        _, _, client = client_setup
+        remote_files = [RemoteFile("a.txt", 1, "syn1", "FileEntity", 1, "md5")]
+        with patch('spccore.baseclient._sync_from_synapse', return_value=SyncResult()) as mock_sync:
+            client.sync_from_synapse(remote_files, "here")
+            mock_sync.assert_called_once_with(client,
+                                              remote_files,
+                                              "here",
+                                              max_threads=DEFAULT_TRANSFER_MAX_THREADS,
+                                              priority=TRANSFER_PRIORITY_BULK,
+                                              progress=None)
+
+    def test_sync_to_synapse(self, client_setup, tmp_path):
+        _, _, client = client_setup
+        with patch('spccore.baseclient._sync_to_synapse', return_value=SyncResult()) as mock_sync:
+            client.sync_to_synapse(str(tmp_path), use_multiple_threads=False)
+            mock_sync.assert_called_once_with(client,
+                                              str(tmp_path),
+                                              (),
+                                              max_threads=1,
+                                              storage_location_id=SYNAPSE_DEFAULT_STORAGE_LOCATION_ID,
+                                              use_multiple_threads=False,
+                                              priority=TRANSFER_PRIORITY_BULK,
+                                              progress=None)
+
+    def test_sync_to_synapse_missing_directory(self, client_setup, tmp_path):
+        _, _, client = client_setup
+        with pytest.raises(ValueError):
+            client.sync_to_synapse(str(tmp_path / "missing"))
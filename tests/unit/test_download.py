@@ -0,0 +1,791 @@
+import functools
+import hashlib
+import io
+import pytest
+import zipfile
+from unittest.mock import patch, Mock, call
+
+from spccore.download import *
+from spccore.download import _check_disk_space, _download_file_handles, _download_from_cache, _download_from_synapse, \
+    _download_from_url, _get_file_handle_batch, _group_by_file_handle_id, _download_group, \
+    _iter_download_file_handles, _get_async_job_response, _select_zip_package, _extract_zip_member
+from spccore.internal.lock import LockException
+from spccore.internal.scheduler import TransferScheduler
+from spccore.progress import TransferProgress
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return Cache(cache_root_dir=str(tmp_path / "cache"))
+
+
+@pytest.fixture
+def content():
+    return b"some content"
+
+
+@pytest.fixture
+def cached_file(tmp_path, cache, content):
+    path = tmp_path / "cached.txt"
+    path.write_bytes(content)
+    cache.register(123, str(path))
+    return str(path)
+
+
+@pytest.fixture
+def response(content):
+    response = Mock(requests.Response)
+    response.status_code = 200
+    response.reason = "OK"
+    response.iter_content.return_value = [content[:4], content[4:]]
+    response.__enter__ = Mock(return_value=response)
+    response.__exit__ = Mock(return_value=False)
+    return response
+
+
+@pytest.fixture
+def client(response):
+    client = Mock()
+    client._default_file_endpoint = SYNAPSE_DEFAULT_FILE_ENDPOINT
+    client._requests_session.get.return_value = response
+    client._presigned_url_cache = PresignedUrlCache(functools.partial(_get_file_handle_batch, client))
+    return client
+
+
+@pytest.fixture
+def url_cache(content):
+    url_cache = Mock(PresignedUrlCache)
+    url_cache.get.return_value = file_result(123, content)
+    return url_cache
+
+
+def file_result(file_handle_id, content):
+    return {'fileHandleId': str(file_handle_id),
+            'fileHandle': {'id': str(file_handle_id), 'contentMd5': hashlib.md5(content).hexdigest()},
+            'preSignedURL': 'https://s3.amazonaws.com/bucket/{}'.format(file_handle_id)}
+
+
+# DownloadRequest / DownloadResult
+
+def test_download_request_equality_and_hash():
+    request = DownloadRequest(1, "syn1", "FileEntity", "a.txt")
+    same = DownloadRequest(1, "syn1", "FileEntity", "a.txt")
+    other = DownloadRequest(1, "syn1", "FileEntity", "b.txt")
+    assert request == same
+    assert hash(request) == hash(same)
+    assert request != other
+    assert {request: 1}[same] == 1
+
+
+def test_download_request_immutable_and_slotted():
+    request = DownloadRequest(1, "syn1", "FileEntity", "a.txt")
+    with pytest.raises(AttributeError):
+        request.path = "b.txt"
+    with pytest.raises(AttributeError):
+        del request.path
+    assert not hasattr(request, '__dict__')
+
+
+def test_download_result_equality_and_hash():
+    error = SynapseNotFoundError()
+    result = DownloadResult("a.txt", DOWNLOAD_STATUS_FAILED, error=error)
+    assert result == DownloadResult("a.txt", DOWNLOAD_STATUS_FAILED, error=error)
+    assert hash(result) == hash(DownloadResult("a.txt", DOWNLOAD_STATUS_FAILED, error=error))
+    assert result != DownloadResult("a.txt", DOWNLOAD_STATUS_DOWNLOADED)
+    with pytest.raises(AttributeError):
+        result.status = DOWNLOAD_STATUS_DOWNLOADED
+    assert not hasattr(result, '__dict__')
+
+
+# DownloadRequestBatch
+
+@pytest.fixture
+def download_requests():
+    return [DownloadRequest(1, "syn1", "FileEntity", "a.txt"),
+            DownloadRequest(2, "syn2", "TableEntity", "b, with comma.txt"),
+            DownloadRequest(3, "syn3", "FileEntity", "c.txt")]
+
+
+def test_download_request_batch(download_requests):
+    batch = DownloadRequestBatch(download_requests)
+    assert len(batch) == 3
+    assert list(batch) == download_requests
+    assert batch[-1] == download_requests[-1]
+    assert list(batch[1:]) == download_requests[1:]
+    with pytest.raises(TypeError):
+        batch.append("not a request")
+
+
+def test_download_request_batch_stores_strings_in_buffers():
+    download_request = DownloadRequest(1, "syn1", "FileEntity", "d\u00e9j\u00e0/\udcff.txt")
+    batch = DownloadRequestBatch([download_request, DownloadRequest(2, "syn2", "FileEntity", "")])
+    assert batch[0] == download_request
+    assert batch[1].path == ""
+    assert isinstance(batch._paths._data, bytearray)
+
+
+@pytest.mark.parametrize("delimiter", [',', '\t'])
+def test_download_request_batch_manifest_round_trip(download_requests, tmp_path, delimiter):
+    manifest = str(tmp_path / "manifest")
+    DownloadRequestBatch(download_requests).to_csv(manifest, delimiter=delimiter)
+    assert list(DownloadRequestBatch.from_csv(manifest, delimiter=delimiter)) == download_requests
+
+
+def test_download_request_batch_manifest_missing_column(tmp_path):
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text("file_handle_id,path\n1,a.txt\n")
+    with pytest.raises(ValueError):
+        DownloadRequestBatch.from_csv(str(manifest))
+
+
+# DownloadResultBatch
+
+def test_download_result_batch(download_requests):
+    batch = DownloadResultBatch(DownloadRequestBatch(download_requests))
+    assert len(batch) == 0
+    error = SynapseNotFoundError(message="not found")
+    batch.set_result(2, DownloadResult("c.txt", DOWNLOAD_STATUS_FAILED, error=error))
+    batch.set_result(0, DownloadResult("a.txt", DOWNLOAD_STATUS_DOWNLOADED))
+    assert len(batch) == 2
+    assert list(batch) == [download_requests[0], download_requests[2]]
+    assert batch[download_requests[2]] == DownloadResult("c.txt", DOWNLOAD_STATUS_FAILED, error=error)
+    with pytest.raises(KeyError):
+        batch[download_requests[1]]
+    assert dict(batch.results()) == {download_requests[0]: DownloadResult("a.txt", DOWNLOAD_STATUS_DOWNLOADED),
+                                     download_requests[2]: DownloadResult("c.txt", DOWNLOAD_STATUS_FAILED,
+                                                                          error=error)}
+
+
+@pytest.mark.parametrize("delimiter", [',', '\t'])
+def test_download_result_batch_manifest_round_trip(download_requests, tmp_path, delimiter):
+    manifest = str(tmp_path / "manifest")
+    batch = DownloadResultBatch(DownloadRequestBatch(download_requests))
+    batch.set_result(0, DownloadResult("a.txt", DOWNLOAD_STATUS_DOWNLOADED))
+    batch.set_result(1, DownloadResult("b, with comma.txt", DOWNLOAD_STATUS_FAILED,
+                                       error=SynapseNotFoundError(message="not found")))
+    batch.to_csv(manifest, delimiter=delimiter)
+
+    restored = DownloadResultBatch.from_csv(manifest, delimiter=delimiter)
+    assert list(restored) == download_requests[:2]
+    assert restored[download_requests[0]] == DownloadResult("a.txt", DOWNLOAD_STATUS_DOWNLOADED)
+    assert restored[download_requests[1]].status == DOWNLOAD_STATUS_FAILED
+    assert restored[download_requests[1]].error.message == "not found"
+
+
+# _download_from_cache
+
+def test__download_from_cache_miss(cache, tmp_path):
+    request = DownloadRequest(123, "syn1", "FileEntity", str(tmp_path / "out.txt"))
+    assert _download_from_cache(cache, request) is None
+
+
+def test__download_from_cache_up_to_date(cache, cached_file):
+    request = DownloadRequest(123, "syn1", "FileEntity", cached_file)
+    with patch("spccore.download.materialize_file") as mock_materialize:
+        result = _download_from_cache(cache, request)
+        mock_materialize.assert_not_called()
+    assert result.status == DOWNLOAD_STATUS_UP_TO_DATE
+    assert result.path == cached_file
+
+
+def test__download_from_cache_materialize(cache, cached_file, tmp_path, content):
+    destination = str(tmp_path / "copy" / "out.txt")
+    request = DownloadRequest(123, "syn1", "FileEntity", destination)
+    result = _download_from_cache(cache, request)
+    assert result.status == DOWNLOAD_STATUS_FROM_CACHE
+    with open(destination, 'rb') as f:
+        assert f.read() == content
+    assert normalize_path(destination) in cache.get_all_unmodified_cached_file_paths(123)
+
+
+def test__download_from_cache_materialize_hardlink(cache, cached_file, tmp_path):
+    destination = str(tmp_path / "copy" / "out.txt")
+    assert _download_from_cache(cache, DownloadRequest(123, "syn1", "FileEntity", destination)).status == \
+        DOWNLOAD_STATUS_FROM_CACHE
+    assert os.stat(destination).st_ino != os.stat(cached_file).st_ino
+    os.remove(destination)
+    assert _download_from_cache(cache, DownloadRequest(123, "syn1", "FileEntity", destination),
+                                hardlink=True).status == DOWNLOAD_STATUS_FROM_CACHE
+    assert os.stat(destination).st_ino == os.stat(cached_file).st_ino
+
+
+def test__download_from_cache_materialize_failed(cache, cached_file, tmp_path):
+    request = DownloadRequest(123, "syn1", "FileEntity", str(tmp_path / "out.txt"))
+    with patch("spccore.download.materialize_file", side_effect=OSError()):
+        assert _download_from_cache(cache, request) is None
+
+
+def test__download_from_cache_lock_timeout(cache, cached_file, tmp_path):
+    request = DownloadRequest(123, "syn1", "FileEntity", str(tmp_path / "out.txt"))
+    error = LockException("timeout")
+    with patch.object(cache, "register", side_effect=error):
+        result = _download_from_cache(cache, request)
+    assert (result.status, result.error) == (DOWNLOAD_STATUS_FAILED, error)
+
+
+# _get_file_handle_batch
+
+def test__get_file_handle_batch(client, content):
+    keys = [(1, "syn1", "FileEntity"), (2, "syn2", "TableEntity")]
+    client.post.return_value = {'requestedFiles': [file_result(1, content), file_result(2, content)]}
+    assert _get_file_handle_batch(client, keys) == {keys[0]: file_result(1, content),
+                                                    keys[1]: file_result(2, content)}
+    client.post.assert_called_once_with('/fileHandle/batch',
+                                        request_body={
+                                            'requestedFiles': [
+                                                {'fileHandleId': '1',
+                                                 'associateObjectId': 'syn1',
+                                                 'associateObjectType': 'FileEntity'},
+                                                {'fileHandleId': '2',
+                                                 'associateObjectId': 'syn2',
+                                                 'associateObjectType': 'TableEntity'}],
+                                            'includePreSignedURLs': True,
+                                            'includeFileHandles': True,
+                                            'includePreviewPreSignedURLs': False},
+                                        endpoint=SYNAPSE_DEFAULT_FILE_ENDPOINT)
+
+
+# _download_from_url
+
+def test__download_from_url(client, response, tmp_path, content):
+    path = str(tmp_path / "dir" / "out.txt")
+    _download_from_url(client._requests_session, "url", path, expected_md5=hashlib.md5(content).hexdigest())
+    with open(path, 'rb') as f:
+        assert f.read() == content
+    assert not os.path.exists(path + DOWNLOAD_TEMP_FILE_SUFFIX)
+    client._requests_session.get.assert_called_once_with("url", stream=True, headers=None)
+
+
+def test__download_from_url_with_channel(client, response, tmp_path, content):
+    scheduler = TransferScheduler(max_in_flight_parts=1)
+    channel = scheduler.channel(TRANSFER_PRIORITY_BULK)
+    throttled = []
+
+    def get(url, **kwargs):
+        assert scheduler.in_flight_parts == 1
+        return response
+
+    client._requests_session.get.side_effect = get
+    with patch.object(scheduler, "throttle", side_effect=lambda n, priority: throttled.append((n, priority))):
+        _download_from_url(client._requests_session, "url", str(tmp_path / "out.txt"), channel=channel)
+    assert throttled == [(4, TRANSFER_PRIORITY_BULK), (len(content) - 4, TRANSFER_PRIORITY_BULK)]
+    assert scheduler.in_flight_parts == 0
+
+
+def test__download_from_url_preallocates(client, response, tmp_path, content):
+    path = str(tmp_path / "out.txt")
+    with patch('spccore.download.preallocate_file') as mock_preallocate:
+        _download_from_url(client._requests_session, "url", path, expected_size=len(content))
+        assert mock_preallocate.call_args[0][1] == len(content)
+
+
+def test__download_from_url_truncates_preallocated_file_on_failure(client, response, tmp_path, content):
+    path = str(tmp_path / "out.txt")
+
+    def iter_content(chunk_size):
+        yield content[:4]
+        raise requests.exceptions.ChunkedEncodingError()
+
+    response.iter_content.side_effect = iter_content
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        _download_from_url(client._requests_session, "url", path, expected_size=len(content) + 1000)
+    assert os.path.getsize(path + DOWNLOAD_TEMP_FILE_SUFFIX) == 4
+
+
+def test__download_from_url_md5_mismatch(client, tmp_path):
+    path = str(tmp_path / "out.txt")
+    with pytest.raises(SynapseMd5MismatchError):
+        _download_from_url(client._requests_session, "url", path, expected_md5="0" * 32)
+    assert not os.path.exists(path)
+
+
+def test__download_from_url_resumes_partial_file(client, response, tmp_path, content):
+    path = str(tmp_path / "out.txt")
+    with open(path + DOWNLOAD_TEMP_FILE_SUFFIX, 'wb') as f:
+        f.write(content[:4])
+    response.status_code = 206
+    response.iter_content.return_value = [content[4:]]
+    _download_from_url(client._requests_session, "url", path, expected_md5=hashlib.md5(content).hexdigest())
+    with open(path, 'rb') as f:
+        assert f.read() == content
+    client._requests_session.get.assert_called_once_with("url", stream=True, headers={'Range': 'bytes=4-'})
+
+
+def test__download_from_url_range_ignored(client, response, tmp_path, content):
+    path = str(tmp_path / "out.txt")
+    with open(path + DOWNLOAD_TEMP_FILE_SUFFIX, 'wb') as f:
+        f.write(b"garbage")
+    _download_from_url(client._requests_session, "url", path, expected_md5=hashlib.md5(content).hexdigest())
+    with open(path, 'rb') as f:
+        assert f.read() == content
+
+
+def test__download_from_url_partial_file_complete(client, tmp_path, content):
+    path = str(tmp_path / "out.txt")
+    with open(path + DOWNLOAD_TEMP_FILE_SUFFIX, 'wb') as f:
+        f.write(content)
+    _download_from_url(client._requests_session, "url", path,
+                       expected_md5=hashlib.md5(content).hexdigest(), expected_size=len(content))
+    client._requests_session.get.assert_not_called()
+    with open(path, 'rb') as f:
+        assert f.read() == content
+
+
+# _download_from_synapse
+
+def test__download_from_synapse(client, cache, url_cache, tmp_path):
+    path = str(tmp_path / "out.txt")
+    request = DownloadRequest(123, "syn1", "FileEntity", path)
+    result = _download_from_synapse(client._requests_session, cache, url_cache, request)
+    assert result.status == DOWNLOAD_STATUS_DOWNLOADED
+    assert result.error is None
+    url_cache.get.assert_called_once_with((123, "syn1", "FileEntity"))
+    assert normalize_path(path) in cache.get_all_unmodified_cached_file_paths(123)
+
+
+def test__download_from_synapse_lock_timeout(client, cache, url_cache, tmp_path):
+    request = DownloadRequest(123, "syn1", "FileEntity", str(tmp_path / "out.txt"))
+    error = LockException("timeout")
+    with patch.object(cache, "register", side_effect=error):
+        result = _download_from_synapse(client._requests_session, cache, url_cache, request)
+    assert (result.status, result.error) == (DOWNLOAD_STATUS_FAILED, error)
+
+
+def test__download_from_synapse_content_already_cached(client, url_cache, tmp_path, content):
+    cache = Cache(cache_root_dir=str(tmp_path / "cache"), use_index=True)
+    cached = tmp_path / "cached.txt"
+    cached.write_bytes(content)
+    cache.register(456, str(cached), content_md5=hashlib.md5(content).hexdigest())
+    path = str(tmp_path / "out.txt")
+    request = DownloadRequest(123, "syn1", "FileEntity", path)
+    result = _download_from_synapse(client._requests_session, cache, url_cache, request)
+    assert result.status == DOWNLOAD_STATUS_FROM_CACHE
+    client._requests_session.get.assert_not_called()
+    with open(path, 'rb') as f:
+        assert f.read() == content
+    assert normalize_path(path) in cache.get_all_unmodified_cached_file_paths(123)
+
+
+def test__download_from_synapse_failure_code(client, cache, url_cache, tmp_path):
+    request = DownloadRequest(123, "syn1", "FileEntity", str(tmp_path / "out.txt"))
+    url_cache.get.return_value = {'fileHandleId': '123', 'failureCode': 'UNAUTHORIZED'}
+    result = _download_from_synapse(client._requests_session, cache, url_cache, request)
+    assert result.status == DOWNLOAD_STATUS_FAILED
+    assert isinstance(result.error, SynapseUnauthorizedError)
+    client._requests_session.get.assert_not_called()
+
+
+def test__download_from_synapse_refreshes_rejected_url(client, cache, url_cache, response, tmp_path):
+    request = DownloadRequest(123, "syn1", "FileEntity", str(tmp_path / "out.txt"))
+    rejected = Mock(requests.Response)
+    rejected.status_code = 403
+    rejected.reason = "Request has expired"
+    rejected.__enter__ = Mock(return_value=rejected)
+    rejected.__exit__ = Mock(return_value=False)
+    client._requests_session.get.side_effect = [rejected, response]
+    result = _download_from_synapse(client._requests_session, cache, url_cache, request)
+    assert result.status == DOWNLOAD_STATUS_DOWNLOADED
+    url_cache.invalidate.assert_called_once_with((123, "syn1", "FileEntity"))
+    assert url_cache.get.call_count == 2
+
+
+def test__download_from_synapse_retries_and_gives_up(client, cache, url_cache, tmp_path):
+    path = str(tmp_path / "out.txt")
+    request = DownloadRequest(123, "syn1", "FileEntity", path)
+    client._requests_session.get.side_effect = requests.ConnectionError()
+    with patch("spccore.download.doze") as mock_doze:
+        result = _download_from_synapse(client._requests_session, cache, url_cache, request)
+        assert mock_doze.call_count == DOWNLOAD_MAX_ATTEMPTS - 1
+    assert result.status == DOWNLOAD_STATUS_FAILED
+    assert isinstance(result.error, requests.ConnectionError)
+    assert client._requests_session.get.call_count == DOWNLOAD_MAX_ATTEMPTS
+    url_cache.invalidate.assert_not_called()
+    assert not os.path.exists(path + DOWNLOAD_TEMP_FILE_SUFFIX)
+
+
+# _group_by_file_handle_id
+
+def test__group_by_file_handle_id():
+    a1 = DownloadRequest(1, "syn1", "FileEntity", "a1")
+    b = DownloadRequest(2, "syn2", "FileEntity", "b")
+    a2 = DownloadRequest(1, "syn3", "FileEntity", "a2")
+    assert _group_by_file_handle_id([a1, b, a2], range(3)) == [[0, 2], [1]]
+    assert _group_by_file_handle_id([a1, b, a2], [1, 2]) == [[1], [2]]
+    assert _group_by_file_handle_id([], []) == []
+
+
+# _download_group
+
+def test__download_group_fans_out(client, cache, url_cache, tmp_path, content):
+    paths = [str(tmp_path / name / "out.txt") for name in ("a", "b", "c")]
+    group = [DownloadRequest(123, "syn1", "FileEntity", path) for path in paths]
+    results = _download_group(client._requests_session, cache, url_cache, group)
+    assert [result.status for result in results] == [DOWNLOAD_STATUS_DOWNLOADED] * 3
+    client._requests_session.get.assert_called_once()
+    for path in paths:
+        with open(path, 'rb') as f:
+            assert f.read() == content
+    assert set(normalize_path(path) for path in paths) == set(cache.get_all_unmodified_cached_file_paths(123))
+
+
+def test__download_group_primary_failed(client, cache, url_cache, tmp_path):
+    group = [DownloadRequest(123, "syn1", "FileEntity", str(tmp_path / name)) for name in ("a", "b")]
+    url_cache.get.return_value = {'fileHandleId': '123', 'failureCode': 'NOT_FOUND'}
+    with patch("spccore.download.materialize_file") as mock_materialize:
+        results = _download_group(client._requests_session, cache, url_cache, group)
+        mock_materialize.assert_not_called()
+    assert [result.status for result in results] == [DOWNLOAD_STATUS_FAILED] * 2
+    assert results[1].error is results[0].error
+
+
+def test__download_group_fan_out_failed(client, cache, url_cache, tmp_path):
+    group = [DownloadRequest(123, "syn1", "FileEntity", str(tmp_path / name)) for name in ("a", "b")]
+    with patch("spccore.download.materialize_file", side_effect=OSError()):
+        results = _download_group(client._requests_session, cache, url_cache, group)
+    assert results[0].status == DOWNLOAD_STATUS_DOWNLOADED
+    assert results[1].status == DOWNLOAD_STATUS_FAILED
+
+
+# _download_file_handles
+
+def test__download_file_handles_uses_cache(client, cache, cached_file, tmp_path, content):
+    up_to_date = DownloadRequest(123, "syn1", "FileEntity", cached_file)
+    from_cache = DownloadRequest(123, "syn1", "FileEntity", str(tmp_path / "copy.txt"))
+    downloaded = DownloadRequest(456, "syn2", "FileEntity", str(tmp_path / "new.txt"))
+    client.post.return_value = {'requestedFiles': [file_result(456, content)]}
+
+    results = _download_file_handles(client, [up_to_date, from_cache, downloaded], cache=cache, max_threads=2)
+
+    assert [result.status for result in results] == [DOWNLOAD_STATUS_UP_TO_DATE,
+                                                     DOWNLOAD_STATUS_FROM_CACHE,
+                                                     DOWNLOAD_STATUS_DOWNLOADED]
+    # only the file that is not in the cache is requested from Synapse
+    assert client.post.call_count == 1
+    requested = client.post.call_args[1]['request_body']['requestedFiles']
+    assert [r['fileHandleId'] for r in requested] == ['456']
+    client._requests_session.get.assert_called_once_with(file_result(456, content)['preSignedURL'],
+                                                         stream=True,
+                                                         headers=None)
+
+
+def test__download_file_handles_batches_requests(client, cache, tmp_path, content):
+    download_requests = [DownloadRequest(i, "syn1", "FileEntity", str(tmp_path / str(i)))
+                         for i in range(SYNAPSE_FILE_HANDLE_BATCH_MAX_SIZE + 1)]
+    client.post.side_effect = lambda *args, **kwargs: {
+        'requestedFiles': [file_result(int(r['fileHandleId']), content)
+                           for r in kwargs['request_body']['requestedFiles']]}
+
+    results = _download_file_handles(client, download_requests, cache=cache, max_threads=4)
+
+    assert client.post.call_count == 2
+    assert len(results) == len(download_requests)
+    assert {result.status for result in results} == {DOWNLOAD_STATUS_DOWNLOADED}
+    # the URLs of completed downloads are not held
+    assert len(client._presigned_url_cache._entries) == 0
+
+
+def test__download_file_handles_deduplicates_file_handles(client, cache, tmp_path, content):
+    download_requests = [DownloadRequest(456, "syn{}".format(i), "FileEntity", str(tmp_path / str(i)))
+                         for i in range(3)]
+    client.post.return_value = {'requestedFiles': [file_result(456, content)]}
+
+    results = _download_file_handles(client, download_requests, cache=cache, max_threads=2)
+
+    assert len(results) == 3
+    assert {result.status for result in results} == {DOWNLOAD_STATUS_DOWNLOADED}
+    assert len(client.post.call_args[1]['request_body']['requestedFiles']) == 1
+    client._requests_session.get.assert_called_once()
+
+
+def test__download_file_handles_reports_progress(client, cache, cached_file, tmp_path, content):
+    from_cache = DownloadRequest(123, "syn1", "FileEntity", str(tmp_path / "copy.txt"))
+    downloaded = DownloadRequest(456, "syn2", "FileEntity", str(tmp_path / "new.txt"))
+    synapse_file = file_result(456, content)
+    synapse_file['fileHandle']['contentSize'] = len(content)
+    client.post.return_value = {'requestedFiles': [synapse_file]}
+    progress = TransferProgress()
+
+    _download_file_handles(client, [from_cache, downloaded], cache=cache, max_threads=2, progress=progress)
+
+    snapshot = progress.snapshot()
+    assert (snapshot.completed_files, snapshot.total_files) == (2, 2)
+    assert (snapshot.transferred_bytes, snapshot.total_bytes) == (len(content), len(content))
+
+
+def sized_file_result(file_handle_id, size):
+    return {'fileHandleId': str(file_handle_id), 'fileHandle': {'id': str(file_handle_id), 'contentSize': size},
+            'preSignedURL': 'https://s3.amazonaws.com/bucket/{}'.format(file_handle_id)}
+
+
+def test__check_disk_space_fits(client, cache, tmp_path):
+    client.post.side_effect = lambda *args, **kwargs: {
+        'requestedFiles': [sized_file_result(int(r['fileHandleId']), 100)
+                           for r in kwargs['request_body']['requestedFiles']]}
+    download_requests = [DownloadRequest(i, "syn1", "FileEntity", str(tmp_path / str(i))) for i in range(3)]
+    with patch('spccore.download.get_free_disk_space', return_value=(1, DOWNLOAD_MIN_FREE_DISK_SPACE_BYTES + 300)):
+        assert _check_disk_space(client, download_requests, cache=cache, max_threads=2, trim=False) == {}
+    # sized from the file handles alone, without presigned URLs, which are not cached
+    assert client.post.call_args[1]['request_body']['includePreSignedURLs'] is False
+    assert len(client._presigned_url_cache._entries) == 0
+
+
+def test__check_disk_space_fails_fast(client, cache, tmp_path):
+    client.post.side_effect = lambda *args, **kwargs: {
+        'requestedFiles': [sized_file_result(int(r['fileHandleId']), 100)
+                           for r in kwargs['request_body']['requestedFiles']]}
+    download_requests = [DownloadRequest(i, "syn1", "FileEntity", str(tmp_path / str(i))) for i in range(3)]
+    with patch('spccore.download.get_free_disk_space', return_value=(1, DOWNLOAD_MIN_FREE_DISK_SPACE_BYTES + 250)), \
+            pytest.raises(SynapseInsufficientDiskSpaceError):
+        _check_disk_space(client, download_requests, cache=cache, max_threads=2, trim=False)
+
+
+def test__check_disk_space_trims(client, cache, tmp_path):
+    sizes = {0: 200, 1: 100, 2: 50}
+    client.post.side_effect = lambda *args, **kwargs: {
+        'requestedFiles': [sized_file_result(int(r['fileHandleId']), sizes[int(r['fileHandleId'])])
+                           for r in kwargs['request_body']['requestedFiles']]}
+    download_requests = [DownloadRequest(i, "syn1", "FileEntity", str(tmp_path / str(i))) for i in range(3)]
+    with patch('spccore.download.get_free_disk_space', return_value=(1, DOWNLOAD_MIN_FREE_DISK_SPACE_BYTES + 260)):
+        trimmed = _check_disk_space(client, download_requests, cache=cache, max_threads=2, trim=True)
+    assert list(trimmed) == [1]
+    assert isinstance(trimmed[1], SynapseInsufficientDiskSpaceError)
+
+
+def test__check_disk_space_skips_cached_and_duplicate_files(client, cache, cached_file, tmp_path):
+    client.post.side_effect = lambda *args, **kwargs: {
+        'requestedFiles': [sized_file_result(int(r['fileHandleId']), 100)
+                           for r in kwargs['request_body']['requestedFiles']]}
+    download_requests = [DownloadRequest(123, "syn1", "FileEntity", str(tmp_path / "cached")),
+                         DownloadRequest(456, "syn2", "FileEntity", str(tmp_path / "a")),
+                         DownloadRequest(456, "syn2", "FileEntity", str(tmp_path / "b"))]
+    with patch('spccore.download.get_free_disk_space', return_value=(1, DOWNLOAD_MIN_FREE_DISK_SPACE_BYTES + 100)):
+        assert _check_disk_space(client, download_requests, cache=cache, max_threads=2, trim=False) == {}
+    requested = client.post.call_args[1]['request_body']['requestedFiles']
+    assert [r['fileHandleId'] for r in requested] == ['456']
+
+
+def test__download_file_handles_trims_batch(client, cache, tmp_path, content):
+    download_requests = [DownloadRequest(i, "syn1", "FileEntity", str(tmp_path / str(i))) for i in range(3)]
+    error = SynapseInsufficientDiskSpaceError()
+    client.post.side_effect = lambda *args, **kwargs: {
+        'requestedFiles': [file_result(int(r['fileHandleId']), content)
+                           for r in kwargs['request_body']['requestedFiles']]}
+    with patch('spccore.download._check_disk_space', return_value={1: error}) as mock_check:
+        results = _download_file_handles(client, download_requests, cache=cache, max_threads=2,
+                                         disk_space_check=DOWNLOAD_DISK_SPACE_CHECK_TRIM)
+        mock_check.assert_called_once_with(client, download_requests, cache=cache, max_threads=2, trim=True)
+    assert [result.status for result in results] == [DOWNLOAD_STATUS_DOWNLOADED,
+                                                     DOWNLOAD_STATUS_FAILED,
+                                                     DOWNLOAD_STATUS_DOWNLOADED]
+    assert results[1].error is error
+    assert [result.path for result in results] == [request.path for request in download_requests]
+    assert not os.path.exists(download_requests[1].path)
+
+
+def test__download_file_handles_writes_request_batch_results_into_result_batch(client, cache, tmp_path, content):
+    download_requests = DownloadRequestBatch(DownloadRequest(i, "syn1", "FileEntity", str(tmp_path / str(i)))
+                                             for i in range(3))
+    error = SynapseInsufficientDiskSpaceError()
+    client.post.side_effect = lambda *args, **kwargs: {
+        'requestedFiles': [file_result(int(r['fileHandleId']), content)
+                           for r in kwargs['request_body']['requestedFiles']]}
+    with patch('spccore.download._check_disk_space', return_value={1: error}), \
+            patch.object(DownloadResultBatch, 'set_result', autospec=True,
+                         side_effect=DownloadResultBatch.set_result) as mock_set_result:
+        results = _download_file_handles(client, download_requests, cache=cache, max_threads=2,
+                                         disk_space_check=DOWNLOAD_DISK_SPACE_CHECK_TRIM)
+    assert isinstance(results, DownloadResultBatch)
+    assert mock_set_result.call_count == 3
+    assert [result.status for _, result in results.results()] == [DOWNLOAD_STATUS_DOWNLOADED,
+                                                                  DOWNLOAD_STATUS_FAILED,
+                                                                  DOWNLOAD_STATUS_DOWNLOADED]
+    assert results.result(1).error is error
+
+
+def test__iter_download_file_handles_yields_as_completed(client, cache, cached_file, tmp_path, content):
+    from_cache = DownloadRequest(123, "syn1", "FileEntity", str(tmp_path / "copy.txt"))
+    downloaded = DownloadRequest(456, "syn2", "FileEntity", str(tmp_path / "new.txt"))
+    client.post.return_value = {'requestedFiles': [file_result(456, content)]}
+
+    iterator = _iter_download_file_handles(client, [downloaded, from_cache], cache=cache, max_threads=2)
+    # the cache hit is yielded before the batch request for the transfer is sent
+    index, result = next(iterator)
+    assert (index, result.status) == (1, DOWNLOAD_STATUS_FROM_CACHE)
+    client.post.assert_not_called()
+    index, result = next(iterator)
+    assert (index, result.status) == (0, DOWNLOAD_STATUS_DOWNLOADED)
+    with pytest.raises(StopIteration):
+        next(iterator)
+
+
+def test__iter_download_file_handles_deduplicates_across_windows(client, cache, tmp_path, content):
+    download_requests = [DownloadRequest(456, "syn1", "FileEntity", str(tmp_path / str(i)))
+                         for i in range(SYNAPSE_FILE_HANDLE_BATCH_MAX_SIZE + 1)]
+    client.post.return_value = {'requestedFiles': [file_result(456, content)]}
+
+    results = dict(_iter_download_file_handles(client, download_requests, cache=cache, max_threads=4))
+
+    assert set(results) == set(range(len(download_requests)))
+    assert results[SYNAPSE_FILE_HANDLE_BATCH_MAX_SIZE].status == DOWNLOAD_STATUS_FROM_CACHE
+    client.post.assert_called_once()
+    client._requests_session.get.assert_called_once()
+
+
+# zip packages
+
+def zip_entry_name(file_handle_id):
+    return "{}/{}/file{}.txt".format(file_handle_id % 1000, file_handle_id, file_handle_id)
+
+
+def zip_package_client(client, content, file_handle_ids, *, failed=(), corrupted=()):
+    """Answer the batch, bulk download job and zip URL requests, and stream a zip of the file handles"""
+    def post(request_path, request_body=None, **kwargs):
+        if request_path == '/file/bulk/async/start':
+            return {'token': '7'}
+        return {'requestedFiles': [sized_file_result(int(r['fileHandleId']), len(content))
+                                   for r in request_body['requestedFiles']]}
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for file_handle_id in file_handle_ids:
+            if file_handle_id not in failed:
+                archive.writestr(zip_entry_name(file_handle_id),
+                                 b"corrupted!!!" if file_handle_id in corrupted else content)
+    bulk_response = {'resultZipFileHandleId': '999',
+                     'fileSummary': [{'fileHandleId': str(file_handle_id),
+                                      'status': 'FAILURE' if file_handle_id in failed else 'SUCCESS',
+                                      'zipEntryName': zip_entry_name(file_handle_id)}
+                                     for file_handle_id in file_handle_ids]}
+    client.post.side_effect = post
+    client.get.side_effect = [{'jobState': 'PROCESSING'}, bulk_response, 'https://s3.amazonaws.com/bucket/zip']
+    zip_response = Mock(requests.Response)
+    zip_response.status_code = 200
+    zip_response.iter_content.return_value = [buffer.getvalue()]
+    zip_response.__enter__ = Mock(return_value=zip_response)
+    zip_response.__exit__ = Mock(return_value=False)
+    client._requests_session.get.side_effect = lambda url, **kwargs: \
+        zip_response if url.endswith('/zip') else client._requests_session.get.return_value
+    return client
+
+
+def sized_file_result_with_md5(file_handle_id, content):
+    result = sized_file_result(file_handle_id, len(content))
+    result['fileHandle']['contentMd5'] = hashlib.md5(content).hexdigest()
+    return result
+
+
+def test__select_zip_package(client, cache, tmp_path):
+    small = list(range(1, DOWNLOAD_ZIP_PACKAGE_MIN_FILES + 1))
+    large = DOWNLOAD_ZIP_PACKAGE_MIN_FILES + 1
+    too_large = DOWNLOAD_ZIP_PACKAGE_MAX_FILE_SIZE_BYTES + 1
+    client.post.return_value = {'requestedFiles': [sized_file_result(i, 10) for i in small] +
+                                                  [sized_file_result(large, too_large)]}
+    download_requests = [DownloadRequest(i, "syn1", "FileEntity", str(tmp_path / str(i))) for i in small + [large]]
+    groups = [[index] for index in range(len(download_requests))]
+
+    assert _select_zip_package(client._presigned_url_cache, download_requests, groups) == groups[:-1]
+    assert _select_zip_package(client._presigned_url_cache, download_requests, groups[1:]) == []
+
+
+def test__get_async_job_response(client):
+    client.post.return_value = {'token': '7'}
+    client.get.side_effect = [{'jobState': 'PROCESSING'}, {'resultZipFileHandleId': '999'}]
+    with patch('spccore.download.doze') as mock_doze:
+        assert _get_async_job_response(client, '/file/bulk/async', {}, endpoint=SYNAPSE_DEFAULT_FILE_ENDPOINT) == \
+            {'resultZipFileHandleId': '999'}
+    client.post.assert_called_once_with('/file/bulk/async/start', request_body={},
+                                        endpoint=SYNAPSE_DEFAULT_FILE_ENDPOINT)
+    client.get.assert_called_with('/file/bulk/async/get/7', endpoint=SYNAPSE_DEFAULT_FILE_ENDPOINT)
+    mock_doze.assert_called_once_with(SYNAPSE_ASYNC_JOB_POLL_INTERVAL_SEC)
+
+
+def test__get_async_job_response_failed(client):
+    client.post.return_value = {'token': '7'}
+    client.get.return_value = {'jobState': 'FAILED', 'errorMessage': 'boom'}
+    with pytest.raises(SynapseClientError) as error:
+        _get_async_job_response(client, '/file/bulk/async', {}, endpoint=SYNAPSE_DEFAULT_FILE_ENDPOINT)
+    assert 'boom' in error.value.message
+
+
+def test__download_file_handles_zip_small_files(client, cache, tmp_path, content):
+    file_handle_ids = list(range(1, DOWNLOAD_ZIP_PACKAGE_MIN_FILES + 1))
+    zip_package_client(client, content, file_handle_ids)
+    download_requests = [DownloadRequest(i, "syn1", "FileEntity", str(tmp_path / str(i))) for i in file_handle_ids]
+    # a second path for the same file handle is materialized from the extracted file
+    download_requests.append(DownloadRequest(1, "syn1", "FileEntity", str(tmp_path / "copy")))
+    progress = TransferProgress()
+
+    with patch('spccore.download.doze'):
+        results = _download_file_handles(client, download_requests, cache=cache, max_threads=2, progress=progress,
+                                         zip_small_files=True)
+
+    assert {result.status for result in results} == {DOWNLOAD_STATUS_DOWNLOADED}
+    for download_request in download_requests:
+        with open(download_request.path, 'rb') as f:
+            assert f.read() == content
+        assert normalize_path(download_request.path) in \
+            cache.get_all_unmodified_cached_file_paths(download_request.file_handle_id)
+    request_body = client.post.call_args_list[-1][1]['request_body']
+    assert request_body['concreteType'] == SYNAPSE_BULK_DOWNLOAD_REQUEST_TYPE
+    assert [r['fileHandleId'] for r in request_body['requestedFiles']] == [str(i) for i in file_handle_ids]
+    # only the zip is transferred
+    client._requests_session.get.assert_called_once()
+    snapshot = progress.snapshot()
+    assert (snapshot.transferred_bytes, snapshot.total_bytes) == (len(content) * len(file_handle_ids),) * 2
+
+
+def test__download_file_handles_zip_falls_back_per_file(client, cache, tmp_path, content):
+    file_handle_ids = list(range(1, DOWNLOAD_ZIP_PACKAGE_MIN_FILES + 1))
+    zip_package_client(client, content, file_handle_ids, failed=[1], corrupted=[2])
+    client.post.side_effect = lambda request_path, request_body=None, **kwargs: \
+        {'token': '7'} if request_path == '/file/bulk/async/start' else \
+        {'requestedFiles': [sized_file_result_with_md5(int(r['fileHandleId']), content)
+                            for r in request_body['requestedFiles']]}
+    client._requests_session.get.return_value.iter_content.return_value = [content]
+    download_requests = [DownloadRequest(i, "syn1", "FileEntity", str(tmp_path / str(i))) for i in file_handle_ids]
+    progress = TransferProgress()
+
+    with patch('spccore.download.doze'):
+        results = _download_file_handles(client, download_requests, cache=cache, max_threads=2, progress=progress,
+                                         zip_small_files=True)
+
+    assert {result.status for result in results} == {DOWNLOAD_STATUS_DOWNLOADED}
+    for download_request in download_requests:
+        with open(download_request.path, 'rb') as f:
+            assert f.read() == content
+    # the zip, then the file Synapse could not package and the corrupted member, one by one
+    assert client._requests_session.get.call_count == 3
+    snapshot = progress.snapshot()
+    assert (snapshot.transferred_bytes, snapshot.total_bytes) == (len(content) * len(file_handle_ids),) * 2
+
+
+def test__extract_zip_member_bad_crc(cache, tmp_path, content):
+    download_request = DownloadRequest(1, "syn1", "FileEntity", str(tmp_path / "a.txt"))
+
+    def corrupt_content():
+        yield content
+        raise zipfile.BadZipFile("Bad CRC-32 for member a.txt")
+
+    assert _extract_zip_member(cache, [download_request], {'contentSize': len(content)}, corrupt_content()) is None
+    assert not os.path.exists(download_request.path)
+    assert cache.get_all_unmodified_cached_file_paths(1) == []
+
+
+def test__extract_zip_member_cache_lock_timeout(cache, tmp_path, content):
+    download_requests = [DownloadRequest(1, "syn1", "FileEntity", str(tmp_path / name)) for name in ("a", "b")]
+    error = LockException("timeout")
+    with patch.object(cache, 'register', side_effect=error):
+        results = _extract_zip_member(cache, download_requests, {'contentSize': len(content)}, iter([content]))
+    assert [(result.status, result.error) for result in results] == [(DOWNLOAD_STATUS_FAILED, error)] * 2
+
+
+def test__download_file_handles_zip_package_failed(client, cache, tmp_path, content):
+    file_handle_ids = list(range(1, DOWNLOAD_ZIP_PACKAGE_MIN_FILES + 1))
+    zip_package_client(client, content, file_handle_ids)
+    client.get.side_effect = [{'jobState': 'FAILED', 'errorMessage': 'boom'}]
+    download_requests = [DownloadRequest(i, "syn1", "FileEntity", str(tmp_path / str(i))) for i in file_handle_ids]
+
+    results = _download_file_handles(client, download_requests, cache=cache, max_threads=2, zip_small_files=True)
+
+    assert {result.status for result in results} == {DOWNLOAD_STATUS_DOWNLOADED}
+    assert client._requests_session.get.call_count == len(file_handle_ids)
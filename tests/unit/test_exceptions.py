@@ -1,3 +1,4 @@
+import pytest
 from unittest.mock import patch, Mock
 from spccore.exceptions import *
 
@@ -83,3 +84,19 @@ def test_check_status_code_and_raise_error_unknown_5xx():
             assert isinstance(e, SynapseServerError)
             assert e.message == reason
             assert e.error_code == error_code
+
+
+def test_check_storage_status_code_and_raise_error():
+    response = Mock(requests.Response)
+    response.status_code = 403
+    response.reason = "Forbidden"
+    with pytest.raises(SynapseUnauthorizedError):
+        check_storage_status_code_and_raise_error(response)
+    response.status_code = 502
+    with pytest.raises(SynapseServerError):
+        check_storage_status_code_and_raise_error(response)
+    response.status_code = 418
+    with pytest.raises(SynapseClientError):
+        check_storage_status_code_and_raise_error(response)
+    response.status_code = 206
+    check_storage_status_code_and_raise_error(response)
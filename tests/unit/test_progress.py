@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+from unittest.mock import patch, Mock
+
+from spccore.progress import *
+
+
+def test_invalid_interval():
+    with pytest.raises(ValueError):
+        TransferProgress(interval=0)
+
+
+def test_snapshot_sums_worker_counters():
+    progress = TransferProgress()
+    progress.expect_files(4)
+    progress.expect_bytes(4000)
+
+    def worker():
+        for _ in range(10):
+            progress.add_bytes(100)
+        progress.add_files()
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    snapshot = progress.snapshot()
+    assert snapshot.transferred_bytes == 4000
+    assert snapshot.total_bytes == 4000
+    assert snapshot.completed_files == 4
+    assert snapshot.total_files == 4
+    # the counters of the ended threads are folded, only the calling thread keeps one
+    assert len(progress._counters) == 1
+
+
+def test_exit_drops_counters_of_ended_workers():
+    progress = TransferProgress()
+    for _ in range(3):
+        with progress:
+            threads = [threading.Thread(target=progress.add_bytes, args=(100,)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert progress._counters == []
+    assert progress.snapshot().transferred_bytes == 1200
+
+
+def test_snapshot_rate_and_eta():
+    with patch.object(time, "monotonic", return_value=100):
+        progress = TransferProgress()
+    progress.expect_bytes(1000)
+    progress.add_bytes(200)
+    with patch.object(time, "monotonic", return_value=102):
+        snapshot = progress.snapshot()
+    assert snapshot.bytes_per_second == 100
+    assert snapshot.eta_seconds == 8
+    assert snapshot.elapsed_seconds == 2
+    # too close to the previous snapshot to measure a new rate
+    progress.add_bytes(400)
+    with patch.object(time, "monotonic", return_value=102.5):
+        assert progress.snapshot().bytes_per_second == 100
+
+
+def test_snapshot_without_rate():
+    progress = TransferProgress(interval=10)
+    assert progress.snapshot().bytes_per_second is None
+    assert progress.snapshot().eta_seconds is None
+
+
+def test_callback_reports_until_exit():
+    reported = threading.Event()
+    callback = Mock(side_effect=lambda snapshot: reported.set())
+    progress = TransferProgress(callback=callback, interval=0.01)
+    with progress:
+        progress.add_bytes(10)
+        assert reported.wait(5)
+    count = callback.call_count
+    assert callback.call_args[0][0].transferred_bytes == 10
+    assert progress._reporter is None
+    assert callback.call_count == count
+
+
+def test_nested_transfers_share_one_reporter():
+    callback = Mock()
+    progress = TransferProgress(callback=callback, interval=60)
+    with progress:
+        reporter = progress._reporter
+        with progress:
+            assert progress._reporter is reporter
+        assert callback.call_count == 0
+    callback.assert_called_once()
@@ -0,0 +1,171 @@
+import hashlib
+import concurrent.futures
+import os
+
+import pytest
+from unittest.mock import patch, Mock
+
+from spccore.download import DownloadResult, DOWNLOAD_STATUS_DOWNLOADED, DOWNLOAD_STATUS_FAILED
+from spccore.internal.cache import Cache
+from spccore.internal.lock import LockException
+from spccore.sync import *
+from spccore.sync import _sync_from_synapse, _sync_to_synapse, _scan_tree, _is_unchanged
+
+
+@pytest.fixture
+def local_dir(tmp_path):
+    root = tmp_path / "project"
+    (root / "data" / "raw").mkdir(parents=True)
+    (root / "README.md").write_bytes(b"readme")
+    (root / "data" / "a.csv").write_bytes(b"a,b\n")
+    (root / "data" / "raw" / "b.bin").write_bytes(b"bbbb")
+    return str(root)
+
+
+@pytest.fixture
+def client(tmp_path):
+    client = Mock()
+    client._cache = Cache(cache_root_dir=str(tmp_path / "cache"))
+    return client
+
+
+def remote_file(path, file_handle_id, content):
+    return RemoteFile(path, file_handle_id, "syn{}".format(file_handle_id), "FileEntity", len(content),
+                      hashlib.md5(content).hexdigest())
+
+
+# _scan_tree
+
+def test__scan_tree(local_dir):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        files = _scan_tree(local_dir, executor)
+    assert sorted(files) == ["README.md", "data/a.csv", "data/raw/b.bin"]
+    assert files["data/raw/b.bin"].st_size == 4
+
+
+def test__scan_tree_skips_download_temp_files(local_dir):
+    with open(os.path.join(local_dir, "c.txt" + DOWNLOAD_TEMP_FILE_SUFFIX), 'wb'):
+        pass
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        assert "c.txt" + DOWNLOAD_TEMP_FILE_SUFFIX not in _scan_tree(local_dir, executor)
+
+
+# _is_unchanged
+
+def test__is_unchanged_missing_local_file(client):
+    assert not _is_unchanged(client._cache, remote_file("a", 1, b"a"), "a", None)
+
+
+def test__is_unchanged_size_differs_without_hashing(client, local_dir):
+    path = os.path.join(local_dir, "README.md")
+    with patch.object(client._cache.hashing_service, 'md5_of_file') as mock_md5:
+        assert not _is_unchanged(client._cache, remote_file("README.md", 1, b"other content"), path, os.stat(path))
+        mock_md5.assert_not_called()
+
+
+def test__is_unchanged_vouched_by_cache_without_hashing(client, local_dir):
+    path = os.path.join(local_dir, "README.md")
+    client._cache.register(1, path)
+    with patch.object(client._cache.hashing_service, 'md5_of_file') as mock_md5:
+        assert _is_unchanged(client._cache, remote_file("README.md", 1, b"readme"), path, os.stat(path))
+        mock_md5.assert_not_called()
+
+
+def test__is_unchanged_by_md5_registers_in_cache(client, local_dir):
+    path = os.path.join(local_dir, "README.md")
+    assert _is_unchanged(client._cache, remote_file("README.md", 1, b"readme"), path, os.stat(path))
+    assert client._cache.get_all_unmodified_cached_file_paths(1) == [normalize_path(path)]
+
+
+def test__is_unchanged_md5_differs(client, local_dir):
+    path = os.path.join(local_dir, "README.md")
+    assert not _is_unchanged(client._cache, remote_file("README.md", 1, b"README"), path, os.stat(path))
+
+
+# _sync_from_synapse
+
+def test__sync_from_synapse(client, local_dir):
+    unchanged = remote_file("README.md", 1, b"readme")
+    changed = remote_file("data/a.csv", 2, b"a,b,c\n")
+    missing = remote_file("data/new.txt", 3, b"new")
+    failing = remote_file("data/failing.txt", 4, b"fail")
+    error = SynapseNotFoundError()
+
+    def download_file_handles(download_requests, **kwargs):
+        return {request: DownloadResult(request.path, DOWNLOAD_STATUS_FAILED, error=error)
+                if request.file_handle_id == 4 else DownloadResult(request.path, DOWNLOAD_STATUS_DOWNLOADED)
+                for request in download_requests}
+
+    client.download_file_handles.side_effect = download_file_handles
+    result = _sync_from_synapse(client, [unchanged, changed, missing, failing], local_dir, max_threads=2,
+                                priority=TRANSFER_PRIORITY_BULK)
+
+    assert result.unchanged == ["README.md"]
+    assert sorted(result.transferred) == ["data/a.csv", "data/new.txt"]
+    assert result.transferred["data/new.txt"].path == os.path.join(local_dir, "data", "new.txt")
+    assert result.failed == {"data/failing.txt": error}
+    assert result.extraneous == ["data/raw/b.bin"]
+    download_requests = client.download_file_handles.call_args[0][0]
+    assert [request.file_handle_id for request in download_requests] == [2, 4, 3]
+    assert client.download_file_handles.call_args[1] == {'use_multiple_threads': True,
+                                                         'priority': TRANSFER_PRIORITY_BULK}
+
+
+def test__sync_from_synapse_to_new_directory(client, tmp_path):
+    client.download_file_handles.return_value = {}
+    result = _sync_from_synapse(client, [remote_file("a.txt", 1, b"a")], str(tmp_path / "new"), max_threads=1)
+    assert [request.path for request in client.download_file_handles.call_args[0][0]] == \
+        [os.path.join(str(tmp_path / "new"), "a.txt")]
+    assert result.extraneous == []
+
+
+# _sync_to_synapse
+
+def test__sync_to_synapse(client, local_dir):
+    unchanged = remote_file("README.md", 1, b"readme")
+    changed = remote_file("data/a.csv", 2, b"a,b,c\n")
+    remote_only = remote_file("data/gone.txt", 3, b"gone")
+    file_handles = {os.path.join(local_dir, "data", "a.csv"): {'id': '12'},
+                    os.path.join(local_dir, "data", "raw", "b.bin"): {'id': '13'}}
+
+    def upload_file_handle(path, content_type, **kwargs):
+        return file_handles[path]
+
+    client.upload_file_handle.side_effect = upload_file_handle
+    result = _sync_to_synapse(client, local_dir, [unchanged, changed, remote_only], max_threads=2,
+                              storage_location_id=1)
+
+    assert result.unchanged == ["README.md"]
+    assert result.transferred == {"data/a.csv": {'id': '12'}, "data/raw/b.bin": {'id': '13'}}
+    assert result.failed == {}
+    assert result.extraneous == ["data/gone.txt"]
+    client.upload_file_handle.assert_any_call(os.path.join(local_dir, "data", "a.csv"), "text/csv",
+                                              storage_location_id=1)
+    # the uploaded files are recognized by the next sync without hashing
+    assert client._cache.get_all_unmodified_cached_file_paths(12) == \
+        [normalize_path(os.path.join(local_dir, "data", "a.csv"))]
+
+
+def test__sync_to_synapse_upload_failure(client, local_dir):
+    error = SynapseServerError()
+    client.upload_file_handle.side_effect = error
+    result = _sync_to_synapse(client, local_dir, [], max_threads=1)
+    assert result.failed == {"README.md": error, "data/a.csv": error, "data/raw/b.bin": error}
+    assert result.transferred == {}
+
+
+def test__sync_to_synapse_upload_invalid(client, local_dir):
+    error = ValueError("invalid storage location")
+    client.upload_file_handle.side_effect = error
+    result = _sync_to_synapse(client, local_dir, [], max_threads=1)
+    assert result.failed == {"README.md": error, "data/a.csv": error, "data/raw/b.bin": error}
+    assert result.transferred == {}
+
+
+def test__sync_to_synapse_cache_lock_timeout(client, local_dir):
+    client.upload_file_handle.return_value = {'id': '12'}
+    with patch.object(client._cache, "register", side_effect=LockException("timeout")):
+        result = _sync_to_synapse(client, local_dir, [], max_threads=1)
+    # the files were uploaded even though the cache could not record them
+    assert result.transferred == {"README.md": {'id': '12'}, "data/a.csv": {'id': '12'}, "data/raw/b.bin": {'id': '12'}}
+    assert result.failed == {}
@@ -0,0 +1,409 @@
+import hashlib
+import io
+import mmap
+import os
+import threading
+import time
+
+import pytest
+from unittest.mock import patch, Mock, call
+
+from spccore.internal.uploadstate import UploadState
+from spccore.progress import TransferProgress
+from spccore.upload import *
+from spccore.upload import _upload_stream, _upload_parts, _upload_part, _add_part, _get_missing_part_numbers, \
+    _get_part_size, _iter_parts, _upload_file_handle, _upload_file_handles
+
+MiB = 1024 * 1024
+
+
+@pytest.fixture
+def client():
+    client = Mock()
+    client._default_file_endpoint = "https://repo-prod.prod.sagebase.org/file/v1"
+    return client
+
+
+def fake_synapse(client, parts_state=None):
+    """
+    Make the client behave like Synapse for a multipart upload, and record the uploaded parts
+    """
+    uploaded = {}
+
+    def post(path, request_body=None, **kwargs):
+        if path == '/file/multipart':
+            fake_synapse.part_size = request_body['partSizeBytes']
+            number_of_parts = max(1, -(-request_body['fileSizeBytes'] // request_body['partSizeBytes']))
+            return {'uploadId': '7', 'state': 'UPLOADING', 'partsState': parts_state or '0' * number_of_parts}
+        return {'partPresignedUrls': [{'partNumber': n, 'uploadPresignedUrl': 'https://s3/' + str(n)}
+                                      for n in request_body['partNumbers']]}
+
+    def put(path, **kwargs):
+        if path.endswith('/complete'):
+            return {'state': MULTIPART_UPLOAD_STATE_COMPLETED, 'resultFileHandleId': '42'}
+        return {'addPartState': ADD_PART_STATE_SUCCESS}
+
+    def put_part(url, data, headers):
+        uploaded[int(url.rsplit('/', 1)[1])] = data
+        return Mock(status_code=200)
+
+    client.post.side_effect = post
+    client.put.side_effect = put
+    client.get.return_value = {'id': '42'}
+    client._requests_session.put.side_effect = put_part
+    return uploaded
+
+
+# _get_part_size
+
+def test__get_part_size_small_file():
+    assert _get_part_size(0) == UPLOAD_DEFAULT_PART_SIZE_BYTES
+
+
+def test__get_part_size_within_max_number_of_parts():
+    file_size = SYNAPSE_MULTIPART_MAX_NUMBER_OF_PARTS * UPLOAD_DEFAULT_PART_SIZE_BYTES + 1
+    assert _get_part_size(file_size) * SYNAPSE_MULTIPART_MAX_NUMBER_OF_PARTS >= file_size
+
+
+# _get_missing_part_numbers
+
+def test__get_missing_part_numbers():
+    assert _get_missing_part_numbers({'partsState': '1010'}) == {2, 4}
+
+
+# _iter_parts
+
+def test__iter_parts_regroups_chunks():
+    assert list(_iter_parts(iter([b"ab", b"cde", b"", b"f"]), 4)) == [b"abcd", b"ef"]
+
+
+def test__iter_parts_file_like():
+    assert list(_iter_parts(io.BytesIO(b"abcdefgh"), 4)) == [b"abcd", b"efgh"]
+
+
+def test__iter_parts_empty_stream():
+    assert list(_iter_parts(iter([]), 4)) == [b""]
+
+
+# _add_part
+
+def test__add_part_failure(client):
+    client.put.return_value = {'addPartState': 'ADD_FAILED', 'errorMessage': 'MD5 mismatch'}
+    with pytest.raises(SynapseClientError):
+        _add_part(client, '7', 1, 'md5')
+
+
+# _upload_part
+
+def test__upload_part_retries(client):
+    fake_synapse(client)
+    client._requests_session.put.side_effect = [Mock(status_code=503, reason="Slow Down"), Mock(status_code=200)]
+    with patch('spccore.upload.doze') as mock_doze:
+        _upload_part(client, '7', 1, b"data")
+        mock_doze.assert_called_once_with(UPLOAD_RETRY_BACKOFF_SEC)
+    assert client._requests_session.put.call_count == 2
+    client.put.assert_called_once_with('/file/multipart/7/add/1',
+                                       request_parameters={'partMD5Hex': hashlib.md5(b"data").hexdigest()},
+                                       endpoint=client._default_file_endpoint)
+
+
+def test__upload_part_gives_up(client):
+    fake_synapse(client)
+    client._requests_session.put.side_effect = None
+    client._requests_session.put.return_value = Mock(status_code=500, reason="Internal Error")
+    with patch('spccore.upload.doze'), pytest.raises(SynapseServerError):
+        _upload_part(client, '7', 1, b"data")
+    assert client._requests_session.put.call_count == UPLOAD_MAX_ATTEMPTS
+    client.put.assert_not_called()
+
+
+def test__upload_part_client_error_is_not_retried(client):
+    fake_synapse(client)
+    client._requests_session.put.side_effect = None
+    client._requests_session.put.return_value = Mock(status_code=400, reason="Bad Request")
+    with pytest.raises(SynapseBadRequestError):
+        _upload_part(client, '7', 1, b"data")
+    assert client._requests_session.put.call_count == 1
+
+
+# _upload_parts
+
+def test__upload_parts_bounds_buffered_parts(client):
+    buffered = []
+    in_flight = threading.Semaphore(0)
+    lock = threading.Lock()
+    produced = []
+
+    def parts():
+        for n in range(1, 11):
+            with lock:
+                produced.append(n)
+                buffered.append(len(produced) - in_flight._value)
+            yield n, b"x"
+
+    def upload_part(client, upload_id, part_number, data, part_md5, tuner, channel, progress):
+        in_flight.release()
+
+    with patch('spccore.upload._upload_part', side_effect=upload_part) as mock_upload_part:
+        _upload_parts(client, '7', parts(), max_threads=2, max_buffered_parts=3)
+    assert mock_upload_part.call_count == 10
+    assert max(buffered) <= 3
+
+
+def test__upload_parts_stops_after_failure(client):
+    produced = []
+
+    def parts():
+        for n in range(1, 101):
+            produced.append(n)
+            yield n, b"x"
+
+    with patch('spccore.upload._upload_part', side_effect=SynapseServerError()), \
+            pytest.raises(SynapseServerError):
+        _upload_parts(client, '7', parts(), max_threads=1, max_buffered_parts=1)
+    assert len(produced) < 100
+
+
+# _upload_file_handle
+
+def test__upload_file_handle(client, tmp_path):
+    uploaded = fake_synapse(client)
+    path = tmp_path / "a.txt"
+    path.write_bytes(b"content")
+    assert _upload_file_handle(client, str(path), "text/plain", generate_preview=False,
+                               storage_location_id=1, max_threads=2) == {'id': '42'}
+    assert uploaded == {1: b"content"}
+    request_body = client.post.call_args_list[0][1]['request_body']
+    assert request_body['contentMD5Hex'] == hashlib.md5(b"content").hexdigest()
+    assert request_body['fileName'] == "a.txt"
+    assert request_body['fileSizeBytes'] == 7
+    client.get.assert_called_once_with('/fileHandle/42', endpoint=client._default_file_endpoint)
+
+
+def test__upload_file_handle_reports_progress(client, tmp_path):
+    content = b"a" * UPLOAD_DEFAULT_PART_SIZE_BYTES + b"b"
+    fake_synapse(client, parts_state='10')
+    path = tmp_path / "a.bin"
+    path.write_bytes(content)
+    progress = TransferProgress()
+    _upload_file_handle(client, str(path), "application/octet-stream", generate_preview=False,
+                        storage_location_id=1, max_threads=2, progress=progress)
+    snapshot = progress.snapshot()
+    assert (snapshot.completed_files, snapshot.total_files) == (1, 1)
+    # the part Synapse already has counts as transferred
+    assert (snapshot.transferred_bytes, snapshot.total_bytes) == (len(content), len(content))
+
+
+def test__upload_file_handle_uploads_memory_mapped_parts(client, tmp_path):
+    uploaded = fake_synapse(client)
+    path = tmp_path / "a.txt"
+    path.write_bytes(b"content")
+    _upload_file_handle(client, str(path), "text/plain", generate_preview=False, storage_location_id=1,
+                        max_threads=1)
+    assert isinstance(uploaded[1], memoryview)
+    assert isinstance(uploaded[1].obj, mmap.mmap)
+
+
+def test__upload_file_handle_empty_file(client, tmp_path):
+    uploaded = fake_synapse(client)
+    path = tmp_path / "empty.txt"
+    path.write_bytes(b"")
+    _upload_file_handle(client, str(path), "text/plain", generate_preview=False, storage_location_id=1,
+                        max_threads=1)
+    assert uploaded == {1: b""}
+    assert client.post.call_args_list[0][1]['request_body']['contentMD5Hex'] == hashlib.md5(b"").hexdigest()
+
+
+def test__upload_file_handle_only_missing_parts(client, tmp_path):
+    content = b"a" * UPLOAD_DEFAULT_PART_SIZE_BYTES + b"b"
+    uploaded = fake_synapse(client, parts_state='10')
+    path = tmp_path / "a.bin"
+    path.write_bytes(content)
+    _upload_file_handle(client, str(path), "application/octet-stream", generate_preview=False,
+                        storage_location_id=1, max_threads=2)
+    assert uploaded == {2: b"b"}
+
+
+def test__upload_file_handle_already_completed(client, tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_bytes(b"content")
+    client.post.return_value = {'uploadId': '7', 'state': MULTIPART_UPLOAD_STATE_COMPLETED,
+                                'resultFileHandleId': '42'}
+    client.get.return_value = {'id': '42'}
+    assert _upload_file_handle(client, str(path), "text/plain", generate_preview=False,
+                               storage_location_id=1, max_threads=2) == {'id': '42'}
+    client._requests_session.put.assert_not_called()
+    client.put.assert_not_called()
+
+
+def test__upload_file_handle_with_hashing_service(client, tmp_path):
+    fake_synapse(client)
+    path = tmp_path / "a.txt"
+    path.write_bytes(b"content")
+    hashing_service = Mock()
+    hashing_service.md5s_of_file.return_value = ("content md5", ["part md5"])
+    with patch('spccore.upload.get_hashing_service') as mock_get_hashing_service:
+        _upload_file_handle(client, str(path), "text/plain", generate_preview=False, storage_location_id=1,
+                            max_threads=1, hashing_service=hashing_service)
+    mock_get_hashing_service.assert_not_called()
+    hashing_service.md5s_of_file.assert_called_once_with(str(path), UPLOAD_DEFAULT_PART_SIZE_BYTES)
+    assert client.post.call_args_list[0][1]['request_body']['contentMD5Hex'] == "content md5"
+
+
+def test__upload_file_handle_keeps_state_of_unfinished_upload(client, tmp_path):
+    fake_synapse(client)
+    path = tmp_path / "a.txt"
+    path.write_bytes(b"content")
+    state_dir = str(tmp_path / "state")
+    with patch('spccore.upload._complete_multipart_upload', side_effect=SynapseServerError()), \
+            pytest.raises(SynapseServerError):
+        _upload_file_handle(client, str(path), "text/plain", generate_preview=False, storage_location_id=1,
+                            max_threads=1, state_dir=state_dir)
+    state = UploadState.load(state_dir, str(path))
+    assert (state.upload_id, state.content_md5) == ('7', hashlib.md5(b"content").hexdigest())
+
+    # the state is dropped once the upload is complete
+    _upload_file_handle(client, str(path), "text/plain", generate_preview=False, storage_location_id=1,
+                        max_threads=1, state_dir=state_dir)
+    assert os.listdir(state_dir) == []
+
+
+def test__upload_file_handle_resumes_from_state(client, tmp_path):
+    content = b"a" * UPLOAD_DEFAULT_PART_SIZE_BYTES + b"b"
+    uploaded = fake_synapse(client, parts_state='10')
+    path = tmp_path / "a.bin"
+    path.write_bytes(content)
+    state_dir = str(tmp_path / "state")
+    state = UploadState.load(state_dir, str(path))
+    state.begin("recorded md5", UPLOAD_DEFAULT_PART_SIZE_BYTES, '7')
+
+    with patch('spccore.upload.get_hashing_service') as mock_hashing_service, \
+            patch('spccore.upload.hashlib.md5', wraps=hashlib.md5) as mock_hashlib_md5:
+        _upload_file_handle(client, str(path), "application/octet-stream", generate_preview=False,
+                            storage_location_id=1, max_threads=2, state_dir=state_dir)
+    # the file is not hashed again; only the missing part is
+    mock_hashing_service.assert_not_called()
+    assert mock_hashlib_md5.call_count == 1
+    assert client.post.call_args_list[0][1]['request_body']['contentMD5Hex'] == "recorded md5"
+    assert uploaded == {2: b"b"}
+
+
+# _upload_file_handles
+
+def test__upload_file_handles(client, tmp_path):
+    fake_synapse(client)
+    (tmp_path / "a.csv").write_bytes(b"a")
+    (tmp_path / "b.bin").write_bytes(b"b")
+    paths = [str(tmp_path / "a.csv"), str(tmp_path / "missing.txt"), str(tmp_path / "b.bin")]
+    progress = TransferProgress()
+    with patch('spccore.upload._upload_parts') as mock_upload_parts:
+        results = _upload_file_handles(client, paths, None, generate_preview=False, storage_location_id=1,
+                                       max_threads=2, progress=progress)
+    assert [result.path for result in results] == paths
+    assert [result.file_handle for result in results] == [{'id': '42'}, None, {'id': '42'}]
+    assert isinstance(results[1].error, FileNotFoundError)
+    # small files are sent as a single part, without a pool of part uploaders
+    mock_upload_parts.assert_not_called()
+    assert client._requests_session.put.call_count == 2
+    content_types = sorted(c[1]['request_body']['contentType'] for c in client.post.call_args_list
+                           if c[0][0] == '/file/multipart')
+    assert content_types == [UPLOAD_DEFAULT_CONTENT_TYPE, "text/csv"]
+    snapshot = progress.snapshot()
+    assert (snapshot.completed_files, snapshot.total_files) == (3, 3)
+    assert (snapshot.transferred_bytes, snapshot.total_bytes) == (2, 2)
+
+
+def test__upload_file_handles_large_file(client, tmp_path):
+    (tmp_path / "a.bin").write_bytes(b"content")
+    with patch('spccore.upload.UPLOAD_SINGLE_PART_MAX_SIZE_BYTES', 4), \
+            patch('spccore.upload._upload_file', return_value={'id': '42'}) as mock_upload_file:
+        results = _upload_file_handles(client, [str(tmp_path / "a.bin")], "application/octet-stream",
+                                       generate_preview=False, storage_location_id=1, max_threads=2)
+    assert results == [UploadResult(str(tmp_path / "a.bin"), {'id': '42'})]
+    mock_upload_file.assert_called_once_with(client, str(tmp_path / "a.bin"), "application/octet-stream",
+                                             generate_preview=False, storage_location_id=1, max_threads=2,
+                                             state_dir=None, hashing_service=None, channel=None, progress=None)
+
+
+def test__upload_file_handles_already_completed(client, tmp_path):
+    (tmp_path / "a.txt").write_bytes(b"content")
+    client.post.return_value = {'uploadId': '7', 'state': MULTIPART_UPLOAD_STATE_COMPLETED,
+                                'resultFileHandleId': '42'}
+    client.get.return_value = {'id': '42'}
+    results = _upload_file_handles(client, [str(tmp_path / "a.txt")], "text/plain", generate_preview=False,
+                                   storage_location_id=1, max_threads=1)
+    assert results[0].file_handle == {'id': '42'}
+    client._requests_session.put.assert_not_called()
+    client.put.assert_not_called()
+
+
+# _upload_stream
+
+def test__upload_stream_unknown_size(client):
+    uploaded = fake_synapse(client)
+    chunks = [b"a" * MiB for _ in range(9)]
+    assert _upload_stream(client, iter(chunks), "a.bin", "application/octet-stream", size=None, content_md5=None,
+                          generate_preview=False, storage_location_id=1, max_threads=2,
+                          max_buffered_parts=1) == {'id': '42'}
+    content = b"".join(chunks)
+    assert b"".join(uploaded[n] for n in sorted(uploaded)) == content
+    request_body = client.post.call_args_list[0][1]['request_body']
+    assert request_body['contentMD5Hex'] == hashlib.md5(content).hexdigest()
+    assert request_body['fileSizeBytes'] == len(content)
+
+
+def test__upload_stream_known_size_and_md5(client):
+    uploaded = fake_synapse(client)
+    content = b"a" * UPLOAD_DEFAULT_PART_SIZE_BYTES + b"b"
+    stream = io.BytesIO(content)
+    md5 = hashlib.md5(content).hexdigest()
+    with patch('spccore.upload.tempfile.SpooledTemporaryFile') as mock_spool:
+        _upload_stream(client, stream, "a.bin", "application/octet-stream", size=len(content), content_md5=md5,
+                       generate_preview=False, storage_location_id=1, max_threads=2, max_buffered_parts=2)
+        mock_spool.assert_not_called()
+    assert uploaded == {1: content[:UPLOAD_DEFAULT_PART_SIZE_BYTES], 2: b"b"}
+    assert client.post.call_args_list[0][1]['request_body']['contentMD5Hex'] == md5
+
+
+def test__get_part_size_targets_number_of_parts():
+    file_size = 50 * 1024 * MiB
+    part_size = _get_part_size(file_size)
+    assert part_size % MiB == 0
+    assert file_size / part_size <= UPLOAD_TARGET_NUMBER_OF_PARTS
+
+
+def test__get_part_size_bounded_by_max_autotuned_part_size():
+    assert _get_part_size(10 * UPLOAD_TARGET_NUMBER_OF_PARTS * UPLOAD_MAX_AUTOTUNED_PART_SIZE_BYTES) == \
+        UPLOAD_MAX_AUTOTUNED_PART_SIZE_BYTES
+
+
+def test__upload_part_throttled_notifies_tuner(client):
+    fake_synapse(client)
+    client._requests_session.put.side_effect = [Mock(status_code=429, reason="Too Many Requests"),
+                                                Mock(status_code=200)]
+    tuner = Mock()
+    with patch('spccore.upload.doze'):
+        _upload_part(client, '7', 1, b"data", tuner=tuner)
+    tuner.throttled.assert_called_once_with()
+    tuner.record.assert_called_once_with(4)
+
+
+def test__upload_parts_within_tuner_limit(client):
+    tuner = Mock(limit=2)
+    in_flight = []
+    most_in_flight = []
+    lock = threading.Lock()
+
+    def upload_part(client, upload_id, part_number, data, part_md5, tuner, channel, progress):
+        with lock:
+            in_flight.append(part_number)
+            most_in_flight.append(len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.remove(part_number)
+
+    with patch('spccore.upload._upload_part', side_effect=upload_part) as mock_upload_part:
+        _upload_parts(client, '7', ((n, b"x") for n in range(1, 11)), max_threads=4, max_buffered_parts=8,
+                      tuner=tuner)
+    assert mock_upload_part.call_count == 10
+    assert max(most_in_flight) == tuner.limit